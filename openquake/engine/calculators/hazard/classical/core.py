@@ -44,11 +44,12 @@ rule implemented in :method:`openquake.engine.models.HazardCurve.build_data`
 
 NB: notice that 1280 / 9 = 142.22, therefore storing all the hazard
 curves takes 140+ times more disk space and resources than actually needed.
-The plan for the future is store only the independent curves and to
-compose them on-the-fly, when they are looked up for a given realization,
-since the composition is pretty fast (there are just numpy multiplications),
-faster than reading from the database all the redundant data. The
-impact on hazard maps has to be determined.
+By setting `independent_curves = true` in the [hazard] section of
+openquake.cfg only the independent curves are stored (in the table
+hzrdr.indep_curve_data) and they are composed on-the-fly, when they are
+looked up for a given realization, since the composition is pretty fast
+(there are just numpy multiplications), faster than reading from the
+database all the redundant data.
 """
 import time
 import operator
@@ -210,7 +211,10 @@ def compute_hazard_curves(job_id, sources, sitecol, info):
     trt_model = models.TrtModel.objects.get(pk=trt_model_id)
 
     gsims = trt_model.get_gsim_instances()
-    curves = [[numpy.ones([total_sites, len(ls)]) for ls in sorted_imls]
+    # one contiguous array of probabilities of no exceedence per GSIM,
+    # with the levels of all the IMTs one after the other
+    imt_slices = general.get_imt_slices(hc.imtls).values()
+    curves = [numpy.ones([total_sites, sum(map(len, sorted_imls))])
               for gsim in gsims]
     if getattr(hc, 'poes_disagg', None):  # doing disaggregation
         lt_model_id = trt_model.lt_model.id
@@ -245,11 +249,11 @@ def compute_hazard_curves(job_id, sources, sitecol, info):
 
             # compute probabilities for all realizations
             for gsim, curv in itertools.izip(gsims, curves):
-                for i, pnes in enumerate(_calc_pnes(
+                for slc, pnes in itertools.izip(imt_slices, _calc_pnes(
                         gsim, r_sites, rupture, sorted_imts, sorted_imls,
                         getattr(hc, 'truncation_level', None),
                         make_ctxt_mon, calc_poes_mon)):
-                    curv[i] *= pnes
+                    curv[:, slc] *= pnes
 
         inserter.add(
             models.SourceInfo(trt_model_id=trt_model_id,
@@ -263,12 +267,11 @@ def compute_hazard_curves(job_id, sources, sitecol, info):
     calc_poes_mon.flush()
     inserter.flush()
 
-    # the 0 here is a shortcut for filtered sources giving no contribution;
+    # the 1 here is a shortcut for filtered sources giving no contribution;
     # this is essential for performance, we want to avoid returning
-    # big arrays of zeros (MS)
+    # big arrays of ones (MS)
     curves_by_gsim = [
-        (gsim.__class__.__name__,
-         [0 if general.all_equal(c, 1) else 1. - c for c in curv])
+        (gsim.__class__.__name__, 1 if general.all_equal(curv, 1) else curv)
         for gsim, curv in zip(gsims, curves)]
     return {trt_model_id: (curves_by_gsim, bbs)}
 
@@ -16,33 +16,69 @@
 """
 Core functionality for the classical tilint PSHA hazard calculator.
 """
+import copy
 import math
+import collections
+
 from openquake.baselib.general import split_in_blocks
 from openquake.commonlib import readinput
 from openquake.hazardlib.site import SiteCollection
 
 from openquake.engine.calculators import calculators
-from openquake.engine.calculators.hazard.general import BaseHazardCalculator
+from openquake.engine.calculators.hazard.general import (
+    BaseHazardCalculator, pnes_to_poes)
+from openquake.engine.input.source import (
+    get_composite_source_model, filter_sources)
 from openquake.engine.logs import LOG
+from openquake.engine.utils import config
 
 
 @calculators.add('classical_tiling')
 class ClassicalTilingHazardCalculator(BaseHazardCalculator):
     """
-    Classical tiling PSHA hazard calculator.
+    Classical tiling PSHA hazard calculator. The tiles are pipelined:
+    the tasks of a tile are submitted while the previous tiles are
+    still being reduced and saved; the parameter `tiles_in_flight` in
+    openquake.cfg sets the maximum number of tiles submitted and not
+    completed yet.
     """
 
-    def run_tile(self, i, tile):
+    def submit_tile(self, i, tile):
         """
+        Build a classical calculator for the given tile and submit its
+        tasks. The composite source model is copied from the one
+        parsed in `pre_execute`, since every tile stores its own
+        source models and TrtModels in the database, and only the
+        sources affecting the sites of the tile are kept.
+
         :param i: ordinal number of the tile being processed (from 1)
         :param tile: list of sites being processed
+        :returns: the classical calculator with a .taskman attribute
         """
         classical = calculators['classical'](self.job)
         classical.tilepath = ('tile%d' % i,)
         classical.site_collection = SiteCollection(tile)
-        classical.initialize_sources()
+        composite_model = copy.deepcopy(self.composite_model)
+        if self.prefilter:
+            composite_model = filter_sources(
+                composite_model, classical.site_collection,
+                self.oqparam.maximum_distance)
+        classical.composite_model = composite_model
+        classical.save_source_models()
         classical.init_zeros_ones()
-        classical.execute()
+        classical.taskman = classical.submit_tasks()
+        return classical
+
+    def complete_tile(self, classical):
+        """
+        Reduce the results of the tasks of the given tile, then save
+        the curves and post-process them.
+
+        :param classical: a calculator returned by `submit_tile`
+        """
+        classical.acc = pnes_to_poes(classical.taskman.reduce(
+            classical.agg_curves, classical.acc))
+        del classical.taskman
         classical.post_execute()
         classical.post_process()
 
@@ -51,27 +87,36 @@ class ClassicalTilingHazardCalculator(BaseHazardCalculator):
         Read the full source model and sites and build the needed tiles
         """
         self.oqparam = self.job.get_oqparam()
-        source_model_lt = readinput.get_source_model_lt(self.oqparam)
-        source_models = list(readinput.get_source_models(
-            self.oqparam, source_model_lt))
         self.parse_risk_model()
         self.initialize_site_collection()
+        # the source model is parsed only once and shared by all tiles;
+        # each tile filters it again against its own sites
+        self.composite_model = get_composite_source_model(
+            self.oqparam, self.site_collection, self.prefilter)
         info = readinput.get_job_info(
-            self.oqparam, source_models, self.site_collection)
+            self.oqparam, self.composite_model, self.site_collection)
         self.imtls = self.oqparam.imtls
         weight = info['n_sites'] * info['n_levels'] * info['max_realizations']
         nblocks = math.ceil(weight / self.oqparam.maximum_tile_weight)
         self.tiles = list(split_in_blocks(self.site_collection, nblocks))
         self.num_tiles = len(self.tiles)
+        self.tiles_in_flight = max(
+            int(config.get('hazard', 'tiles_in_flight') or 2), 1)
 
     def execute(self):
         """
-        Executing all tiles sequentially
+        Executing all tiles, keeping at most `.tiles_in_flight`
+        tiles submitted and not completed
         """
+        pending = collections.deque()
         for i, tile in enumerate(self.tiles, 1):
-            LOG.progress('Running tile %d of %d, %s sites',
+            LOG.progress('Submitting tile %d of %d, %s sites',
                          i, self.num_tiles, len(tile))
-            self.run_tile(i, tile)
+            pending.append(self.submit_tile(i, tile))
+            if len(pending) >= self.tiles_in_flight:
+                self.complete_tile(pending.popleft())
+        while pending:
+            self.complete_tile(pending.popleft())
 
     def post_execute(self):
         """Do nothing"""
@@ -22,12 +22,14 @@ import sys
 from operator import attrgetter
 from collections import namedtuple
 import numpy
+import scipy.stats
 
+from openquake.hazardlib import const
 from openquake.hazardlib.calc import disagg
 from openquake.hazardlib.imt import from_string
 from openquake.hazardlib.site import SiteCollection
 
-from openquake.baselib.general import groupby
+from openquake.baselib.general import groupby, split_in_blocks
 from openquake.commonlib.calculators.calc import gen_ruptures_for_site
 
 from openquake.engine import logs
@@ -40,13 +42,54 @@ from openquake.engine.calculators.hazard.classical.core import \
 
 
 # a 6-uple containing float 4 arrays mags, dists, lons, lats,
-# 1 int array trts and a list of dictionaries pnes
+# 1 int array trts and a float array pnes of shape (U, R, P, M, E), i.e.
+# the probabilities of no exceedence for each rupture, realization,
+# disaggregation PoE, IMT and epsilon bin
 BinData = namedtuple('BinData', 'mags, dists, lons, lats, trts, pnes')
 
 
-def _collect_bins_data(mon, trt_num, source_ruptures, site, curves,
-                       trt_model_id, gsims, imtls, poes, truncation_level,
-                       n_epsilons):
+def _get_target_imls(curves, rlz_ids, imtls, poes):
+    """
+    :param curves: a dictionary (rlz_id, imt_str) -> array of PoEs
+    :param rlz_ids: a list of R realization IDs
+    :param imtls: a dictionary with M IMTs
+    :param poes: a list of P disaggregation PoEs
+    :returns: an array of shape (R, M, P) with the IMLs interpolated
+              from the hazard curves for each realization, IMT and PoE
+    """
+    target_imls = numpy.zeros((len(rlz_ids), len(imtls), len(poes)))
+    for r, rlz_id in enumerate(rlz_ids):
+        for m, (imt_str, imls) in enumerate(imtls.iteritems()):
+            curve_poes = curves[rlz_id, imt_str][::-1]
+            target_imls[r, m] = numpy.interp(poes, curve_poes, imls[::-1])
+    return target_imls
+
+
+def _disaggregate_poes(gsim, sctx, rctx, dctx, imt, imls, distribution,
+                       epsilons):
+    """
+    Compute the probabilities of exceeding the given IMLs for a single
+    site, split in epsilon bins, i.e. ``P(IMT >= iml | rup, epsilon_bin)``.
+    This is the same as `gsim.disaggregate_poe`, but the mean and the
+    standard deviation are computed only once for all the IMLs.
+
+    :param imls: an array of K intensity measure levels
+    :param distribution: the truncated normal distribution of the epsilons
+    :param epsilons: the E + 1 edges of the epsilon bins
+    :returns: an array of shape (K, E)
+    """
+    mean, [stddev] = gsim.get_mean_and_stddevs(
+        sctx, rctx, dctx, imt, [const.StdDev.TOTAL])
+    standard_imls = (gsim.to_distribution_values(imls) - mean[0]) / stddev[0]
+    # the bins below the level do not contribute, the bin containing
+    # the level contributes partially and the bins above fully
+    lower = numpy.maximum(epsilons[:-1], standard_imls[:, None])
+    return numpy.maximum(
+        distribution.cdf(epsilons[1:]) - distribution.cdf(lower), 0)
+
+
+def _collect_bins_data(mon, trt_num, source_ruptures, site, target_imls,
+                       rlz_idx, gsims, imts, truncation_level, n_epsilons):
     # returns a BinData instance
     sitecol = SiteCollection([site])
     mags = []
@@ -59,8 +102,11 @@ def _collect_bins_data(mon, trt_num, source_ruptures, site, curves,
     calc_dist = mon.copy('calc distances')
     make_ctxt = mon.copy('making contexts')
     disagg_poe = mon.copy('disaggregate_poe')
-    trt_model = models.TrtModel.objects.get(pk=trt_model_id)
-    rlzs = trt_model.get_rlzs_by_gsim()
+    num_rlzs, num_imts, num_poes = target_imls.shape
+    distribution = scipy.stats.truncnorm(-truncation_level, truncation_level)
+    epsilons = numpy.linspace(-truncation_level, truncation_level,
+                              n_epsilons + 1)
+    imts = map(from_string, imts)
     for source, ruptures in source_ruptures:
         try:
             tect_reg = trt_num[source.tectonic_region_type]
@@ -77,32 +123,26 @@ def _collect_bins_data(mon, trt_num, source_ruptures, site, curves,
                 lats.append(closest_point.latitude)
                 trts.append(tect_reg)
 
-                pne_dict = {}
-                # a dictionary rlz.id, poe, imt_str -> prob_no_exceed
+                # probabilities of no exceedence for the rupture,
+                # by realization, poe, imt and epsilon bin
+                pne = numpy.ones((num_rlzs, num_poes, num_imts, n_epsilons))
                 for gsim in gsims:
+                    idx = rlz_idx.get(gsim.__class__.__name__)
+                    if not idx:
+                        continue
                     with make_ctxt:
                         sctx, rctx, dctx = gsim.make_contexts(sitecol, rupture)
-                    for imt_str, imls in imtls.iteritems():
-                        imt = from_string(imt_str)
-                        imls = numpy.array(imls[::-1])
-                        for rlz in rlzs[gsim.__class__.__name__]:
-                            curve_poes = curves[rlz.id, imt_str].poes[::-1]
-                            for poe in poes:
-                                iml = numpy.interp(poe, curve_poes, imls)
-                                # compute probability of exceeding iml given
-                                # the current rupture and epsilon_bin, that is
-                                # ``P(IMT >= iml | rup, epsilon_bin)``
-                                # for each of the epsilon bins
-                                with disagg_poe:
-                                    [poes_given_rup_eps] = \
-                                        gsim.disaggregate_poe(
-                                            sctx, rctx, dctx, imt, iml,
-                                            truncation_level, n_epsilons)
-                                pne = rupture.get_probability_no_exceedance(
-                                    poes_given_rup_eps)
-                                pne_dict[rlz.id, poe, imt_str] = (iml, pne)
-
-                pnes.append(pne_dict)
+                    for m, imt in enumerate(imts):
+                        # all the IMLs of the realizations of the gsim
+                        # for all the disaggregation poes in a single call
+                        with disagg_poe:
+                            poes = _disaggregate_poes(
+                                gsim, sctx, rctx, dctx, imt,
+                                target_imls[idx, m].flatten(),
+                                distribution, epsilons)
+                        pne[idx, :, m] = rupture.get_probability_no_exceedance(
+                            poes).reshape(len(idx), num_poes, n_epsilons)
+                pnes.append(pne)
         except Exception as err:
             etype, err, tb = sys.exc_info()
             msg = 'An error occurred with source id=%s. Error: %s'
@@ -118,7 +158,7 @@ def _collect_bins_data(mon, trt_num, source_ruptures, site, curves,
                    numpy.array(lons, float),
                    numpy.array(lats, float),
                    numpy.array(trts, int),
-                   pnes)
+                   numpy.array(pnes, float))
 
 
 _DISAGG_RES_NAME_FMT = 'disagg(%(poe)s)-rlz-%(rlz)s-%(imt)s-%(wkt)s'
@@ -186,15 +226,15 @@ def save_disagg_result(job_id, site_id, bin_edges, trt_names, matrix,
 
 
 @tasks.oqtask
-def compute_disagg(job_id, sitecol, sources, trt_model_id,
+def compute_disagg(job_id, sites, sources, trt_model_id,
                    trt_num, curves_dict, bin_edges):
     # see https://bugs.launchpad.net/oq-engine/+bug/1279247 for an explanation
     # of the algorithm used
     """
     :param int job_id:
         ID of the currently running :class:`openquake.engine.db.models.OqJob`
-    :param sitecol:
-        a :class:`openquake.hazardlib.site.SiteCollection` instance
+    :param sites:
+        a block of :class:`openquake.hazardlib.site.Site` instances
     :param list sources:
         list of hazardlib source objects
     :param lt_model:
@@ -202,9 +242,11 @@ def compute_disagg(job_id, sitecol, sources, trt_model_id,
     :param dict trt_num:
         a dictionary Tectonic Region Type -> incremental number
     :param curves_dict:
-        a dictionary with the hazard curves for sites, realizations and IMTs
+        a dictionary with the hazard curves for the sites in the block,
+        by realization and IMT
     :param bin_egdes:
-        a dictionary (lt_model_id, site_id) -> edges
+        a dictionary (lt_model_id, site_id) -> edges for the sites in
+        the block
     :returns:
         a dictionary of probability arrays, with composite key
         (site.id, rlz.id, poe, imt, iml, trt_names).
@@ -217,8 +259,18 @@ def compute_disagg(job_id, sitecol, sources, trt_model_id,
     rlzs = trt_model.get_rlzs_by_gsim()
     trt_names = tuple(trt_model.lt_model.get_tectonic_region_types())
     result = {}  # site.id, rlz.id, poe, imt, iml, trt_names -> array
-
-    for site in sitecol:
+    imts = list(hc.imtls)
+    # the realizations of all the gsims and their indices by gsim
+    rlz_ids = []
+    rlz_idx = {}
+    for gsim in gsims:
+        gsim_name = gsim.__class__.__name__
+        rlz_idx[gsim_name] = []
+        for rlz in rlzs.get(gsim_name, []):
+            rlz_idx[gsim_name].append(len(rlz_ids))
+            rlz_ids.append(rlz.id)
+
+    for site in sites:
         # edges as wanted by disagg._arrange_data_in_bins
         try:
             edges = bin_edges[lt_model_id, site.id]
@@ -237,39 +289,36 @@ def compute_disagg(job_id, sitecol, sources, trt_model_id,
 
         with EnginePerformanceMonitor(
                 'collecting bins', job_id, compute_disagg):
+            target_imls = _get_target_imls(
+                curves_dict[site.id], rlz_ids, hc.imtls, hc.poes_disagg)
             bdata = _collect_bins_data(
-                mon, trt_num, source_ruptures, site, curves_dict[site.id],
-                trt_model_id, gsims, hc.imtls,
-                hc.poes_disagg, getattr(hc, 'truncation_level', None),
+                mon, trt_num, source_ruptures, site, target_imls, rlz_idx,
+                gsims, imts, getattr(hc, 'truncation_level', None),
                 hc.num_epsilon_bins)
 
-        if not bdata.pnes:  # no contributions for this site
+        if not len(bdata.pnes):  # no contributions for this site
             continue
 
-        for poe in hc.poes_disagg:
-            for imt in hc.imtls:
-                for gsim in gsims:
-                    for rlz in rlzs[gsim.__class__.__name__]:
-                        # extract the probabilities of non-exceedance for the
-                        # given realization, disaggregation PoE, and IMT
-                        iml_pne_pairs = [pne[rlz.id, poe, imt]
-                                         for pne in bdata.pnes]
-                        iml = iml_pne_pairs[0][0]
-                        probs = numpy.array(
-                            [p for (i, p) in iml_pne_pairs], float)
-                        # bins in a format handy for hazardlib
-                        bins = [bdata.mags, bdata.dists,
-                                bdata.lons, bdata.lats,
-                                bdata.trts, None, probs]
-
-                        # call disagg._arrange_data_in_bins
-                        with EnginePerformanceMonitor(
-                                'arranging bins', job_id, compute_disagg):
-                            key = (site.id, rlz.id, poe, imt, iml, trt_names)
-                            matrix = disagg._arrange_data_in_bins(
-                                bins, edges + (trt_names,))
-                            result[key] = numpy.array(
-                                [fn(matrix) for fn in disagg.pmf_map.values()])
+        for p, poe in enumerate(hc.poes_disagg):
+            for m, imt in enumerate(imts):
+                for r, rlz_id in enumerate(rlz_ids):
+                    # extract the probabilities of non-exceedance for the
+                    # given realization, disaggregation PoE, and IMT
+                    iml = target_imls[r, m, p]
+                    probs = bdata.pnes[:, r, p, m]
+                    # bins in a format handy for hazardlib
+                    bins = [bdata.mags, bdata.dists,
+                            bdata.lons, bdata.lats,
+                            bdata.trts, None, probs]
+
+                    # call disagg._arrange_data_in_bins
+                    with EnginePerformanceMonitor(
+                            'arranging bins', job_id, compute_disagg):
+                        key = (site.id, rlz_id, poe, imt, iml, trt_names)
+                        matrix = disagg._arrange_data_in_bins(
+                            bins, edges + (trt_names,))
+                        result[key] = numpy.array(
+                            [fn(matrix) for fn in disagg.pmf_map.values()])
 
     return result
 
@@ -283,51 +332,63 @@ class DisaggHazardCalculator(ClassicalHazardCalculator):
     See :func:`openquake.hazardlib.calc.disagg.disaggregation` for more
     details about the nature of this type of calculation.
     """
-    def get_curves(self, site):
+    def get_curves(self):
         """
-        Get all the relevant hazard curves for the given site.
-        Returns a dictionary {(rlz_id, imt) -> curve}.
+        Get all the relevant hazard curves with a single query.
+        Returns a dictionary {site_id -> {(rlz_id, imt) -> poes}}.
         """
-        dic = {}
-        wkt = site.location.wkt2d
-        for rlz in self._realizations:
-            for imt_str in self.oqparam.imtls:
-                imt = from_string(imt_str)
-                [curve] = models.HazardCurveData.objects.filter(
-                    location=wkt,
-                    hazard_curve__lt_realization=rlz,
-                    hazard_curve__imt=imt[0],
-                    hazard_curve__sa_period=imt[1],
-                    hazard_curve__sa_damping=imt[2])
-                if all(x == 0.0 for x in curve.poes):
-                    logs.LOG.warn(
-                        '* hazard curve %d contains all zero '
-                        'probabilities; skipping SRID=4326;%s, rlz=%d, IMT=%s',
-                        curve.id, wkt, rlz.id, imt_str)
-                    continue
-                dic[rlz.id, imt_str] = curve
+        imt_strs = dict((tuple(from_string(imt_str)), imt_str)
+                        for imt_str in self.oqparam.imtls)
+        site_ids = [site.id for site in self.site_collection]
+        dic = dict((site_id, {}) for site_id in site_ids)
+        if not self._realizations:
+            return dic
+        # the curves are associated to the sites with a join on the
+        # location, as in the HazardCurveGetter, so no rounding is needed
+        cursor = models.getcursor('job_init')
+        cursor.execute("""\
+        SELECT hcd.id, hs.id, hcd.poes, hc.lt_realization_id,
+               hc.imt, hc.sa_period, hc.sa_damping
+        FROM hzrdr.hazard_curve_data AS hcd
+        JOIN hzrdr.hazard_curve AS hc ON hc.id = hcd.hazard_curve_id
+        JOIN hzrdi.hazard_site AS hs ON hcd.location = hs.location
+        WHERE hc.lt_realization_id IN %s AND hs.id IN %s
+        """, (tuple(rlz.id for rlz in self._realizations), tuple(site_ids)))
+        for curve_id, site_id, poes, rlz_id, imt, period, damping in cursor:
+            imt_str = imt_strs.get((imt, period, damping))
+            if imt_str is None:
+                continue
+            if all(x == 0.0 for x in poes):
+                logs.LOG.warn(
+                    '* hazard curve %d contains all zero '
+                    'probabilities; skipping site %d, rlz=%d, IMT=%s',
+                    curve_id, site_id, rlz_id, imt_str)
+                continue
+            dic[site_id][rlz_id, imt_str] = numpy.array(poes)
         return dic
 
     @EnginePerformanceMonitor.monitor
     def full_disaggregation(self):
         """
         Run the disaggregation phase after hazard curve finalization.
+        The tasks are split by TrtModel and block of sites, and each task
+        receives only the curves and the bin edges of its own sites.
         """
         hc = self.oqparam
         tl = getattr(self.oqparam, 'truncation_level', None)
-        sitecol = self.site_collection
         mag_bin_width = self.oqparam.mag_bin_width
         eps_edges = numpy.linspace(-tl, tl, self.oqparam.num_epsilon_bins + 1)
         logs.LOG.info('%d epsilon bins from %s to %s', len(eps_edges) - 1,
                       min(eps_edges), max(eps_edges))
 
         self.bin_edges = {}
-        curves_dict = dict((site.id, self.get_curves(site))
-                           for site in self.site_collection)
+        curves_dict = self.get_curves()
+        sources_by_trt_model = groupby(
+            self.composite_model.sources, attrgetter('trt_model_id'))
+        num_blocks = max(
+            1, self.concurrent_tasks // max(1, len(sources_by_trt_model)))
         all_args = []
-        for trt_model_id, srcs in groupby(
-                self.composite_model.sources,
-                attrgetter('trt_model_id')).iteritems():
+        for trt_model_id, srcs in sources_by_trt_model.iteritems():
             lt_model = models.TrtModel.objects.get(pk=trt_model_id).lt_model
             trt_num = dict((trt, i) for i, trt in enumerate(
                            lt_model.get_tectonic_region_types()))
@@ -342,6 +403,7 @@ class DisaggHazardCalculator(ClassicalHazardCalculator):
             logs.LOG.info('%d mag bins from %s to %s', len(mag_edges) - 1,
                           min_mag, max_mag)
 
+            sites = []
             for site in self.site_collection:
                 curves = curves_dict[site.id]
                 if not curves:
@@ -365,9 +427,19 @@ class DisaggHazardCalculator(ClassicalHazardCalculator):
 
                 self.bin_edges[lt_model.id, site.id] = (
                     mag_edges, dist_edges, lon_edges, lat_edges, eps_edges)
-
-            all_args.append((self.job.id, sitecol, srcs, trt_model_id,
-                             trt_num, curves_dict, self.bin_edges))
+                sites.append(site)
+
+            if not sites:
+                continue
+            # the sources are the same for all the blocks of sites
+            srcs = tasks.broadcast(self.job.id, srcs)
+            for block in split_in_blocks(sites, num_blocks):
+                all_args.append((
+                    self.job.id, block, srcs, trt_model_id, trt_num,
+                    dict((site.id, curves_dict[site.id]) for site in block),
+                    dict(((lt_model.id, site.id),
+                          self.bin_edges[lt_model.id, site.id])
+                         for site in block)))
 
         res = tasks.starmap(compute_disagg, all_args, logs.LOG.progress)
         self.save_disagg_results(res.reduce(self.agg_result))
@@ -31,11 +31,11 @@ For more information on computing ground motion fields, see
 :mod:`openquake.hazardlib.calc.gmf`.
 """
 
+import math
 import time
 import random
 import operator
 import itertools
-import collections
 
 import numpy.random
 
@@ -46,7 +46,7 @@ from openquake.hazardlib.site import FilteredSiteCollection
 from openquake.commonlib.calculators.event_based import (
     sample_ruptures, build_ses_ruptures)
 
-from openquake.engine import writer
+from openquake.engine import logs, writer
 from openquake.engine.calculators import calculators
 from openquake.engine.calculators.hazard import general
 from openquake.engine.db import models
@@ -96,6 +96,30 @@ def gmvs_to_haz_curve(gmvs, imls, invest_time, duration):
     return poes
 
 
+# number of ProbabilisticRuptures saved together by compute_ruptures
+RUPTURE_BLOCK_SIZE = 1000
+
+
+def save_ruptures(prob_rups, occurrences):
+    """
+    Save the ProbabilisticRuptures and their occurrences as SESRuptures
+    with two COPY FROM, by reserving the IDs of the ruptures in advance.
+
+    :param prob_rups:
+        a list of unsaved ProbabilisticRupture objects
+    :param occurrences:
+        a list of lists of triples (ses_idx, tag, seed), one per rupture
+    """
+    if not prob_rups:
+        return
+    rup_ids = writer.CacheInserter.saveall(prob_rups)
+    writer.CacheInserter.saveall([
+        models.SESRupture(rupture_id=rup_id, ses_id=ses_idx,
+                          tag=tag, seed=seed)
+        for rup_id, occ in itertools.izip(rup_ids, occurrences)
+        for ses_idx, tag, seed in occ])
+
+
 @tasks.oqtask
 def compute_ruptures(job_id, sources, sitecol, info):
     """
@@ -138,6 +162,8 @@ def compute_ruptures(job_id, sources, sitecol, info):
         'filtering ruptures', job_id, compute_ruptures)
     save_ruptures_mon = LightMonitor(
         'saving ruptures', job_id, compute_ruptures)
+    prob_rups = []  # ProbabilisticRuptures to save
+    occurrences = []  # lists of (ses_idx, tag, seed), one per prob_rup
 
     # Compute and save stochastic event sets
     for src in sources:
@@ -158,17 +184,17 @@ def compute_ruptures(job_id, sources, sitecol, info):
                 build_ses_ruptures(
                     src, num_occ_by_rup, s_sites, hc.maximum_distance, sitecol
                 ))
-        # saving ses_ruptures
-        with save_ruptures_mon:
-            for rup, rups in pairs:
-                for col_idx in set(r.col_idx for r in rups):
-                    prob_rup = models.ProbabilisticRupture.create(
-                        rup, ses_coll[col_idx], rups[0].indices)
-                    for r in rups:
-                        if r.col_idx == col_idx:
-                            models.SESRupture.objects.create(
-                                rupture=prob_rup, ses_id=r.ses_idx,
-                                tag=r.tag, seed=r.seed)
+        # collecting ses_ruptures
+        for rup, rups in pairs:
+            for col_idx in set(r.col_idx for r in rups):
+                prob_rups.append(models.ProbabilisticRupture.build(
+                    rup, ses_coll[col_idx], rups[0].indices))
+                occurrences.append([(r.ses_idx, r.tag, r.seed)
+                                    for r in rups if r.col_idx == col_idx])
+        if len(prob_rups) >= RUPTURE_BLOCK_SIZE:
+            with save_ruptures_mon:
+                save_ruptures(prob_rups, occurrences)
+            prob_rups, occurrences = [], []
 
         if num_occ_by_rup:
             num_ruptures = len(num_occ_by_rup)
@@ -190,6 +216,9 @@ def compute_ruptures(job_id, sources, sitecol, info):
                               uniq_ruptures=num_ruptures,
                               calc_time=time.time() - t0))
 
+    with save_ruptures_mon:
+        save_ruptures(prob_rups, occurrences)
+
     filter_sites_mon.flush()
     generate_ruptures_mon.flush()
     filter_ruptures_mon.flush()
@@ -200,12 +229,12 @@ def compute_ruptures(job_id, sources, sitecol, info):
 
 
 @tasks.oqtask
-def compute_gmfs_and_curves(job_id, ses_ruptures, sitecol, rlzs_assoc):
+def compute_gmfs_and_curves(job_id, ses_rupture_ids, sitecol, rlzs_assoc):
     """
     :param int job_id:
         ID of the currently running job
-    :param ses_ruptures:
-        a list of blocks of SESRuptures with homogeneous TrtModel
+    :param ses_rupture_ids:
+        a list of IDs of SESRuptures with homogeneous SESCollection
     :param sitecol:
         a :class:`openquake.hazardlib.site.SiteCollection` instance
     :param rlzs_assoc:
@@ -219,32 +248,45 @@ def compute_gmfs_and_curves(job_id, ses_ruptures, sitecol, rlzs_assoc):
     imts = map(from_string, sorted(hc.imtls))
 
     result = {}  # trt_model_id -> (curves_by_gsim, [])
+    with EnginePerformanceMonitor(
+            'reading ruptures', job_id, compute_gmfs_and_curves):
+        # read the triples (rupture_id, ses_rupture_id, seed) and then
+        # each ProbabilisticRupture only once
+        triples = list(models.SESRupture.objects.filter(
+            pk__in=ses_rupture_ids).order_by('rupture', 'id').values_list(
+            'rupture', 'id', 'seed'))
+        ruptures = models.ProbabilisticRupture.objects.in_bulk(
+            set(rup_id for rup_id, _, _ in triples))
     # NB: by construction each block is a non-empty list with
     # ruptures of homogeneous SESCollection
-    ses_coll = ses_ruptures[0].rupture.ses_collection
+    ses_coll = ruptures[triples[0][0]].ses_collection
     trt_model = ses_coll.trt_model
     gsims = rlzs_assoc.get_gsims_by_trt_id()[trt_model.id]
+    curves_from_gmfs = getattr(hc, 'hazard_curves_from_gmfs', None)
     calc = GmfCalculator(
         sorted(imts), sorted(gsims), ses_coll,
-        getattr(hc, 'truncation_level', None), models.get_correl_model(job))
+        getattr(hc, 'truncation_level', None), models.get_correl_model(job),
+        hc.imtls if curves_from_gmfs else None, sitecol.sids,
+        store_gmfs=bool(hc.ground_motion_fields))
 
     with EnginePerformanceMonitor(
             'computing gmfs', job_id, compute_gmfs_and_curves):
-        for rupture, group in itertools.groupby(
-                ses_ruptures, operator.attrgetter('rupture')):
+        for rup_id, group in itertools.groupby(
+                triples, operator.itemgetter(0)):
+            rupture = ruptures[rup_id]
             r_sites = sitecol if rupture.site_indices is None \
                 else FilteredSiteCollection(rupture.site_indices, sitecol)
             calc.calc_gmfs(
-                r_sites, rupture, [(r.id, r.seed) for r in group])
+                r_sites, rupture, [(sr_id, seed) for _, sr_id, seed in group])
 
-    if getattr(hc, 'hazard_curves_from_gmfs', None):
+    if curves_from_gmfs:
         duration = hc.investigation_time * hc.ses_per_logic_tree_path * (
             hc.number_of_logic_tree_samples or 1)
         with EnginePerformanceMonitor(
                 'hazard curves from gmfs',
                 job_id, compute_gmfs_and_curves):
             result[trt_model.id] = (calc.to_haz_curves(
-                sitecol.sids, hc.imtls, hc.investigation_time, duration), [])
+                hc.investigation_time, duration), [])
     else:
         result[trt_model.id] = ([], [])
 
@@ -259,9 +301,21 @@ def compute_gmfs_and_curves(job_id, ses_ruptures, sitecol, rlzs_assoc):
 class GmfCalculator(object):
     """
     A class to store ruptures and then compute and save ground motion fields.
+    The ground motion values are stored in a growable numpy buffer of
+    records (sid, rupid, gsim, imt, gmv), where `gsim` and `imt` are
+    indices in the lists of sorted GSIMs and IMTs. If the intensity
+    measure levels are given, for each GSIM the number of ground motion
+    values exceeding each level is accumulated in an array of shape (N, L)
+    while the GMFs are computed, so that the hazard curves can be built
+    without storing the ground motion values.
     """
+    gmf_dt = numpy.dtype([('sid', numpy.uint32), ('rupid', numpy.uint32),
+                          ('gsim', numpy.uint16), ('imt', numpy.uint16),
+                          ('gmv', numpy.float64)])
+
     def __init__(self, sorted_imts, sorted_gsims, ses_coll,
-                 truncation_level=None, correl_model=None):
+                 truncation_level=None, correl_model=None,
+                 imtls=None, sids=None, store_gmfs=True):
         """
         :param sorted_imts:
             a sorted list of hazardlib intensity measure types
@@ -273,23 +327,53 @@ class GmfCalculator(object):
             the truncation level, or None
         :param str correl_model:
             the correlation model, or None
+        :param imtls:
+            a dictionary {IMT: intensity measure levels}, or None if the
+            hazard curves are not computed
+        :param sids:
+            the IDs of the N sites of the hazard curves
+        :param store_gmfs:
+            if False, the ground motion values are discarded after
+            updating the exceedance counts
         """
         self.sorted_imts = sorted_imts
         self.sorted_gsims = sorted_gsims
+        self.imt_idx = dict((str(imt), i) for i, imt in enumerate(sorted_imts))
+        self.gsim_idx = dict((gsim.__class__.__name__, i)
+                             for i, gsim in enumerate(sorted_gsims))
         self.col_idx = ses_coll.ordinal
         self.trt_model_id = ses_coll.trt_model.id
         self.truncation_level = truncation_level
         self.correl_model = correl_model
-        # NB: I tried to use a single dictionary
-        # {site_id: [(gmv, rupt_id),...]} but it took a lot more memory (MS)
-        self.gmvs_per_site = collections.defaultdict(list)
-        self.ruptures_per_site = collections.defaultdict(list)
+        self.store_gmfs = store_gmfs
+        self._blocks = []  # arrays of records of type gmf_dt
+        self.imtls = imtls
+        if imtls:
+            self.sids = numpy.asarray(sids)
+            self.sorter = numpy.argsort(self.sids)
+            self.imls = dict((imt, numpy.array(imls))
+                             for imt, imls in imtls.iteritems())
+            self.imt_slices = general.get_imt_slices(imtls)
+            shape = (len(sids), sum(map(len, imtls.values())))
+            self.num_exceeding = [numpy.zeros(shape, numpy.uint32)
+                                  for gsim in sorted_gsims]
+
+    @property
+    def gmf_data(self):
+        """
+        An array of records of type `gmf_dt` with all the ground motion
+        values computed so far, in order of computation.
+        """
+        if len(self._blocks) != 1:
+            self._blocks = [numpy.concatenate(self._blocks) if self._blocks
+                            else numpy.zeros(0, self.gmf_dt)]
+        return self._blocks[0]
 
     def calc_gmfs(self, r_sites, rupture, rupid_seed_pairs):
         """
         Compute the GMF generated by the given rupture on the given
-        sites and collect the values in the dictionaries
-        .gmvs_per_site and .ruptures_per_site.
+        sites, update the exceedance counts (if there are IMTLs) and
+        collect the values in the buffer .gmf_data (if store_gmfs is set).
 
         :param r_sites:
             a SiteCollection instance with the sites affected by the rupture
@@ -301,14 +385,34 @@ class GmfCalculator(object):
         computer = gmf.GmfComputer(
             rupture, r_sites, self.sorted_imts, self.sorted_gsims,
             self.truncation_level, self.correl_model)
+        sids = r_sites.sids
+        n = len(sids)
+        if self.imtls:  # the rows of the affected sites
+            rows = self.sorter[numpy.searchsorted(
+                self.sids, sids, sorter=self.sorter)]
+        if self.store_gmfs:
+            data = numpy.zeros(
+                len(rupid_seed_pairs) * len(self.sorted_gsims) *
+                len(self.sorted_imts) * n, self.gmf_dt)
+        start = 0
         for rupid, seed in rupid_seed_pairs:
             for gsim_name, gmf_by_imt in computer.compute(seed):
+                gsim_idx = self.gsim_idx[gsim_name]
                 for imt_str, gmvs in gmf_by_imt.iteritems():
-                    for site_id, gmv in zip(r_sites.sids, gmvs):
-                        self.gmvs_per_site[
-                            gsim_name, imt_str, site_id].append(gmv)
-                        self.ruptures_per_site[
-                            gsim_name, imt_str, site_id].append(rupid)
+                    if self.imtls and imt_str in self.imls:
+                        self.num_exceeding[gsim_idx][
+                            rows, self.imt_slices[imt_str]] += (
+                            gmvs[:, None] >= self.imls[imt_str])
+                    if self.store_gmfs:
+                        block = data[start:start + n]
+                        block['sid'] = sids
+                        block['rupid'] = rupid
+                        block['gsim'] = gsim_idx
+                        block['imt'] = self.imt_idx[imt_str]
+                        block['gmv'] = gmvs
+                        start += n
+        if self.store_gmfs:
+            self._blocks.append(data[:start])
 
     def save_gmfs(self, rlzs_assoc):
         """
@@ -318,55 +422,65 @@ class GmfCalculator(object):
             a :class:`openquake.commonlib.source.RlzsAssoc` instance
         """
         samples = rlzs_assoc.csm_info.get_num_samples(self.trt_model_id)
-        for gsim_name, imt_str, site_id in self.gmvs_per_site:
-            rlzs = rlzs_assoc[self.trt_model_id, gsim_name]
+        rlzs_by_gsim = []
+        for gsim in self.sorted_gsims:
+            rlzs = rlzs_assoc[self.trt_model_id, gsim.__class__.__name__]
             if samples > 1:
                 # save only the data for the realization corresponding
                 # to the current SESCollection
                 rlzs = [rlz for rlz in rlzs if self.col_idx in rlz.col_ids]
-            for rlz in rlzs:
-                imt_name, sa_period, sa_damping = from_string(imt_str)
+            rlzs_by_gsim.append(rlzs)
+        # read the Gmf IDs with a single query
+        gmf_id = dict(models.Gmf.objects.filter(
+            lt_realization__in=[rlz.id for rlzs in rlzs_by_gsim
+                                for rlz in rlzs]
+        ).values_list('lt_realization', 'id'))
+
+        # group by (gsim, imt, sid); the sort is stable, so the rupture
+        # ids in each group are in the order of computation
+        data = self.gmf_data
+        data = data[numpy.lexsort((data['sid'], data['imt'], data['gsim']))]
+        change = ((numpy.diff(data['gsim']) != 0) |
+                  (numpy.diff(data['imt']) != 0) |
+                  (numpy.diff(data['sid']) != 0))
+        bounds = numpy.concatenate(
+            [[0], numpy.nonzero(change)[0] + 1, [len(data)]])
+        for start, stop in itertools.izip(bounds[:-1], bounds[1:]):
+            if start == stop:  # no data
+                continue
+            rec = data[start]
+            imt_name, sa_period, sa_damping = self.sorted_imts[rec['imt']]
+            gmvs = data['gmv'][start:stop].tolist()
+            rupture_ids = data['rupid'][start:stop].tolist()
+            for rlz in rlzs_by_gsim[rec['gsim']]:
                 inserter.add(models.GmfData(
-                    gmf=models.Gmf.objects.get(lt_realization=rlz.id),
+                    gmf_id=gmf_id[rlz.id],
                     task_no=0,
                     imt=imt_name,
                     sa_period=sa_period,
                     sa_damping=sa_damping,
-                    site_id=site_id,
-                    gmvs=self.gmvs_per_site[gsim_name, imt_str, site_id],
-                    rupture_ids=self.ruptures_per_site[
-                        gsim_name, imt_str, site_id]
-                ))
+                    site_id=int(rec['sid']),
+                    gmvs=gmvs,
+                    rupture_ids=rupture_ids))
         inserter.flush()
-        self.gmvs_per_site.clear()
-        self.ruptures_per_site.clear()
+        self._blocks = []
 
-    def to_haz_curves(self, sids, imtls, invest_time, duration):
+    def to_haz_curves(self, invest_time, duration):
         """
-        Convert the gmf into hazard curves (by gsim and imt)
+        Convert the exceedance counts into hazard curves (by gsim).
+        For each gsim returns an array of shape (N, L) with the
+        probabilities of no exceedence for the N sites and the L levels
+        of all the IMTs.
 
-        :param sids: database ids of the given sites
-        :param imtls: dictionary {IMT: intensity measure levels}
         :param invest_time: investigation time
         :param duration: effective duration (investigation time multiplied
                          by number of SES and number of samples)
         """
-        gmf = collections.defaultdict(dict)  # (gsim, imt) > {site_id: poes}
-        sorted_imts = map(str, self.sorted_imts)
-        zeros = {imt: numpy.zeros(len(imtls[imt])) for imt in sorted_imts}
-        for (gsim, imt, site_id), gmvs in self.gmvs_per_site.iteritems():
-            gmf[gsim, imt][site_id] = gmvs_to_haz_curve(
-                gmvs, imtls[imt], invest_time, duration)
-        curves_by_gsim = []
-        for gsim_obj in self.sorted_gsims:
-            gsim = gsim_obj.__class__.__name__
-            curves_by_imt = []
-            for imt in sorted_imts:
-                curves_by_imt.append(
-                    numpy.array([gmf[gsim, imt].get(site_id, zeros[imt])
-                                 for site_id in sids]))
-            curves_by_gsim.append((gsim, curves_by_imt))
-        return curves_by_gsim
+        # NB: the approach used here will not work for non-poissonian models
+        return [(gsim.__class__.__name__,
+                 numpy.exp(- (invest_time / duration) * num_exceeding))
+                for gsim, num_exceeding in zip(
+                    self.sorted_gsims, self.num_exceeding)]
 
 
 @calculators.add('event_based')
@@ -453,30 +567,46 @@ class EventBasedHazardCalculator(general.BaseHazardCalculator):
         # now save the curves, if any
         self.save_hazard_curves()
 
+    def gen_ses_rupture_ids(self):
+        """
+        Yield lists of SESRupture IDs, homogeneous by SESCollection and
+        ordered by rupture, with around num_ses_ruptures / concurrent_tasks
+        IDs each. The IDs are read lazily, one SESCollection at the time,
+        so that the SESRupture objects are never instantiated in the
+        controller; each task reads its own ruptures.
+        """
+        ses_colls = models.SESCollection.objects.filter(
+            trt_model__lt_model__hazard_calculation=self.job
+        ).order_by('ordinal')
+        num_ses_ruptures = models.SESRupture.objects.filter(
+            rupture__ses_collection__in=ses_colls).count()
+        block_size = int(math.ceil(
+            float(num_ses_ruptures) / (self.concurrent_tasks or 1)))
+        for ses_coll in ses_colls:
+            ids = models.SESRupture.objects.filter(
+                rupture__ses_collection=ses_coll).order_by(
+                'rupture', 'id').values_list('id', flat=True).iterator()
+            while True:
+                block = list(itertools.islice(ids, block_size))
+                if not block:
+                    break
+                yield block
+
     @EnginePerformanceMonitor.monitor
     def generate_gmfs_and_curves(self):
         """
         Generate the GMFs and optionally the hazard curves too
         """
-        sitecol = self.site_collection
-        sesruptures = []  # collect the ruptures in a fixed order
-        with self.monitor('reading ruptures'):
-            for ses_coll in models.SESCollection.objects.filter(
-                    trt_model__lt_model__hazard_calculation=self.job):
-                for sr in models.SESRupture.objects.filter(
-                        rupture__ses_collection=ses_coll):
-                    # adding the annotation below saves a LOT of memory
-                    # otherwise one would need as key in apply_reduce
-                    # lambda sr: sr.rupture.ses_collection.ordinal which would
-                    # read the world from the database
-                    sr.col_idx = ses_coll.ordinal
-                    sesruptures.append(sr)
+        sitecol = tasks.broadcast(self.job.id, self.site_collection)
+        rlzs_assoc = tasks.broadcast(self.job.id, self.rlzs_assoc)
         base_agg = super(EventBasedHazardCalculator, self).agg_curves
-        if hasattr(self, 'zeros'):  # there are IMTLs
-            zeros = {key: self.zeros for key in self.rlzs_assoc}
+        if hasattr(self, 'ones'):  # there are IMTLs
+            # the accumulator is updated in-place, so a copy is needed
+            ones = {key: self.ones.copy() for key in self.rlzs_assoc}
         else:
-            zeros = {}
-        return tasks.apply_reduce(
+            ones = {}
+        return general.pnes_to_poes(tasks.starmap(
             compute_gmfs_and_curves,
-            (self.job.id, sesruptures, sitecol, self.rlzs_assoc),
-            base_agg, zeros, key=lambda sr: sr.col_idx)
+            ((self.job.id, ids, sitecol, rlzs_assoc)
+             for ids in self.gen_ses_rupture_ids()),
+            logs.LOG.progress).reduce(base_agg, ones))
@@ -18,7 +18,6 @@
 
 """Common code for the hazard calculators."""
 
-import itertools
 import collections
 from operator import attrgetter
 
@@ -32,21 +31,22 @@ from openquake.hazardlib.imt import from_string
 from openquake.engine.db import models
 
 from openquake.baselib import general
-from openquake.commonlib import readinput, risk_parsers, source
+from openquake.commonlib import readinput, source
 from openquake.commonlib.readinput import (
     get_site_collection, get_site_model)
 
 from openquake.engine.input import exposure
+from openquake.engine.input.source import get_composite_source_model
 from openquake.engine import logs
-from openquake.engine import writer
+from openquake.engine import writer, datastore
 from openquake.engine.calculators import base
-from openquake.risklib import scientific
 
 from openquake.engine.calculators.hazard.post_processing import (
-    hazard_curves_to_hazard_map, do_uhs_post_proc)
+    compute_hazard_stats, compute_hazard_maps, save_hazard_maps, make_uhs,
+    save_uhs)
 
 from openquake.engine.performance import EnginePerformanceMonitor
-from openquake.engine.utils import tasks
+from openquake.engine.utils import config, tasks
 
 QUANTILE_PARAM_NAME = "QUANTILE_LEVELS"
 POES_PARAM_NAME = "POES"
@@ -76,6 +76,48 @@ def all_equal(obj, value):
         return eq
 
 
+def get_imt_slices(imtls):
+    """
+    :param imtls: a dictionary IMT string -> intensity measure levels
+    :returns:
+        an ordered dictionary IMT string -> slice, sorted by IMT; each slice
+        selects the levels of the IMT in an array containing the levels of
+        all the IMTs
+    """
+    slices = collections.OrderedDict()
+    start = 0
+    for imt in sorted(imtls):
+        stop = start + len(imtls[imt])
+        slices[imt] = slice(start, stop)
+        start = stop
+    return slices
+
+
+def split_by_imt(curves, imt_slices):
+    """
+    :param curves: an array of shape (N, L) where L is the total
+                   number of levels, or the scalar 0
+    :param imt_slices: an ordered dictionary IMT string -> slice
+    :returns: a list of views, one per IMT, with shape (N, L_imt)
+    """
+    if not isinstance(curves, numpy.ndarray):  # no contributions
+        return [curves] * len(imt_slices)
+    return [curves[:, slc] for slc in imt_slices.itervalues()]
+
+
+def pnes_to_poes(acc):
+    """
+    Convert in-place the probabilities of no exceedence in the
+    accumulator into probabilities of exceedence.
+
+    :param acc: a dictionary (trt_model_id, gsim) -> array
+    :returns: the same dictionary
+    """
+    for array in acc.itervalues():
+        numpy.subtract(1., array, out=array)
+    return acc
+
+
 class SiteModelParams(object):
     """
     Wrapper around the SiteModel table with a method .get_closest
@@ -127,15 +169,35 @@ class BaseHazardCalculator(base.Calculator):
         super(BaseHazardCalculator, self).__init__(job)
         # a dictionary trt_model_id -> num_ruptures
         self.num_ruptures = collections.defaultdict(int)
-        # now a dictionary (trt_model_id, gsim) -> poes
+        # a dictionary (trt_model_id, gsim) -> array of shape (N, L) with
+        # the probabilities of no exceedence while the tasks are running
+        # and the probabilities of exceedence at the end
         self.acc = general.AccumDict()
         self.mean_hazard_curves = getattr(
             self.oqparam, 'mean_hazard_curves', None)
         self.quantile_hazard_curves = getattr(
             self.oqparam, 'quantile_hazard_curves', ())
         self._hazard_curves = []
+        # the hazard maps are computed from the curves in memory; they
+        # are kept for the UHS, grouped by (statistics, quantile, rlz, poe)
+        self.poes = getattr(self.oqparam, 'poes', None) or []
+        self.uhs = getattr(self.oqparam, 'uniform_hazard_spectra', None)
+        self.map_poes = self.poes if (
+            getattr(self.oqparam, 'hazard_maps', None) or self.uhs) else []
+        self._hazard_maps = collections.defaultdict(list)
         self._realizations = []
         self._source_models = []
+        # if set, store only the curves by TrtModel and GSIM and compose
+        # the curves by realization on demand; the disaggregation
+        # calculator needs the stored curves, so it is not affected
+        self.independent_curves = config.flag_set(
+            'hazard', 'independent_curves') and not getattr(
+            self.oqparam, 'poes_disagg', None)
+        # if a backend is set in openquake.cfg, the curves by realization
+        # are saved in the datastore and not in hzrdr.hazard_curve_data;
+        # the disaggregation calculator reads the curves from the database
+        self.datastore = None if getattr(
+            self.oqparam, 'poes_disagg', None) else datastore.create(self.job)
 
     @EnginePerformanceMonitor.monitor
     def execute(self):
@@ -144,10 +206,22 @@ class BaseHazardCalculator(base.Calculator):
         distribution, but it can be overridden in subclasses.
         """
         csm = self.composite_model
-        self.acc = tasks.apply_reduce(
+        self.acc = pnes_to_poes(tasks.apply_reduce(
             self.core_calc_task,
             (self.job.id, list(csm.sources), self.site_collection, csm.info),
             agg=self.agg_curves, acc=self.acc,
+            weight=attrgetter('weight'), key=attrgetter('trt_model_id')))
+
+    def submit_tasks(self):
+        """
+        Submit the `.core_calc_task` without waiting for the results;
+        they can be reduced later with the method .reduce(agg, acc)
+        of the returned task manager.
+        """
+        csm = self.composite_model
+        return tasks.submit_blocks(
+            self.core_calc_task,
+            (self.job.id, list(csm.sources), self.site_collection, csm.info),
             weight=attrgetter('weight'), key=attrgetter('trt_model_id'))
 
     @EnginePerformanceMonitor.monitor
@@ -159,24 +233,23 @@ class BaseHazardCalculator(base.Calculator):
         calculation model.)
 
         :param acc:
-            A dictionary of curves
+            A dictionary `(trt_model_id, gsim) -> pnes`, where `pnes` is
+            an array of shape (N, L) with the probabilities of no exceedence
+            for all the N sites and all the L levels, sorted by IMT
         :param result:
             A dictionary `{trt_model_id: (curves_by_gsim, bbs)}`.
-            `curves_by_gsim` is a list of pairs `(gsim, curves_by_imt)`
-            where `curves_by_imt` is a list of 2-D numpy arrays
+            `curves_by_gsim` is a list of pairs `(gsim, pnes)` where
+            `pnes` is an array of the same shape as `acc[tr_model_id, gsim]`
             representing the new results which need to be combined
-            with the current value. These should be the same shape as
-            `acc[tr_model_id, gsim][j]` where `gsim` is the GSIM
-            name and `j` is the IMT ordinal.
+            with the current value, or the scalar 1 if there
+            are no contributions.
         """
         for trt_model_id, (curves_by_gsim, bbs) in result.iteritems():
-            for gsim, probs in curves_by_gsim:
-                pnes = []
-                for prob, zero in itertools.izip(probs, self.zeros):
-                    pnes.append(1 - (zero if all_equal(prob, 0) else prob))
-                pnes1 = numpy.array(pnes)
-                pnes2 = 1 - acc.get((trt_model_id, gsim), self.zeros)
-                acc[trt_model_id, gsim] = 1 - pnes1 * pnes2
+            for gsim, pnes in curves_by_gsim:
+                array = acc.get((trt_model_id, gsim))
+                if array is None:
+                    array = acc[trt_model_id, gsim] = self.ones.copy()
+                array *= pnes
 
             if getattr(self.oqparam, 'poes_disagg', None):
                 for bb in bbs:
@@ -209,12 +282,10 @@ class BaseHazardCalculator(base.Calculator):
         imtls = self.oqparam.imtls
         if None in imtls.values():  # no levels, cannot compute curves
             return
-        n_sites = len(self.site_collection)
-        self.zeros = numpy.array(
-            [numpy.zeros((n_sites, len(imtls[imt])))
-             for imt in sorted(imtls)])
-        self.ones = [numpy.zeros(len(imtls[imt]), dtype=float)
-                     for imt in sorted(imtls)]
+        self.imt_slices = get_imt_slices(imtls)
+        shape = (len(self.site_collection), sum(map(len, imtls.values())))
+        self.zeros = numpy.zeros(shape)  # poes
+        self.ones = numpy.ones(shape)  # pnes
 
     def check_limits(self, input_weight, output_weight):
         """
@@ -251,8 +322,16 @@ class BaseHazardCalculator(base.Calculator):
         trees. Save in the database LtSourceModel and TrtModel objects.
         """
         logs.LOG.progress("initializing sources")
-        self.composite_model = readinput.get_composite_source_model(
+        self.composite_model = get_composite_source_model(
             self.oqparam, self.site_collection, self.prefilter)
+        self.save_source_models()
+
+    def save_source_models(self):
+        """
+        Save in the database LtSourceModel and TrtModel objects for
+        the current composite source model and store the database IDs
+        in the in-memory TrtModels.
+        """
         for sm in self.composite_model:
             # create an LtSourceModel for each distinct source model
             lt_model = models.LtSourceModel.objects.create(
@@ -289,10 +368,7 @@ class BaseHazardCalculator(base.Calculator):
         oqparam = self.job.get_oqparam()
         if 'exposure' in oqparam.inputs:
             with logs.tracing('storing exposure'):
-                exposure.ExposureDBWriter(
-                    self.job).serialize(
-                    risk_parsers.ExposureModelParser(
-                        oqparam.inputs['exposure']))
+                exposure.import_exposure(self.job, oqparam.inputs['exposure'])
         models.Imt.save_new(map(from_string, oqparam.imtls))
 
     @EnginePerformanceMonitor.monitor
@@ -368,10 +444,15 @@ class BaseHazardCalculator(base.Calculator):
         imtls = self.oqparam.imtls
         points = models.HazardSite.objects.filter(
             hazard_calculation=self.job).order_by('id')
+        lons = [p.location.x for p in points]
+        lats = [p.location.y for p in points]
         sorted_imts = sorted(imtls)
         curves_by_imt = dict((imt, []) for imt in sorted_imts)
         individual_curves = self.job.get_param(
             'individual_curves', missing=True)
+        lazy = individual_curves and self.independent_curves
+        if lazy:
+            self.save_indep_curves(points)
         for rlz in self._realizations:
             if individual_curves:
                 # create a multi-imt curve
@@ -382,19 +463,66 @@ class BaseHazardCalculator(base.Calculator):
                     output=multicurve, lt_realization=rlz,
                     investigation_time=self.oqparam.investigation_time)
 
+            if lazy and not (self.mean_hazard_curves or
+                             self.quantile_hazard_curves or
+                             self.map_poes):
+                # the curves by realization are not needed: save only
+                # the containers, the data will be composed on demand
+                for imt in sorted_imts:
+                    self.save_curves_for_rlz_imt(
+                        rlz, imt, imtls[imt], points, None)
+                continue
+
             with self.monitor('building curves per realization'):
-                imt_curves = zip(
-                    sorted_imts, models.build_curves(rlz, self.acc))
+                imt_curves = zip(sorted_imts, split_by_imt(
+                    models.build_curves(rlz, self.acc), self.imt_slices))
             for imt, curves in imt_curves:
                 if individual_curves:
-                    self.save_curves_for_rlz_imt(
-                        rlz, imt, imtls[imt], points, curves)
+                    haz_curve = self.save_curves_for_rlz_imt(
+                        rlz, imt, imtls[imt], points,
+                        None if lazy else curves)
+                    if self.map_poes:
+                        with self.monitor('generating hazard maps'):
+                            self.save_hazard_maps(
+                                haz_curve, lons, lats,
+                                compute_hazard_maps(
+                                    curves, imtls[imt], self.poes))
                 curves_by_imt[imt].append(curves)
 
         self.acc = {}  # save memory for the post-processing phase
         if self.mean_hazard_curves or self.quantile_hazard_curves:
             self.curves_by_imt = curves_by_imt
 
+    @EnginePerformanceMonitor.monitor
+    def save_indep_curves(self, points):
+        """
+        Save the curves by TrtModel and GSIM in the table
+        `hzrdr.indep_curve_data`, i.e. the only curves which are really
+        independent: the curves by realization are composed from them
+        on demand, see :meth:`openquake.engine.db.models.HazardCurve.
+        build_data`.
+
+        :param points: the HazardSites associated to the curves
+        """
+        if not self.job.get_param('independent_curves', False):
+            # the tiling calculator calls this method once per tile
+            self.job.save_params(dict(independent_curves=True))
+        inserter = writer.CacheInserter(
+            models.IndepCurveData, max_cache_size=10000)
+        sorted_imts = sorted(self.oqparam.imtls)
+        for (trt_model_id, gsim), array in self.acc.iteritems():
+            for imt, curves in zip(
+                    sorted_imts, split_by_imt(array, self.imt_slices)):
+                imt_type, sa_period, sa_damping = from_string(imt)
+                for p, poes in zip(points, curves):
+                    if not poes.any():  # zero curves are not stored
+                        continue
+                    inserter.add(models.IndepCurveData(
+                        trt_model_id=trt_model_id, gsim=gsim, imt=imt_type,
+                        sa_period=sa_period, sa_damping=sa_damping,
+                        poes=list(poes), site_id=p.id))
+        inserter.flush()
+
     def save_curves_for_rlz_imt(self, rlz, imt, imls, points, curves):
         """
         Save the curves corresponding to a given realization and IMT.
@@ -403,7 +531,8 @@ class BaseHazardCalculator(base.Calculator):
         :param imt: an IMT string
         :param imls: the intensity measure levels for the given IMT
         :param points: the points associated to the curves
-        :param curves: the curves
+        :param curves: the curves, or None if they must not be stored
+        :returns: the saved HazardCurve
         """
         # create a new `HazardCurve` 'container' record for each
         # realization for each intensity measure type
@@ -427,6 +556,15 @@ class BaseHazardCalculator(base.Calculator):
             sa_damping=sa_damping,
         )
         self._hazard_curves.append(haz_curve)
+        if curves is None:  # lazy curve
+            return haz_curve
+        elif self.datastore is not None:
+            logs.LOG.info('saving %d hazard curves for %s, imt=%s in %s',
+                          len(points), hco, imt, self.datastore)
+            self.datastore['hcurves/%d/sids' % haz_curve.id] = [
+                p.id for p in points]
+            self.datastore['hcurves/%d/poes' % haz_curve.id] = curves
+            return haz_curve
 
         # save hazard_curve_data
         logs.LOG.info('saving %d hazard curves for %s, imt=%s',
@@ -437,6 +575,25 @@ class BaseHazardCalculator(base.Calculator):
             location=p.location,
             weight=rlz.weight)
             for p, poes in zip(points, curves)])
+        return haz_curve
+
+    def save_hazard_maps(self, haz_curve, lons, lats, hazard_maps):
+        """
+        Save the hazard maps obtained from the curves of the given
+        HazardCurve and keep them in memory if the UHS are required.
+
+        :param haz_curve: a HazardCurve instance
+        :param lons: the longitudes of the sites
+        :param lats: the latitudes of the sites
+        :param hazard_maps: an array of shape (P, N)
+        """
+        saved = save_hazard_maps(
+            self.job, haz_curve, lons, lats, hazard_maps, self.poes)
+        if self.uhs:
+            for hmap in saved:
+                self._hazard_maps[hmap.statistics, hmap.quantile,
+                                  haz_curve.lt_realization, hmap.poe
+                                  ].append(hmap)
 
     @EnginePerformanceMonitor.monitor
     def do_aggregate_post_proc(self):
@@ -484,6 +641,9 @@ class BaseHazardCalculator(base.Calculator):
                 quantile=quantile,
                 investigation_time=self.oqparam.investigation_time)
 
+        locations = [site.location.wkt2d for site in self.site_collection]
+        lons = self.site_collection.mesh.lons.tolist()
+        lats = self.site_collection.mesh.lats.tolist()
         for imt, imls in self.oqparam.imtls.items():
             im_type, sa_period, sa_damping = from_string(imt)
 
@@ -529,35 +689,25 @@ class BaseHazardCalculator(base.Calculator):
             all_curves_for_imt = numpy.array(self.curves_by_imt[imt])
             del self.curves_by_imt[imt]  # save memory
 
-            inserter = writer.CacheInserter(
-                models.HazardCurveData, max_cache_size=10000)
-
-            # curve_poes below is an array num_rlzs * num_levels
-            for i, site in enumerate(self.site_collection):
-                wkt = site.location.wkt2d
-                curve_poes = numpy.array(
-                    [c_by_rlz[i] for c_by_rlz in all_curves_for_imt])
-
-                # calc quantiles first
-                for quantile in self.quantile_hazard_curves:
-                    q_curve = scientific.quantile_curve(
-                        curve_poes, quantile, weights)
-                    inserter.add(
-                        models.HazardCurveData(
-                            hazard_curve_id=(
-                                container_ids['q%s' % quantile]),
-                            poes=q_curve.tolist(),
-                            location=wkt))
-
-                # then means
-                if self.mean_hazard_curves:
-                    m_curve = scientific.mean_curve(curve_poes, weights)
-                    inserter.add(
-                        models.HazardCurveData(
-                            hazard_curve_id=container_ids['mean'],
-                            poes=m_curve.tolist(),
-                            location=wkt))
-            inserter.flush()
+            # the statistics are computed in parallel by blocks of sites,
+            # together with the hazard maps, if required
+            site_curves = zip(range(len(locations)), locations,
+                              all_curves_for_imt.transpose(1, 0, 2))
+            del all_curves_for_imt
+            maps_by_hc_id = tasks.apply_reduce(
+                compute_hazard_stats,
+                (self.job.id, site_curves, container_ids,
+                 self.quantile_hazard_curves, weights,
+                 imls, self.map_poes),
+                concurrent_tasks=self.concurrent_tasks,
+                name='compute_hazard_stats %s' % imt)
+            for haz_curve in self._hazard_curves:
+                if haz_curve.id not in maps_by_hc_id:
+                    continue
+                hazard_maps = numpy.zeros((len(self.poes), len(locations)))
+                for indices, hmaps in maps_by_hc_id[haz_curve.id]:
+                    hazard_maps[:, indices] = hmaps
+                self.save_hazard_maps(haz_curve, lons, lats, hazard_maps)
 
     def post_process(self):
         """
@@ -568,15 +718,13 @@ class BaseHazardCalculator(base.Calculator):
         if self.mean_hazard_curves or self.quantile_hazard_curves:
             self.do_aggregate_post_proc()
 
-        # hazard maps:
-        # required for computing UHS
-        # if `hazard_maps` is false but `uniform_hazard_spectra` is true,
-        # just don't export the maps
-        if (getattr(self.oqparam, 'hazard_maps', None) or
-                getattr(self.oqparam, 'uniform_hazard_spectra', None)):
-            with self.monitor('generating hazard maps'):
-                tasks.apply_reduce(
-                    hazard_curves_to_hazard_map,
-                    (self.job.id, self._hazard_curves, self.oqparam.poes))
-        if getattr(self.oqparam, 'uniform_hazard_spectra', None):
-            do_uhs_post_proc(self.job)
+        # the hazard maps were computed together with the curves;
+        # they are required for computing UHS: if `hazard_maps` is false
+        # but `uniform_hazard_spectra` is true, just don't export the maps
+        if self.uhs:
+            with self.monitor('generating uhs'):
+                for (statistics, quantile, rlz, poe), maps in \
+                        self._hazard_maps.iteritems():
+                    save_uhs(self.job, make_uhs(maps), poe, rlz=rlz,
+                             statistics=statistics, quantile=quantile)
+            self._hazard_maps.clear()
@@ -25,7 +25,7 @@ import numpy
 
 from itertools import izip
 
-from openquake.commonlib.calculators import calc
+from openquake.baselib.general import AccumDict
 from openquake.engine.db import models
 from openquake.engine.utils import tasks
 from openquake.engine.writer import CacheInserter
@@ -41,123 +41,224 @@ _UHS_DISP_NAME_MEAN_FMT = 'Mean UHS (%(poe)s)'
 _UHS_DISP_NAME_QUANTILE_FMT = '%(quantile)s Quantile UHS (%(poe)s)'
 _UHS_DISP_NAME_FMT = 'UHS (%(poe)s) rlz-%(rlz)s'
 
+# the poes smaller than this are replaced with EPSILON in the hazard maps
+EPSILON = 1E-30
 
-@tasks.oqtask
-def hazard_curves_to_hazard_map(job_id, hazard_curves, poes):
+
+def mean_curves(curves, weights=None):
+    """
+    Compute the weighted mean of the curves of all the realizations.
+
+    :param curves:
+        an array of shape (R, ...), i.e. (R, N, L) for the curves of R
+        realizations, N sites and L levels
+    :param weights:
+        R weights, or None for equal weights
+    :returns:
+        an array of shape curves.shape[1:]
     """
-    Function to process a set of hazard curves into 1 hazard map for each PoE
-    in ``poes``.
+    return numpy.average(curves, axis=0, weights=weights)
 
-    Hazard map results are written directly to the database.
 
-    :param int job_id:
-        ID of the current :class:`openquake.engine.db.models.OqJob`.
-    :param hazard_curves:
-        a list of
-        :class:`hazard curves <openquake.engine.db.models.HazardCurve>`.
-    :param list poes:
-        List of PoEs for which we want to iterpolate hazard maps.
+def quantile_curves(curves, quantile, weights=None):
     """
-    job = models.OqJob.objects.get(id=job_id)
-    for hc in hazard_curves:
-        hcd = list(models.HazardCurveData.objects.all_curves_simple(
-            filter_args=dict(hazard_curve=hc.id), order_by='location'
-        ))
-        imt = hc.imt
-        if imt == 'SA':
-            # if it's SA, include the period using the standard notation
-            imt = 'SA(%s)' % hc.sa_period
-
-        # Gather all of the curves and compute the maps, for all PoEs
-        curves = [_poes for _, _, _poes in hcd]
-        hazard_maps = calc.compute_hazard_maps(curves, hc.imls, poes)
-
-        # Prepare the maps to be saved to the DB
-        for i, poe in enumerate(poes):
-            map_values = hazard_maps[i]
-            lons = numpy.empty(map_values.shape)
-            lats = numpy.empty(map_values.shape)
-
-            for loc_idx, _ in enumerate(map_values):
-                lons[loc_idx] = hcd[loc_idx][0]
-                lats[loc_idx] = hcd[loc_idx][1]
-
-            # Create 'Output' records for the map for this PoE
-            if hc.statistics == 'mean':
-                disp_name = _HAZ_MAP_DISP_NAME_MEAN_FMT % dict(
-                    poe=poe, imt=imt)
-            elif hc.statistics == 'quantile':
-                disp_name = _HAZ_MAP_DISP_NAME_QUANTILE_FMT % dict(
-                    poe=poe, imt=imt, quantile=hc.quantile)
-            else:
-                disp_name = _HAZ_MAP_DISP_NAME_FMT % dict(
-                    poe=poe, imt=imt, rlz=hc.lt_realization.id)
-
-            output = job.get_or_create_output(disp_name, 'hazard_map')
-
-            # Save the complete hazard map
-            models.HazardMap.objects.create(
-                output=output,
-                lt_realization=hc.lt_realization,
-                investigation_time=hc.investigation_time,
-                imt=hc.imt,
-                statistics=hc.statistics,
-                quantile=hc.quantile,
-                sa_period=hc.sa_period,
-                sa_damping=hc.sa_damping,
-                poe=poe,
-                lons=lons.tolist(),
-                lats=lats.tolist(),
-                imls=map_values.tolist(),
-            )
-
-
-def do_uhs_post_proc(job):
+    Compute the quantile curves for all the sites at once. The results
+    are the same as the ones of
+    :func:`openquake.risklib.scientific.quantile_curve` applied site by
+    site: without weights the quantiles are computed as in
+    scipy.stats.mstats.mquantiles (with alphap=0.4, betap=0.4), otherwise
+    the poes are interpolated on the cumulative weights.
+
+    :param curves:
+        an array of shape (R, ...), i.e. (R, N, L) for the curves of R
+        realizations, N sites and L levels
+    :param quantile:
+        the quantile, a number in the range [0, 1]
+    :param weights:
+        R weights, or None for equal weights
+    :returns:
+        an array of shape curves.shape[1:]
     """
-    Compute and save (to the DB) Uniform Hazard Spectra for all hazard maps for
-    the given ``job``.
-
-    :param job:
-        Instance of :class:`openquake.engine.db.models.OqJob`.
+    curves = numpy.asarray(curves)
+    num_rlzs = len(curves)
+    arr = curves.reshape(num_rlzs, -1)
+    cols = numpy.arange(arr.shape[1])
+    if weights is None:
+        aleph = num_rlzs * quantile + 0.4 + quantile * 0.2
+        k = int(numpy.floor(numpy.clip(aleph, 1, num_rlzs - 1)))
+        gamma = numpy.clip(aleph - k, 0, 1)
+        data = numpy.sort(arr, axis=0)
+        qcurves = (1.0 - gamma) * data[k - 1] + gamma * data[k]
+        return qcurves.reshape(curves.shape[1:])
+    weights = numpy.asarray(weights, float)
+    assert len(weights) == num_rlzs, (len(weights), num_rlzs)
+    idx = numpy.argsort(arr, axis=0)
+    sorted_poes = arr[idx, cols]
+    cum_weights = numpy.cumsum(weights[idx], axis=0)
+    # linear interpolation of the poes on the cumulative weights,
+    # as numpy.interp does for each column
+    j = (cum_weights < quantile).sum(axis=0)  # cum_weights[j] >= quantile
+    j1 = j.clip(1, num_rlzs - 1)
+    x0, x1 = cum_weights[j1 - 1, cols], cum_weights[j1, cols]
+    y0, y1 = sorted_poes[j1 - 1, cols], sorted_poes[j1, cols]
+    dx = x1 - x0
+    frac = numpy.where(dx > 0, (quantile - x0) / numpy.where(
+        dx > 0, dx, 1), 1)
+    qcurves = y0 + frac * (y1 - y0)
+    qcurves[j == 0] = sorted_poes[0, j == 0]
+    qcurves[j == num_rlzs] = sorted_poes[-1, j == num_rlzs]
+    return qcurves.reshape(curves.shape[1:])
+
+
+def compute_hazard_maps(curves, imls, poes):
+    """
+    Given a set of hazard curves, interpolate the hazard maps for all
+    the sites at once. The results are the same as the ones of
+    :func:`openquake.commonlib.calculators.calc.compute_hazard_maps`:
+    the interpolation is linear in log-log space and the map value is
+    zero when the poe is bigger than the maximum poe of the curve.
+
+    :param curves:
+        an array of shape (N, L) with the curves of N sites
+    :param imls:
+        the L intensity measure levels
+    :param poes:
+        a list of P probabilities of exceedance
+    :returns:
+        an array of shape (P, N)
     """
-    poes = job.get_param('poes')
-    quantile_hazard_curves = job.get_param('quantile_hazard_curves', [])
+    curves = numpy.asarray(curves, float)
+    if curves.ndim == 1:  # a single site
+        curves = curves.reshape(1, -1)
+    num_sites, num_levels = curves.shape
+    rows = numpy.arange(num_sites)
+    # the curves are decreasing, so the reversed log-curves are increasing
+    log_curves = numpy.log(numpy.maximum(curves[:, ::-1], EPSILON))
+    log_imls = numpy.log(numpy.array(imls, float)[::-1])
+    hmaps = numpy.zeros((len(poes), num_sites))
+    for i, poe in enumerate(poes):
+        log_poe = numpy.log(poe)
+        # as in numpy.interp, interpolate between the last point with
+        # log_curves[j] <= log_poe and the next one; this matters when
+        # the poe is equal to a repeated value of the curve
+        k = (log_curves <= log_poe).sum(axis=1)
+        j = k.clip(1, num_levels - 1) - 1
+        x0, x1 = log_curves[rows, j], log_curves[rows, j + 1]
+        dx = x1 - x0
+        frac = numpy.where(dx > 0, (log_poe - x0) / numpy.where(
+            dx > 0, dx, 1), 1)
+        vals = log_imls[j] + frac * (log_imls[j + 1] - log_imls[j])
+        vals[k == 0] = log_imls[0]
+        vals[k == num_levels] = log_imls[-1]
+        hmap = numpy.exp(vals)
+        # poe bigger than the maximum poe: the iml is extrapolated to zero
+        hmap[log_curves[:, -1] < log_poe] = 0
+        hmaps[i] = hmap
+    return hmaps
 
-    rlzs = models.LtRealization.objects.filter(
-        lt_model__hazard_calculation=job)
 
-    for poe in poes:
-        maps_for_poe = models.HazardMap.objects.filter(
-            output__oq_job=job, poe=poe
-        )
+@tasks.oqtask
+def compute_hazard_stats(job_id, site_curves, container_ids, quantiles,
+                         weights, imls=None, poes=()):
+    """
+    Compute the mean and quantile curves for a block of sites and save
+    them with a single COPY FROM. If `poes` are given, compute also
+    the corresponding hazard maps.
+
+    :param int job_id:
+        ID of the current :class:`openquake.engine.db.models.OqJob`
+    :param site_curves:
+        a list of triples (site index, location WKT, array of shape (R, L))
+        with the curves of the R realizations for the same IMT
+    :param container_ids:
+        a dictionary 'mean' -> HazardCurve ID, 'q<quantile>' -> HazardCurve ID
+    :param quantiles:
+        a list of quantiles
+    :param weights:
+        the weights of the realizations, or None
+    :param imls:
+        the intensity measure levels of the curves
+    :param poes:
+        the poes of the hazard maps
+    :returns:
+        a dictionary HazardCurve ID -> [(site indices, maps of shape (P, N))]
+    """
+    indices = numpy.array([idx for idx, _, _ in site_curves])
+    locations = [loc for _, loc, _ in site_curves]
+    # array of shape (R, N, L)
+    curves = numpy.array([c for _, _, c in site_curves]).transpose(1, 0, 2)
+    stats = [(container_ids['q%s' % q], quantile_curves(curves, q, weights))
+             for q in quantiles]
+    if 'mean' in container_ids:
+        stats.append((container_ids['mean'], mean_curves(curves, weights)))
+    data = [models.HazardCurveData(hazard_curve_id=hc_id,
+                                   poes=curve.tolist(), location=loc)
+            for hc_id, stat_curves in stats
+            for loc, curve in izip(locations, stat_curves)]
+    if data:
+        CacheInserter.saveall(data)
+    hmaps = AccumDict()
+    if len(poes):
+        for hc_id, stat_curves in stats:
+            hmaps[hc_id] = [
+                (indices, compute_hazard_maps(stat_curves, imls, poes))]
+    return hmaps
+
+
+def save_hazard_maps(job, hc, lons, lats, hazard_maps, poes):
+    """
+    Save a HazardMap for each PoE.
 
-        # mean (if defined)
-        mean_maps = maps_for_poe.filter(statistics='mean')
-        if mean_maps.count() > 0:
-            mean_uhs = make_uhs(mean_maps)
-            _save_uhs(job, mean_uhs, poe, statistics='mean')
-
-        # quantiles (if defined)
-        for quantile in quantile_hazard_curves:
-            quantile_maps = maps_for_poe.filter(
-                statistics='quantile', quantile=quantile
-            )
-            if quantile_maps:
-                # they are missing if there is a single realization
-                quantile_uhs = make_uhs(quantile_maps)
-                _save_uhs(job, quantile_uhs, poe, statistics='quantile',
-                          quantile=quantile)
-
-        if job.get_param('individual_curves', True):
-            # build a map for each logic tree branch
-            for rlz in rlzs:
-                rlz_maps = maps_for_poe.filter(
-                    statistics=None, lt_realization=rlz
-                )
-                assert rlz_maps, \
-                    'Could not find HazardMaps for rlz=%d' % rlz.id
-                rlz_uhs = make_uhs(rlz_maps)
-                _save_uhs(job, rlz_uhs, poe, rlz=rlz)
+    :param job:
+        the current :class:`openquake.engine.db.models.OqJob`
+    :param hc:
+        the :class:`openquake.engine.db.models.HazardCurve` of the curves
+    :param lons:
+        the longitudes of the N sites
+    :param lats:
+        the latitudes of the N sites
+    :param hazard_maps:
+        an array of shape (P, N)
+    :param poes:
+        the P poes of the maps
+    :returns:
+        the list of saved :class:`openquake.engine.db.models.HazardMap`
+    """
+    imt = hc.imt
+    if imt == 'SA':
+        # if it's SA, include the period using the standard notation
+        imt = 'SA(%s)' % hc.sa_period
+    saved = []
+    for poe, map_values in izip(poes, hazard_maps):
+        # Create 'Output' records for the map for this PoE
+        if hc.statistics == 'mean':
+            disp_name = _HAZ_MAP_DISP_NAME_MEAN_FMT % dict(
+                poe=poe, imt=imt)
+        elif hc.statistics == 'quantile':
+            disp_name = _HAZ_MAP_DISP_NAME_QUANTILE_FMT % dict(
+                poe=poe, imt=imt, quantile=hc.quantile)
+        else:
+            disp_name = _HAZ_MAP_DISP_NAME_FMT % dict(
+                poe=poe, imt=imt, rlz=hc.lt_realization.id)
+
+        output = job.get_or_create_output(disp_name, 'hazard_map')
+
+        # Save the complete hazard map
+        saved.append(models.HazardMap.objects.create(
+            output=output,
+            lt_realization=hc.lt_realization,
+            investigation_time=hc.investigation_time,
+            imt=hc.imt,
+            statistics=hc.statistics,
+            quantile=hc.quantile,
+            sa_period=hc.sa_period,
+            sa_damping=hc.sa_damping,
+            poe=poe,
+            lons=list(lons),
+            lats=list(lats),
+            imls=numpy.asarray(map_values).tolist(),
+        ))
+    return saved
 
 
 def make_uhs(maps):
@@ -207,7 +308,7 @@ def make_uhs(maps):
     return result
 
 
-def _save_uhs(job, uhs_results, poe, rlz=None, statistics=None, quantile=None):
+def save_uhs(job, uhs_results, poe, rlz=None, statistics=None, quantile=None):
     """
     Save computed UHS data to the DB.
 
@@ -19,11 +19,11 @@
 Base RiskCalculator class.
 """
 
-import itertools
+import copy
+import collections
 import psutil
 import numpy
 
-from openquake.commonlib import risk_parsers
 from openquake.hazardlib.imt import from_string
 from openquake.commonlib.readinput import get_risk_model
 from openquake.commonlib.parallel import virtual_memory
@@ -35,15 +35,13 @@ from openquake.engine.calculators.risk import \
     writers, validation, hazard_getters
 from openquake.engine.utils import config, tasks
 from openquake.engine.performance import EnginePerformanceMonitor
-from openquake.engine.input.exposure import ExposureDBWriter
+from openquake.engine.input.exposure import import_exposure
 
 MEMORY_ERROR = '''Running the calculation will require approximately
 %dM, i.e. more than the memory which is available right now (%dM).
 Please increase the free memory or apply a stringent region
 constraint to reduce the number of assets. Alternatively you can set
-epsilon_sampling in openquake.cfg. It the correlation is
-nonzero, consider setting asset_correlation=0 to avoid building the
-correlation matrix.'''
+epsilon_sampling in openquake.cfg.'''
 
 #: Default maximum asset-hazard distance in km
 DEFAULT_MAXIMUM_DISTANCE = 5
@@ -54,9 +52,9 @@ eps_sampling = int(config.get('risk', 'epsilon_sampling'))
 @tasks.oqtask
 def prepare_risk(job_id, counts_taxonomy, calc):
     """
-    Associates the assets to the closest hazard sites and populate
-    the table asset_site. For some calculators also initializes the
-    epsilon matrices and save them on the database.
+    Reads the associations between the assets and the closest hazard
+    sites and checks the needed memory. The epsilons are not stored:
+    they are regenerated by the risk tasks for their own assets.
 
     :param job_id:
         ID of the current risk job
@@ -69,7 +67,7 @@ def prepare_risk(job_id, counts_taxonomy, calc):
 
         # building the RiskInitializers
         with EnginePerformanceMonitor(
-                "associating asset->site", job_id, prepare_risk):
+                "reading asset->site", job_id, prepare_risk):
             initializer = hazard_getters.RiskInitializer(taxonomy, calc)
             initializer.init_assocs()
 
@@ -86,49 +84,61 @@ def prepare_risk(job_id, counts_taxonomy, calc):
                 raise MemoryError(
                     MEMORY_ERROR % (estimate_mb, available_mb))
 
-        # initializing epsilons
-        with EnginePerformanceMonitor(
-                "initializing epsilons", job_id, prepare_risk):
-            initializer.init_epsilons(eps_sampling)
-
 
 @tasks.oqtask
-def run_risk(job_id, sorted_assocs, calc):
+def run_risk(job_id, assocs, calc):
     """
     Run the risk calculation on the given assets by using the given
-    hazard initializers and risk calculator.
+    hazard initializers and risk calculator. The hazard of the sites
+    is read once per IMT and shared by the assets of all taxonomies.
 
     :param job_id:
         ID of the current risk job
-    :param sorted_assocs:
-        asset_site associations, sorted by taxonomy
+    :param assocs:
+        asset_site associations for a block of hazard sites
     :param calc:
         the risk calculator to use
     """
-    acc = calc.acc
-    hazard_outputs = calc.get_hazard_outputs()
-    monitor = EnginePerformanceMonitor(None, job_id, run_risk)
-    exposure_model = calc.exposure_model
-    time_event = calc.time_event
-    for taxonomy, assocs_by_taxonomy in itertools.groupby(
-            sorted_assocs, lambda a: a.asset.taxonomy):
+    # the initial value of the accumulator is copied, since agg_result
+    # can update it in place and calc.acc is shared when the tasks run
+    # in the controller process
+    acc = copy.deepcopy(calc.acc)
+    try:
+        hazard_outputs = calc.get_hazard_outputs()
+        monitor = EnginePerformanceMonitor(None, job_id, run_risk)
+        hazard_cache = {}  # shared by the getters of the task
         with calc.monitor("getting assets"):
             assets = models.ExposureData.objects.get_asset_chunk(
-                exposure_model, time_event, assocs_by_taxonomy)
-        for it in models.ImtTaxonomy.objects.filter(
-                job=calc.job, taxonomy=taxonomy):
-            imt = it.imt.imt_str
+                calc.exposure_model, calc.time_event, assocs)
+        indices = collections.defaultdict(list)  # taxonomy -> asset indices
+        for i, asset in enumerate(assets):
+            indices[asset.taxonomy].append(i)
+        taxonomies_by_imt = collections.defaultdict(list)
+        imt_taxonomies = models.ImtTaxonomy.objects.filter(
+            job=calc.job, taxonomy__in=list(indices))
+        for it in imt_taxonomies.select_related('imt'):
+            taxonomies_by_imt[it.imt.imt_str].append(it.taxonomy)
+        for imt in sorted(taxonomies_by_imt):
             with calc.monitor("getting hazard"):
                 getter = calc.getter_class(
-                    imt, taxonomy, hazard_outputs, assets)
-            logs.LOG.info(
-                'Read %d data for %d assets of taxonomy %s, imt=%s',
-                len(set(getter.site_ids)), len(assets), taxonomy, imt)
-
-            res = calc.core(
-                calc.risk_model[imt, taxonomy],
-                getter, calc.outputdict, calc.oqparam, monitor)
-            acc = calc.agg_result(acc, res)
+                    imt, None, hazard_outputs, assets, hazard_cache,
+                    calc.epsilon_params)
+            for taxonomy in sorted(taxonomies_by_imt[imt]):
+                subgetter = getter.get_subset(taxonomy, indices[taxonomy])
+                logs.LOG.info(
+                    'Read %d data for %d assets of taxonomy %s, imt=%s',
+                    len(set(subgetter.site_ids)), len(subgetter.assets),
+                    taxonomy, imt)
+                res = calc.core(
+                    calc.risk_model[imt, taxonomy],
+                    subgetter, calc.outputdict, calc.oqparam, monitor)
+                acc = calc.agg_result(acc, res)
+        with calc.monitor("saving risk outputs"):
+            writers.flush()
+    finally:
+        # no-op after the flush; if the task failed, the outputs in the
+        # caches must not be saved by the next task in this process
+        writers.discard()
     return acc
 
 
@@ -249,9 +259,7 @@ class RiskCalculator(base.Calculator):
             self.exposure_model = self.job.exposure_model
         except models.ObjectDoesNotExist:
             with self.monitor('import exposure'):
-                ExposureDBWriter(self.job).serialize(
-                    risk_parsers.ExposureModelParser(
-                        self.oqparam.inputs['exposure']))
+                import_exposure(self.job, self.oqparam.inputs['exposure'])
             self.exposure_model = self.job.exposure_model
         self.taxonomies_asset_count = \
             self.exposure_model.taxonomies_in(
@@ -274,17 +282,30 @@ class RiskCalculator(base.Calculator):
         logs.LOG.info('Considering %d assets of %d distinct taxonomies',
                       num_assets, num_taxonomies)
 
+    @property
+    def epsilon_params(self):
+        """
+        The parameters needed by the getters to regenerate the epsilons,
+        i.e. the triple (master_seed, asset_correlation, epsilon_sampling)
+        """
+        return (self.oqparam.master_seed,
+                self.oqparam.asset_correlation,
+                eps_sampling)
+
     def prepare_risk(self):
         """
-        Associate assets and sites and for some calculator generate the
-        epsilons.
+        Associate assets and sites.
         """
         self.outputdict = writers.combine_builders(
             [ob(self) for ob in self.output_builders])
 
-        # build the initializers hazard -> risk
+        # associate the assets of all taxonomies to the hazard sites
         ct = sorted((counts, taxonomy) for taxonomy, counts
                     in self.taxonomies_asset_count.iteritems())
+        with self.monitor('associating asset->site'):
+            hazard_getters.associate_assets(self, [t for _c, t in ct])
+
+        # build the initializers hazard -> risk
         tasks.apply_reduce(prepare_risk, (self.job.id, ct, self),
                            concurrent_tasks=self.concurrent_tasks)
 
@@ -295,15 +316,16 @@ class RiskCalculator(base.Calculator):
         calculators share a two phase distribution logic: in phase 1
         the initializer objects are built, by distributing per taxonomy;
         in phase 2 the real computation is run, by distributing in chunks
-        of asset_site associations.
+        of asset_site associations ordered by site, so that each task
+        reads the hazard of a block of sites only once.
         """
         self.prepare_risk()
         # then run the real computation
         assocs = models.AssetSite.objects.filter(job=self.job).order_by(
-            'asset__taxonomy')
+            'site', 'asset')
         self.acc = tasks.apply_reduce(
             run_risk, (self.job.id, assocs, self),
-            self.agg_result, self.acc, self.concurrent_tasks,
+            self.agg_result, copy.deepcopy(self.acc), self.concurrent_tasks,
             name=self.core.__name__)
 
     def get_risk_model(self):
@@ -20,7 +20,7 @@ Core functionality for the classical PSHA risk calculator.
 import itertools
 
 from openquake.engine.calculators.risk import (
-    base, hazard_getters, validation, writers)
+    base, hazard_getters, loss_statistics, validation, writers)
 from openquake.engine.calculators import calculators
 
 
@@ -44,22 +44,39 @@ def classical(workflow, getter, outputdict, params, monitor):
     loss fractions. Then if the number of units are bigger than 1, we
     compute mean and quantile artifacts.
     """
+    # the loss fractions are the conditional losses for the poes_disagg,
+    # so they are computed together with the loss maps and split later
+    poes = (list(params.conditional_loss_poes or []) +
+            list(params.poes_disagg or []))
     for loss_type in workflow.loss_types:
-        with monitor('computing risk'):
-            outputs = workflow.compute_all_outputs(getter, loss_type)
-            stats = workflow.statistics(
-                outputs, params.quantile_loss_curves)
-        with monitor('saving risk'):
-            for out in outputs:
+        # the outputs are consumed one realization at the time; since the
+        # classical curves share their loss ratios across realizations
+        # the running mean is exact
+        outputs = workflow.compute_all_outputs(getter, loss_type)
+        stats = loss_statistics.LossStatistics(
+            poes, params.quantile_loss_curves)
+        insured_stats = loss_statistics.LossStatistics(
+            [], params.quantile_loss_curves)
+        for out in outputs:
+            stats_assets = out.output.assets
+            stats.add(out.output.loss_curves, out.weight)
+            if out.output.insured_curves is not None:
+                insured_stats.add(out.output.insured_curves, out.weight)
+            with monitor('saving risk'):
                 save_individual_outputs(
                     outputdict.with_args(
                         loss_type=loss_type, hazard_output_id=out.hid),
                     out.output, params)
-            if stats is not None:
+
+        if stats.num_rlzs > 1:
+            with monitor('computing risk statistics'):
+                stat_output = loss_statistics.get_statistical_output(
+                    stats_assets, stats, insured_stats)
+            with monitor('saving risk statistics'):
                 save_statistical_output(
                     outputdict.with_args(
                         loss_type=loss_type, hazard_output_id=None),
-                    stats, params)
+                    stat_output, params)
 
 
 def save_individual_outputs(outputdict, outs, params):
@@ -111,13 +128,16 @@ def save_statistical_output(outputdict, stats, params):
     :param outputdict:
         a :class:`openquake.engine.calculators.risk.writers.OutputDict`
         instance holding the reference to the output container objects
-    :param outs:
-        a :class:`openquake.risklib.workflows.Classical.StatisticalOutput`
-        holding the statistical output data
+    :param stats:
+        a :class:`..loss_statistics.StatisticalOutput` holding the
+        statistical output data; its maps contain the conditional losses
+        for the conditional_loss_poes followed by the loss fractions for
+        the poes_disagg
     :param params:
         a :class:`openquake.engine.calculators.risk.base.CalcParams`
         holding the parameters for this calculation
     """
+    clp = len(params.conditional_loss_poes or [])
 
     # mean curves, maps and fractions
     outputdict.write(
@@ -125,12 +145,12 @@ def save_statistical_output(outputdict, stats, params):
         output_type="loss_curve", statistics="mean")
 
     outputdict.write_all("poe", params.conditional_loss_poes,
-                         stats.mean_maps, stats.assets,
+                         stats.mean_maps[:clp], stats.assets,
                          output_type="loss_map",
                          statistics="mean")
 
     outputdict.write_all("poe", params.poes_disagg,
-                         stats.mean_fractions,
+                         stats.mean_maps[clp:],
                          stats.assets,
                          [a.taxonomy for a in stats.assets],
                          output_type="loss_fraction", statistics="mean",
@@ -145,13 +165,13 @@ def save_statistical_output(outputdict, stats, params):
 
     for quantile, maps in zip(
             params.quantile_loss_curves, stats.quantile_maps):
-        outputdict.write_all("poe", params.conditional_loss_poes, maps,
-                             stats.assets, output_type="loss_map",
+        outputdict.write_all("poe", params.conditional_loss_poes,
+                             maps[:clp], stats.assets, output_type="loss_map",
                              statistics="quantile", quantile=quantile)
 
-    for quantile, fractions in zip(
-            params.quantile_loss_curves, stats.quantile_fractions):
-        outputdict.write_all("poe", params.poes_disagg, fractions,
+    for quantile, maps in zip(
+            params.quantile_loss_curves, stats.quantile_maps):
+        outputdict.write_all("poe", params.poes_disagg, maps[clp:],
                              stats.assets, [a.taxonomy for a in stats.assets],
                              output_type="loss_fraction",
                              statistics="quantile", quantile=quantile,
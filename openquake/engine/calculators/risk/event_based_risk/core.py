@@ -26,13 +26,40 @@ from openquake.risklib import scientific
 from openquake.risklib.utils import numpy_map
 
 from openquake.engine.calculators.risk import (
-    base, hazard_getters, validation, writers)
+    base, hazard_getters, loss_statistics, validation, writers)
 from openquake.engine.db import models
 from openquake.engine import writer, logs
 from openquake.engine.calculators import calculators
 from openquake.engine.performance import EnginePerformanceMonitor
 
 
+def elt_to_array(event_loss_table, rupture_ids):
+    """
+    Convert an event loss table into a dense array of losses.
+
+    :param event_loss_table:
+        a dictionary rupture_id -> aggregate loss, or a sequence of
+        pairs (rupture_id, loss); the losses of the same rupture are summed
+    :param rupture_ids:
+        the sorted array of the rupture IDs of the hazard output
+    :returns:
+        an array of losses indexed by rupture ordinal; the losses of
+        ruptures not in `rupture_ids` are discarded
+    """
+    losses = numpy.zeros(len(rupture_ids))
+    if hasattr(event_loss_table, 'items'):
+        event_loss_table = event_loss_table.items()
+    if not len(event_loss_table) or not len(rupture_ids):
+        return losses
+    rupids = numpy.array([r for r, _ in event_loss_table], dtype=int)
+    values = numpy.array([v for _, v in event_loss_table], dtype=float)
+    ordinals = numpy.searchsorted(rupture_ids, rupids)
+    ok = ordinals < len(rupture_ids)
+    ok[ok] = rupture_ids[ordinals[ok]] == rupids[ok]
+    numpy.add.at(losses, ordinals[ok], values[ok])
+    return losses
+
+
 def _filter_loss_matrix_assets(loss_matrix, assets, specific_assets):
     # reduce loss_matrix and assets to the specific_assets
     mask = numpy.array([a.asset_ref in specific_assets for a in assets])
@@ -58,11 +85,10 @@ def event_based(workflow, getter, outputdict, params, monitor):
     :param monitor:
       A monitor instance
     :returns:
-      A dictionary {loss_type: event_loss_table}
+      A dictionary (loss_type, out_id) -> array of losses per rupture ordinal
     """
-    # NB: event_loss_table is a dictionary (loss_type, out_id) -> loss,
-    # out_id can be None, and it that case it stores the statistics
     event_loss_table = {}
+    hazard_outputs = dict((ho.id, ho) for ho in getter.hazard_outputs)
 
     # num_loss is a dictionary asset_ref -> array([not_zeros, total])
     num_losses = collections.defaultdict(lambda: numpy.zeros(2, dtype=int))
@@ -76,16 +102,22 @@ def event_based(workflow, getter, outputdict, params, monitor):
     inserter = writer.CacheInserter(
         models.EventLossAsset, max_cache_size=10000)
     for loss_type in workflow.loss_types:
-        with monitor('computing individual risk'):
-            outputs = workflow.compute_all_outputs(getter, loss_type)
-            if statistics:
-                outputs = list(outputs)  # expand the generator
-                # this is needed, otherwise the call to workflow.statistics
-                # below will find an empty iterable; notice that by disabling
-                # the statistics we can save memory by keeping only one
-                # hazard realization at the time
+        # the outputs are consumed one realization at the time and only
+        # their loss curves are kept for the statistics
+        outputs = workflow.compute_all_outputs(getter, loss_type)
+        stats = loss_statistics.LossStatistics(
+            params.conditional_loss_poes, params.quantile_loss_curves)
+        insured_stats = loss_statistics.LossStatistics(
+            [], params.quantile_loss_curves)
         for out in outputs:
-            event_loss_table[loss_type, out.hid] = out.output.event_loss_table
+            event_loss_table[loss_type, out.hid] = elt_to_array(
+                out.output.event_loss_table, hazard_getters.get_rupture_ids(
+                    hazard_outputs[out.hid], getter.cache))
+            if statistics:
+                stats_assets = out.output.assets
+                stats.add(out.output.loss_curves, out.weight)
+                if out.output.insured_curves is not None:
+                    insured_stats.add(out.output.insured_curves, out.weight)
             disagg_outputs = None  # changed if params.sites_disagg is set
             if specific_assets:
                 loss_matrix, assets = _filter_loss_matrix_assets(
@@ -127,16 +159,15 @@ def event_based(workflow, getter, outputdict, params, monitor):
                                          loss_type=loss_type),
                     out.output, disagg_outputs, params)
 
-        if statistics and len(outputs) > 1:
-            stats = workflow.statistics(
-                outputs, params.quantile_loss_curves)
-
+        if stats.num_rlzs > 1:
+            with monitor('computing risk statistics'):
+                stat_output = loss_statistics.get_statistical_output(
+                    stats_assets, stats, insured_stats)
             with monitor('saving risk statistics'):
                 save_statistical_output(
                     outputdict.with_args(
                         hazard_output_id=None, loss_type=loss_type),
-                    stats, params)
-            event_loss_table[loss_type, None] = stats.event_loss_table
+                    stat_output, params)
 
     inserter.flush()
 
@@ -210,8 +241,7 @@ def save_statistical_output(outputdict, stats, params):
         a :class:`openquake.engine.calculators.risk.writers.OutputDict`
         instance holding the reference to the output container objects
     :param stats:
-        :class:
-        `openquake.risklib.workflows.ProbabilisticEventBased.StatisticalOutput`
+        a :class:`..loss_statistics.StatisticalOutput`
         holding the statistical output data
     :param params:
         a :class:`openquake.engine.calculators.risk.base.CalcParams`
@@ -340,7 +370,7 @@ class EventBasedRiskCalculator(base.RiskCalculator):
     def __init__(self, job):
         super(EventBasedRiskCalculator, self).__init__(job)
         # accumulator for the event loss tables
-        self.acc = collections.defaultdict(collections.Counter)
+        self.acc = {}
         self.sites_disagg = self.job.get_param('sites_disagg')
         self.specific_assets = self.job.get_param('specific_assets')
 
@@ -372,17 +402,14 @@ class EventBasedRiskCalculator(base.RiskCalculator):
     @EnginePerformanceMonitor.monitor
     def agg_result(self, acc, event_loss_table):
         """
-        Updates the event loss table
+        Updates in place the event loss tables, i.e. the arrays of losses
+        indexed by rupture ordinal for each loss type and hazard output
         """
-        newdict = acc.copy()
-        for (loss_type, out_id), counter in event_loss_table.iteritems():
-            try:
-                c = newdict[loss_type, out_id]
-            except KeyError:
-                pass
-            else:
-                newdict[loss_type, out_id] = c + counter
-        return newdict
+        for key, losses in event_loss_table.iteritems():
+            if key not in acc:
+                acc[key] = numpy.zeros(losses.shape)
+            acc[key] += losses
+        return acc
 
     def post_process(self):
         """
@@ -391,60 +418,42 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         oq = self.oqparam
         tses = oq.investigation_time * oq.ses_per_logic_tree_path
         with self.monitor('post processing'):
-            inserter = writer.CacheInserter(models.EventLossData,
-                                            max_cache_size=10000)
-            for (loss_type, out_id), event_loss_table in self.acc.items():
-                if out_id:  # values for individual realizations
-                    hazard_output = models.Output.objects.get(pk=out_id)
-                    event_loss = models.EventLoss.objects.get(
-                        output__oq_job=self.job,
-                        output__output_type='event_loss',
-                        loss_type=loss_type, hazard_output=hazard_output)
-                    if isinstance(hazard_output.output_container,
-                                  models.SESCollection):
-                        ses_coll = hazard_output.output_container
-                        rupture_ids = ses_coll.get_ruptures().values_list(
-                            'id', flat=True)
-                    else:  # extract the SES collection from the Gmf
-                        rupture_ids = models.SESRupture.objects.filter(
-                            rupture__ses_collection__trt_model__lt_model=
-                            hazard_output.output_container.
-                            lt_realization.lt_model).values_list(
-                            'id', flat=True)
-                    for rupture_id in rupture_ids:
-                        if rupture_id in event_loss_table:
-                            inserter.add(
-                                models.EventLossData(
-                                    event_loss_id=event_loss.id,
-                                    rupture_id=rupture_id,
-                                    aggregate_loss=event_loss_table[
-                                        rupture_id]))
-                    inserter.flush()
-
-                    aggregate_losses = [
-                        event_loss_table[rupture_id]
-                        for rupture_id in rupture_ids
-                        if rupture_id in event_loss_table]
-
-                    if aggregate_losses:
-                        aggregate_loss = scientific.event_based(
-                            aggregate_losses, tses=tses,
-                            time_span=oq.investigation_time,
-                            curve_resolution=oq.loss_curve_resolution)
-
-                        models.AggregateLossCurveData.objects.create(
-                            loss_curve=models.LossCurve.objects.create(
-                                aggregate=True, insured=False,
-                                hazard_output=hazard_output,
-                                loss_type=loss_type,
-                                output=models.Output.objects.create_output(
-                                    self.job,
-                                    "aggregate loss curves. "
-                                    "loss_type=%s hazard=%s" % (
-                                        loss_type, hazard_output),
-                                    "agg_loss_curve")),
-                            losses=aggregate_loss[0],
-                            poes=aggregate_loss[1],
-                            average_loss=scientific.average_loss(
-                                aggregate_loss),
-                            stddev_loss=numpy.std(aggregate_losses))
+            for (loss_type, out_id), losses in sorted(self.acc.iteritems()):
+                hazard_output = models.Output.objects.get(pk=out_id)
+                event_loss = models.EventLoss.objects.get(
+                    output__oq_job=self.job,
+                    output__output_type='event_loss',
+                    loss_type=loss_type, hazard_output=hazard_output)
+                rupture_ids = hazard_getters.get_rupture_ids(hazard_output)
+                ordinals, = (losses > 0).nonzero()
+                aggregate_losses = losses[ordinals]
+                if not len(aggregate_losses):
+                    continue
+                writer.CacheInserter.saveall([
+                    models.EventLossData(
+                        event_loss_id=event_loss.id,
+                        rupture_id=rupture_ids[o],
+                        aggregate_loss=losses[o])
+                    for o in ordinals])
+
+                aggregate_loss = scientific.event_based(
+                    aggregate_losses, tses=tses,
+                    time_span=oq.investigation_time,
+                    curve_resolution=oq.loss_curve_resolution)
+
+                models.AggregateLossCurveData.objects.create(
+                    loss_curve=models.LossCurve.objects.create(
+                        aggregate=True, insured=False,
+                        hazard_output=hazard_output,
+                        loss_type=loss_type,
+                        output=models.Output.objects.create_output(
+                            self.job,
+                            "aggregate loss curves. "
+                            "loss_type=%s hazard=%s" % (
+                                loss_type, hazard_output),
+                            "agg_loss_curve")),
+                    losses=aggregate_loss[0],
+                    poes=aggregate_loss[1],
+                    average_loss=scientific.average_loss(
+                        aggregate_loss),
+                    stddev_loss=numpy.std(aggregate_losses))
@@ -18,15 +18,15 @@
 """
 Hazard input management for Risk calculators.
 """
-import itertools
-import operator
-
+import copy
+import hashlib
 import numpy
+import scipy.spatial
 
 from openquake.hazardlib.imt import from_string
-from openquake.risklib import scientific
+from openquake.hazardlib.geo import geodetic, utils as geo_utils
 
-from openquake.engine import logs
+from openquake.engine import logs, writer
 from openquake.engine.db import models
 from django.db import transaction
 
@@ -65,15 +65,48 @@ class Hazard(object):
             return h.lt_realization.weight
 
 
-def make_epsilons(asset_count, num_samples, seed, correlation):
+def _seed_words(string):
+    # a stable 160 bit hash of a (possibly unicode) string, as a list of
+    # five unsigned 32 bit words usable in a seed; a single 32 bit word
+    # would give colliding seeds for large exposures
+    if isinstance(string, unicode):
+        string = string.encode('utf-8')
+    digest = hashlib.sha1(string).digest()
+    return [int(w) for w in numpy.frombuffer(digest, dtype='>u4')]
+
+
+def make_epsilons(asset_refs, num_samples, seed, correlation,
+                  ses_ordinal=0, taxonomy=''):
     """
-    :param int asset_count: the number of assets
-    :param int num_ruptures: the number of ruptures
+    Regenerate the epsilons of the given assets for a SES collection.
+    The epsilons of an asset depend only on the seed, on the ordinal of
+    the SES collection and on the asset reference, so that any task can
+    regenerate the epsilons of its own assets, independently from the
+    way the assets are split in chunks. If the correlation is nonzero
+    the assets of the same taxonomy share a common normal component:
+    `sqrt(rho) * z_common + sqrt(1 - rho) * z_asset` has the same
+    covariance as the full correlation matrix, without building it.
+
+    :param asset_refs: a list of N asset references
+    :param int num_samples: the number of samples
     :param int seed: a random seed
     :param float correlation: the correlation coefficient
+    :param int ses_ordinal: the ordinal of the SES collection
+    :param str taxonomy: the taxonomy of the assets
+    :returns: an array of shape (N, num_samples)
     """
-    zeros = numpy.zeros((asset_count, num_samples))
-    return scientific.make_epsilons(zeros, seed, correlation)
+    eps = numpy.zeros((len(asset_refs), num_samples))
+    for i, asset_ref in enumerate(asset_refs):
+        rng = numpy.random.RandomState(
+            [seed, ses_ordinal] + _seed_words(asset_ref))
+        eps[i] = rng.normal(size=num_samples)
+    if correlation:
+        rng = numpy.random.RandomState(
+            [seed, ses_ordinal, 1] + _seed_words(taxonomy))
+        common = rng.normal(size=num_samples)
+        eps = (numpy.sqrt(correlation) * common +
+               numpy.sqrt(1. - correlation) * eps)
+    return eps
 
 
 class HazardGetter(object):
@@ -90,20 +123,26 @@ class HazardGetter(object):
 
    :attr site_ids:
         The ids of the sites associated to the hazards
+
+   :attr cache:
+        A dictionary which can be shared by the getters of the same task,
+        to avoid reading the same hazard data more than once
+
+   :attr epsilon_params:
+        A triple (seed, correlation, epsilon_sampling) used to regenerate
+        the epsilons of the assets, or None
     """
-    def __init__(self, imt, taxonomy, hazard_outputs, assets):
+    def __init__(self, imt, taxonomy, hazard_outputs, assets, cache=None,
+                 epsilon_params=None):
         self.imt = imt
         self.taxonomy = taxonomy
         self.hazard_outputs = hazard_outputs
         self.assets = assets
-        self.site_ids = []
-        self.asset_site_ids = []
-        # asset_site associations
-        for asset in self.assets:
-            asset_site_id = asset.asset_site_id
-            assoc = models.AssetSite.objects.get(pk=asset_site_id)
-            self.site_ids.append(assoc.site.id)
-            self.asset_site_ids.append(asset_site_id)
+        self.cache = {} if cache is None else cache
+        self.epsilon_params = epsilon_params
+        # asset_site associations, as annotated by get_asset_chunk
+        self.asset_site_ids = [asset.asset_site_id for asset in self.assets]
+        self.site_ids = [asset.hazard_site_id for asset in self.assets]
 
     def get_hazards(self):
         """
@@ -112,6 +151,20 @@ class HazardGetter(object):
         return [Hazard(ho, self._get_data(ho), self.imt)
                 for ho in self.hazard_outputs]
 
+    def get_subset(self, taxonomy, indices):
+        """
+        :param taxonomy: a taxonomy string
+        :param indices: the indices of the assets of the given taxonomy
+        :returns: a shallow copy of the getter restricted to the given
+                  assets; the hazard data are shared and not read again
+        """
+        new = copy.copy(self)
+        new.taxonomy = taxonomy
+        new.assets = [self.assets[i] for i in indices]
+        new.asset_site_ids = [self.asset_site_ids[i] for i in indices]
+        new.site_ids = [self.site_ids[i] for i in indices]
+        return new
+
     def get_data(self):
         """
         Shortcut returning the hazard data when there is a single realization
@@ -137,12 +190,22 @@ class HazardGetter(object):
 
 class HazardCurveGetter(HazardGetter):
     """
-    Simple HazardCurve Getter that performs a spatial query for each
-    asset.
+    Simple HazardCurve Getter that reads the curves of all the sites
+    of the assets with a single query; the curves are cached by
+    hazard output and IMT.
     """ + HazardGetter.__doc__
 
     def _get_data(self, ho):
-        # extract the poes for each site from the given hazard output
+        # extract the poes for each site from the given hazard output;
+        # returns an array of shape (N, L), N being the number of assets
+        curves = self.cache.setdefault((ho.id, self.imt), {})
+        missing = sorted(set(self.site_ids).difference(curves))
+        if missing:
+            curves.update(zip(missing, self._read_curves(ho, missing)))
+        return numpy.array([curves[site_id] for site_id in self.site_ids])
+
+    def _read_curves(self, ho, site_ids):
+        # read the curves for the given (distinct) sites
         imt_type, sa_period, sa_damping = from_string(self.imt)
         oc = ho.output_container
         if oc.output.output_type == 'hazard_curve_multi':
@@ -154,20 +217,24 @@ class HazardCurveGetter(HazardGetter):
                 imt=imt_type,
                 sa_period=sa_period,
                 sa_damping=sa_damping)
+        if oc.is_lazy:
+            # read the curves from the datastore or compose
+            # them from the independent ones
+            return oc.build_data(site_ids)
 
         cursor = models.getcursor('job_init')
         query = """\
-        SELECT hzrdr.hazard_curve_data.poes
-        FROM hzrdr.hazard_curve_data
-        WHERE hazard_curve_id = %s AND location = %s
+        SELECT hs.id, hcd.poes
+        FROM hzrdr.hazard_curve_data AS hcd
+        JOIN hzrdi.hazard_site AS hs ON hcd.location = hs.location
+        WHERE hcd.hazard_curve_id = %s AND hs.id IN %s
         """
-        all_curves = []
-        for site_id in self.site_ids:
-            location = models.HazardSite.objects.get(pk=site_id).location
-            cursor.execute(query, (oc.id, 'SRID=4326; ' + location.wkt))
-            poes = cursor.fetchall()[0][0]
-            all_curves.append(poes)
-        return all_curves
+        cursor.execute(query, (oc.id, tuple(site_ids)))
+        idx = dict((site_id, i) for i, site_id in enumerate(site_ids))
+        data = numpy.zeros((len(site_ids), len(oc.imls)))
+        for site_id, poes in cursor.fetchall():
+            data[idx[site_id]] = poes
+        return data
 
 
 def expand(array, N):
@@ -194,43 +261,101 @@ def haz_out_to_ses_coll(ho):
     if ho.output_type == 'gmf_scenario':
         out = models.Output.objects.get(output_type='ses', oq_job=ho.oq_job)
         return [out.ses]
+    elif ho.output_type == 'ses':
+        return [ho.ses]
 
     return models.SESCollection.objects.filter(
         trt_model__lt_model=ho.output_container.lt_realization.lt_model)
 
 
+def read_rupture_ids(ses_coll, cache):
+    """
+    :param ses_coll: a :class:`openquake.engine.db.models.SESCollection`
+    :param cache: a dictionary used to read the IDs only once per task
+    :returns: the list of the IDs of the ruptures of the SES collection
+    """
+    try:
+        return cache['rupture_ids', ses_coll.id]
+    except KeyError:
+        rupids = cache['rupture_ids', ses_coll.id] = list(
+            ses_coll.get_ruptures().values_list('id', flat=True))
+        return rupids
+
+
+def get_rupture_ids(ho, cache=None):
+    """
+    :param ho: a hazard output of kind gmf, gmf_scenario or ses
+    :param cache: a dictionary used to read the IDs only once per task
+    :returns: the sorted array of the IDs of the ruptures of the hazard
+              output; the position of a rupture ID in the array is used
+              as rupture ordinal in the event loss tables
+    """
+    cache = {} if cache is None else cache
+    rupids = []
+    for sc in haz_out_to_ses_coll(ho):
+        rupids.extend(read_rupture_ids(sc, cache))
+    return numpy.array(sorted(rupids), dtype=int)
+
+
 class GroundMotionGetter(HazardGetter):
     """
     Hazard getter for loading ground motion values.
     """ + HazardGetter.__doc__
 
-    def __init__(self, imt, taxonomy, hazard_outputs, assets):
+    def __init__(self, imt, taxonomy, hazard_outputs, assets, cache=None,
+                 epsilon_params=None):
         """
         Perform the needed queries on the database to populate
         hazards and epsilons.
         """
-        HazardGetter.__init__(self, imt, taxonomy, hazard_outputs, assets)
-        self.hazards = {}  # dict ho, imt -> {site_id: {rup_id: gmv}}
+        HazardGetter.__init__(
+            self, imt, taxonomy, hazard_outputs, assets, cache,
+            epsilon_params)
         self.rupture_ids = []
         sescolls = set()
         for ho in self.hazard_outputs:
-            self.hazards[ho] = self._get_gmv_dict(ho)
             for sc in haz_out_to_ses_coll(ho):
                 sescolls.add(sc)
-        sescolls = sorted(sescolls)
-        for sc in sescolls:
-            self.rupture_ids.extend(
-                sc.get_ruptures().values_list('id', flat=True))
-        epsilon_rows = []  # ordered by asset_site_id
-        for asset_site_id in self.asset_site_ids:
-            row = []
-            for eps in models.Epsilon.objects.filter(
-                    ses_collection__in=sescolls,
-                    asset_site=asset_site_id):
-                row.extend(eps.epsilons)
-            epsilon_rows.append(row)
-        if epsilon_rows:
-            self.epsilons = numpy.array(epsilon_rows)
+        self._sescolls = sorted(sescolls)
+        self._num_ruptures = []
+        for sc in self._sescolls:
+            rupids = read_rupture_ids(sc, self.cache)
+            self.rupture_ids.extend(rupids)
+            self._num_ruptures.append(len(rupids))
+        # the rupture IDs are sorted to find their column quickly
+        rupids = numpy.array(self.rupture_ids, dtype=int)
+        self._rupid_order = numpy.argsort(rupids)
+        self._sorted_rupids = rupids[self._rupid_order]
+        self.sites = sorted(set(self.site_ids))  # distinct sites
+        self.hazards = {}  # dict ho -> array of shape (S, E)
+        self._no_data = {}  # dict ho -> sites without GMVs
+        for ho in self.hazard_outputs:
+            self.hazards[ho] = self._get_gmv_matrix(ho)
+        self._init_epsilons()
+
+    def get_subset(self, taxonomy, indices):
+        new = HazardGetter.get_subset(self, taxonomy, indices)
+        new._init_epsilons()
+        return new
+    get_subset.__doc__ = HazardGetter.get_subset.__doc__
+
+    def _init_epsilons(self):
+        # regenerate the epsilons of the assets, for each SES collection;
+        # they depend on the taxonomy when there is asset correlation
+        if (self.epsilon_params is not None and self.assets and
+                self.taxonomy is not None):
+            seed, correlation, sampling = self.epsilon_params
+            if any(ho.output_type == 'gmf_scenario'
+                   for ho in self.hazard_outputs):
+                sampling = 0  # there is an epsilon for each GMF
+            asset_refs = [asset.asset_ref for asset in self.assets]
+            self.epsilons = numpy.concatenate(
+                [numpy.zeros((len(asset_refs), 0))] +
+                [make_epsilons(asset_refs,
+                               min(sampling, n) if sampling else n,
+                               seed, correlation, sc.ordinal, self.taxonomy)
+                 for sc, n in zip(self._sescolls, self._num_ruptures)],
+                axis=1)
 
     def get_epsilons(self):
         """
@@ -246,54 +371,171 @@ class GroundMotionGetter(HazardGetter):
             return expand(eps.T, e).T
         return eps
 
-    def _get_gmv_dict(self, ho):
-        # return a nested dictionary site_id -> {rupture_id: gmv}
+    def _rupture_columns(self, rupture_ids):
+        # return the columns of the given ruptures in the GMV matrix,
+        # with -1 for the ruptures not in .rupture_ids
+        cols = numpy.zeros(len(rupture_ids), int) - 1
+        if len(self._sorted_rupids) == 0:
+            return cols
+        rupids = numpy.array(rupture_ids, dtype=int)
+        pos = numpy.searchsorted(self._sorted_rupids, rupids)
+        pos[pos == len(self._sorted_rupids)] = 0
+        ok = self._sorted_rupids[pos] == rupids
+        cols[ok] = self._rupid_order[pos[ok]]
+        return cols
+
+    def _get_gmv_matrix(self, ho):
+        # return a matrix of shape (S, E) where S is the number of distinct
+        # sites and E the number of ruptures; the missing GMVs are zeros
         imt_type, sa_period, sa_damping = from_string(self.imt)
         gmf_id = ho.output_container.id
         if sa_period:
             imt_query = 'imt=%s and sa_period=%s and sa_damping=%s'
         else:
             imt_query = 'imt=%s and sa_period is %s and sa_damping is %s'
-        gmv_dict = {}  # dict site_id -> {rup_id: gmv}
+        matrix = numpy.zeros((len(self.sites), len(self.rupture_ids)))
+        no_data = self._no_data[ho] = set(self.sites)
+        if not self.sites:
+            return matrix
+        row = dict((site_id, i) for i, site_id in enumerate(self.sites))
         cursor = models.getcursor('job_init')
         cursor.execute('select site_id, rupture_ids, gmvs from '
                        'hzrdr.gmf_data where gmf_id=%s and site_id in %s '
-                       'and {} order by site_id'.format(imt_query),
-                       (gmf_id, tuple(set(self.site_ids)),
+                       'and {}'.format(imt_query),
+                       (gmf_id, tuple(self.sites),
                         imt_type, sa_period, sa_damping))
-        for sid, group in itertools.groupby(cursor, operator.itemgetter(0)):
-            gmvs = []
-            ruptures = []
-            for site_id, rupture_ids, gmvs_chunk in group:
-                gmvs.extend(gmvs_chunk)
-                ruptures.extend(rupture_ids)
-            gmv_dict[sid] = dict(itertools.izip(ruptures, gmvs))
-        return gmv_dict
+        for site_id, rupture_ids, gmvs in cursor:
+            no_data.discard(site_id)
+            cols = self._rupture_columns(rupture_ids)
+            ok = cols >= 0
+            matrix[row[site_id], cols[ok]] = numpy.array(gmvs)[ok]
+        return matrix
 
     def _get_data(self, ho):
-        # return a list of N arrays with R elements each
-        all_gmvs = []
-        no_data = 0
-        gmv_dict = self.hazards[ho]
-        for site_id in self.site_ids:
-            gmv = gmv_dict.get(site_id, {})
-            if not gmv:
-                no_data += 1
-            array = numpy.array([gmv.get(r, 0.) for r in self.rupture_ids])
-            all_gmvs.append(array)
+        # return an array of shape (N, E), N being the number of assets
+        # and E the number of ruptures
+        rows = numpy.searchsorted(self.sites, self.site_ids)
+        no_data = sum(1 for site_id in self.site_ids
+                      if site_id in self._no_data[ho])
         if no_data:
             logs.LOG.info('No data for %d assets out of %d, IMT=%s',
                           no_data, len(self.site_ids), self.imt)
-        return all_gmvs
+        return self.hazards[ho][rows]
+
+
+def get_assoc_key(calc, taxonomies):
+    """
+    :param calc: a risk calculator
+    :param taxonomies: the taxonomies of the assets to associate
+    :returns: a SHA1 hex digest of the hazard job, the exposure model,
+              the region constraint, the distance and the taxonomies
+    """
+    return hashlib.sha1(repr((
+        calc.oqparam.hazard_calculation_id, calc.exposure_model.id,
+        calc.oqparam.region_constraint, calc.best_maximum_distance,
+        sorted(taxonomies)))).hexdigest()
+
+
+def closest_sites(site_lons, site_lats, lons, lats, max_dist):
+    """
+    Find the closest site to each point, by using a KD-tree of the sites
+    in 3D cartesian coordinates; the closest point in the chord distance
+    is also the closest point in the great circle distance.
+
+    :param site_lons: the longitudes of the S sites
+    :param site_lats: the latitudes of the S sites
+    :param lons: the longitudes of the N points
+    :param lats: the latitudes of the N points
+    :param max_dist: the maximum distance in km
+    :returns: an array of N indices of the closest sites, with -1 for
+              the points with no sites within the maximum distance
+    """
+    idx = numpy.zeros(len(lons), int) - 1
+    if not len(site_lons) or not len(lons):
+        return idx
+    tree = scipy.spatial.cKDTree(geo_utils.spherical_to_cartesian(
+        site_lons, site_lats, numpy.zeros(len(site_lons))))
+    # the chord is shorter than the arc, so no site is lost
+    _, closest = tree.query(geo_utils.spherical_to_cartesian(
+        lons, lats, numpy.zeros(len(lons))),
+        distance_upper_bound=max_dist)
+    found = closest < len(site_lons)
+    idx[found] = closest[found]
+    # discard the sites which are within the distance only along the chord
+    dist = geodetic.geodetic_distance(
+        lons[found], lats[found],
+        site_lons[idx[found]], site_lats[idx[found]])
+    idx[numpy.where(found)[0][dist > max_dist]] = -1
+    return idx
+
+
+def associate_assets(calc, taxonomies):
+    """
+    Associate the assets of the given taxonomies within the region
+    constraint to the closest hazard site within the best maximum
+    distance and store the associations in the table asset_site.
+    The sites and the assets are read once and the association is
+    computed in memory with a KD-tree. If a previous risk job had the
+    same hazard job, exposure model, region constraint, maximum distance
+    and taxonomies, its associations are copied.
+
+    :param calc: a risk calculator
+    :param taxonomies: the taxonomies of the assets to associate
+    :returns: the number of associations
+    """
+    if not taxonomies:
+        return 0
+    job = calc.job
+    key = get_assoc_key(calc, taxonomies)
+    cursor = models.getcursor('job_init')
+    for param in models.JobParam.objects.filter(
+            name='asset_site_key', value=key).exclude(
+            job=job).order_by('-id'):
+        with transaction.atomic(using='job_init'):
+            cursor.execute(
+                'INSERT INTO riskr.asset_site (job_id, asset_id, site_id) '
+                'SELECT %s, asset_id, site_id FROM riskr.asset_site '
+                'WHERE job_id=%s', (job.id, param.job_id))
+            num_assocs = cursor.rowcount
+        if num_assocs:
+            logs.LOG.info('Copied %d asset->site associations from job %d',
+                          num_assocs, param.job_id)
+            job.save_params(dict(asset_site_key=key))
+            return num_assocs
+
+    cursor.execute(
+        'SELECT id, ST_X(location::geometry), ST_Y(location::geometry) '
+        'FROM hzrdi.hazard_site WHERE hazard_calculation_id=%s',
+        (calc.oqparam.hazard_calculation_id,))
+    sites = numpy.array(cursor.fetchall(), float).reshape(-1, 3)
+    cursor.execute(
+        'SELECT id, ST_X(site::geometry), ST_Y(site::geometry) '
+        'FROM riski.exposure_data WHERE exposure_model_id=%s '
+        'AND taxonomy IN %s '
+        'AND ST_COVERS(ST_GeographyFromText(%s), site)',
+        (calc.exposure_model.id, tuple(taxonomies),
+         calc.oqparam.region_constraint))
+    assets = numpy.array(cursor.fetchall(), float).reshape(-1, 3)
+    idx = closest_sites(sites[:, 1], sites[:, 2], assets[:, 1], assets[:, 2],
+                        calc.best_maximum_distance)
+    ok = idx >= 0
+    assocs = [models.AssetSite(job_id=job.id, asset_id=int(asset_id),
+                               site_id=int(site_id))
+              for asset_id, site_id in zip(assets[ok, 0], sites[idx[ok], 0])]
+    if assocs:
+        writer.CacheInserter.saveall(assocs)
+    logs.LOG.info('Associated %d assets out of %d to %d hazard sites',
+                  len(assocs), len(assets), len(sites))
+    job.save_params(dict(asset_site_key=key))
+    return len(assocs)
 
 
 class RiskInitializer(object):
     """
     A facility providing the brigde between the hazard (sites and outputs)
     and the risk (assets and risk models). When .init_assocs is called,
-    populates the `asset_site` table with the associations between the assets
-    in the current exposure model and the sites in the previous hazard
-    calculation.
+    reads the number of assets of the given taxonomy associated to the
+    sites of the previous hazard calculation by :func:`associate_assets`.
 
     :param hazard_outputs:
         outputs of the previous hazard calculation
@@ -301,9 +543,6 @@ class RiskInitializer(object):
         the taxonomy of the assets we are interested in
     :param calc:
         a risk calculator
-
-    Warning: instantiating a RiskInitializer may perform a potentially
-    expensive geospatial query.
     """
     def __init__(self, taxonomy, calc):
         self.exposure_model = calc.exposure_model
@@ -315,58 +554,15 @@ class RiskInitializer(object):
         self.calculation_mode = self.calc.oqparam.calculation_mode
         self.number_of_ground_motion_fields = self.oqparam.get_param(
             'number_of_ground_motion_fields', 0)
-        max_dist = calc.best_maximum_distance * 1000  # km to meters
-        self.cursor = models.getcursor('job_init')
-
-        hazard_exposure = models.extract_from([self.oqparam], 'exposuremodel')
-        if self.exposure_model and hazard_exposure and \
-           self.exposure_model.id == hazard_exposure.id:
-            # no need of geospatial queries, just join on the location
-            self.assoc_query = self.cursor.mogrify("""\
-WITH assocs AS (
-  SELECT %s, exp.id, hsite.id
-  FROM riski.exposure_data AS exp
-  JOIN hzrdi.hazard_site AS hsite
-  ON exp.site::text = hsite.location::text
-  WHERE hsite.hazard_calculation_id = %s
-  AND exposure_model_id = %s AND taxonomy=%s
-  AND ST_COVERS(ST_GeographyFromText(%s), exp.site)
-)
-INSERT INTO riskr.asset_site (job_id, asset_id, site_id)
-SELECT * FROM assocs""", (self.calc.job.id, self.oqparam.id,
-                          self.exposure_model.id, taxonomy,
-                          self.calc.oqparam.region_constraint))
-        else:
-            # associate each asset to the closest hazard site
-            self.assoc_query = self.cursor.mogrify("""\
-WITH assocs AS (
-  SELECT DISTINCT ON (exp.id) %s, exp.id, hsite.id
-  FROM riski.exposure_data AS exp
-  JOIN hzrdi.hazard_site AS hsite
-  ON ST_DWithin(exp.site, hsite.location, %s)
-  WHERE hsite.hazard_calculation_id = %s
-  AND exposure_model_id = %s AND taxonomy=%s
-  AND ST_COVERS(ST_GeographyFromText(%s), exp.site)
-  ORDER BY exp.id, ST_Distance(exp.site, hsite.location, false)
-)
-INSERT INTO riskr.asset_site (job_id, asset_id, site_id)
-SELECT * FROM assocs""", (self.calc.job.id, max_dist, self.oqparam.id,
-                          self.exposure_model.id, taxonomy,
-                          self.calc.oqparam.region_constraint))
         self.num_assets = 0
-        self._rupture_ids = {}
         self.epsilons_shape = {}
 
     def init_assocs(self):
         """
-        Stores the associations asset <-> site into the database
+        Reads the number of associations asset <-> site for the taxonomy
         """
-        with transaction.atomic(using='job_init'):
-            # insert the associations for the current taxonomy
-            self.cursor.execute(self.assoc_query)
-            # now read the associations just inserted
-            self.num_assets = models.AssetSite.objects.filter(
-                job=self.calc.job, asset__taxonomy=self.taxonomy).count()
+        self.num_assets = models.AssetSite.objects.filter(
+            job=self.calc.job, asset__taxonomy=self.taxonomy).count()
 
         # check if there are no associations
         if self.num_assets == 0:
@@ -402,45 +598,7 @@ SELECT * FROM assocs""", (self.calc.job.id, max_dist, self.oqparam.id,
             self.epsilons_shape[out.ses.id] = (self.num_assets, samples)
         nbytes = 0
         for (n, r) in self.epsilons_shape.values():
-            # the max(n, r) is taken because if n > r then the limiting
-            # factor is the size of the correlation matrix, i.e. n
-            nbytes += max(n, r) * n * BYTES_PER_FLOAT
+            # the epsilons are regenerated by the tasks; the correlation
+            # matrix is never built
+            nbytes += n * r * BYTES_PER_FLOAT
         return nbytes
-
-    def init_epsilons(self, epsilon_sampling=None):
-        """
-        :param epsilon_sampling:
-             flag saying if the epsilon_sampling feature is enabled
-
-        Populate the .epsilons_shape and the ._rupture_ids dictionaries.
-        For the calculators `event_based_risk` and `scenario_risk` also
-        stores the epsilons in the database for each asset_site association.
-        """
-        oq = self.calc.oqparam
-        if not self.epsilons_shape:
-            self.calc_nbytes(epsilon_sampling)
-        if self.calculation_mode.startswith('event_based'):
-            lt_model_ids = set(ho.output_container.lt_realization.lt_model.id
-                               for ho in self.hazard_outputs)
-            ses_collections = models.SESCollection.objects.filter(
-                trt_model__lt_model__in=lt_model_ids)
-        elif self.calculation_mode.startswith('scenario'):
-            [out] = self.oqparam.output_set.filter(output_type='ses')
-            ses_collections = [out.ses]
-        else:
-            ses_collections = []
-        for ses_coll in ses_collections:
-            scid = ses_coll.id  # ses collection id
-            num_assets, num_samples = self.epsilons_shape[scid]
-            self._rupture_ids[scid] = ses_coll.get_ruptures(
-                ).values_list('id', flat=True)
-            # build the epsilons, except for scenario_damage
-            if self.calculation_mode != 'scenario_damage':
-                logs.LOG.info('Building (%d, %d) epsilons for taxonomy %s',
-                              num_assets, num_samples, self.taxonomy)
-                asset_sites = models.AssetSite.objects.filter(
-                    job=self.calc.job, asset__taxonomy=self.taxonomy)
-                eps = make_epsilons(
-                    num_assets, num_samples,
-                    oq.master_seed, oq.asset_correlation)
-                models.Epsilon.saveall(ses_coll, asset_sites, eps)
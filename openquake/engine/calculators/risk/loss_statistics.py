@@ -0,0 +1,206 @@
+# Copyright (c) 2015, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Mean and quantile loss curves and maps across the realizations, computed
+by consuming the outputs one realization at the time. Only the loss curves
+of at most `statistics_buffer` realizations (see the section [risk] of
+openquake.cfg) are kept in memory: up to that number the statistics are
+the same as the ones of
+:meth:`openquake.risklib.workflows.ProbabilisticEventBased.statistics`;
+beyond it the mean curves are accumulated as running weighted sums and
+the quantiles are computed on a random sample of the realizations.
+"""
+import collections
+
+import numpy
+
+from openquake.risklib import scientific
+
+from openquake.engine.calculators.hazard.post_processing import (
+    mean_curves, quantile_curves)
+from openquake.engine.utils import config
+
+DEFAULT_BUFFER_SIZE = 100
+
+StatisticalOutput = collections.namedtuple(
+    'StatisticalOutput',
+    'assets mean_curves mean_average_losses mean_maps '
+    'quantile_curves quantile_average_losses quantile_maps '
+    'mean_insured_curves mean_average_insured_losses '
+    'quantile_insured_curves quantile_average_insured_losses')
+
+
+def get_buffer_size():
+    """
+    :returns: the maximum number of realizations kept in memory
+    """
+    return int(config.get('risk', 'statistics_buffer') or
+               DEFAULT_BUFFER_SIZE)
+
+
+def normalize(losses, poes, ref_losses):
+    """
+    Interpolate the curves of N assets on the reference loss ratios, as
+    :func:`openquake.risklib.scientific.normalize_curves_eb` does; the
+    poes beyond the maximum loss of a curve are zero. If the reference
+    losses of an asset are all zero its poes are not changed.
+
+    :param losses: an array of shape (N, C) with the loss ratios
+    :param poes: an array of shape (N, C) with the poes
+    :param ref_losses: an array of shape (N, C) with the reference losses
+    :returns: an array of shape (N, C) with the interpolated poes
+    """
+    normalized = numpy.zeros_like(ref_losses)
+    for i, (ls, ps, ref) in enumerate(zip(losses, poes, ref_losses)):
+        if ref[-1] == 0:
+            normalized[i] = ps
+        elif ls[-1] > 0:  # the curves with zero losses have zero poes
+            normalized[i] = numpy.interp(ref, ls, ps, right=0)
+    return normalized
+
+
+class LossStatistics(object):
+    """
+    Accumulator of the loss curves of N assets for many realizations.
+
+    :param poes: the probabilities of the conditional loss maps
+    :param quantiles: the quantiles of the loss curves
+    :param buffer_size: the maximum number of realizations in memory
+    :param seed: the seed used to sample the realizations in the buffer
+    """
+    def __init__(self, poes, quantiles, buffer_size=None, seed=42):
+        self.poes = poes
+        self.quantiles = quantiles
+        self.buffer_size = buffer_size or get_buffer_size()
+        self.rng = numpy.random.RandomState(seed)
+        self.num_rlzs = 0
+        self.buffer = []  # triples (weight, losses, poes)
+        self.weighted = True
+        self.ref_losses = None  # loss ratios of the running mean
+        self.sum_poes = None  # weighted sum of the normalized poes
+        self.sum_weights = 0
+
+    def add(self, loss_curves, weight=None):
+        """
+        Add the loss curves of a realization.
+
+        :param loss_curves: an array-like of shape (N, 2, C)
+        :param weight: the weight of the realization, or None if the
+                       realizations have been sampled
+        """
+        curves = numpy.array(loss_curves, dtype=float)
+        losses, poes = curves[:, 0], curves[:, 1]
+        self.weighted = self.weighted and weight is not None
+        self.num_rlzs += 1
+        if self.num_rlzs <= self.buffer_size:
+            self.buffer.append((weight, losses, poes))
+            return
+        elif self.sum_poes is None:  # first time the buffer is full
+            for w, ls, ps in self.buffer:
+                self._accumulate(w, ls, ps)
+        self._accumulate(weight, losses, poes)
+        # reservoir sampling: each realization has the same probability
+        # of being in the buffer, which is used for the quantiles
+        j = self.rng.randint(0, self.num_rlzs)
+        if j < self.buffer_size:
+            self.buffer[j] = (weight, losses, poes)
+
+    def _accumulate(self, weight, losses, poes):
+        # add the normalized poes to the running weighted sum; when
+        # a curve has a bigger maximum loss it becomes the reference
+        # and the sum is interpolated on it
+        weight = 1. if weight is None else weight
+        if self.ref_losses is None:
+            self.ref_losses = losses.copy()
+            self.sum_poes = numpy.zeros_like(poes)
+        bigger = losses[:, -1] > self.ref_losses[:, -1]
+        if bigger.any():
+            self.sum_poes[bigger] = normalize(
+                self.ref_losses[bigger], self.sum_poes[bigger],
+                losses[bigger])
+            self.ref_losses[bigger] = losses[bigger]
+        self.sum_poes += weight * normalize(losses, poes, self.ref_losses)
+        self.sum_weights += weight
+
+    def _normalized_buffer(self):
+        # returns the reference losses and the normalized poes of the
+        # realizations in the buffer, an array of shape (R, N, C)
+        losses = numpy.array([ls for _w, ls, _ps in self.buffer])
+        if self.ref_losses is None:
+            # the reference curve of each asset is the one with the
+            # maximum loss
+            ref = losses[losses[:, :, -1].argmax(axis=0),
+                         numpy.arange(losses.shape[1])]
+        else:  # the buffer is a sample of the realizations
+            ref = self.ref_losses
+        return ref, numpy.array([normalize(ls, ps, ref)
+                                 for _w, ls, ps in self.buffer])
+
+    def _curves_maps(self, losses, poes):
+        # returns the curves, the average losses and the maps
+        curves = [(ls, ps) for ls, ps in zip(losses, poes)]
+        averages = [scientific.average_loss(curve) for curve in curves]
+        maps = [[scientific.conditional_loss_ratio(ls, ps, poe)
+                 for ls, ps in curves] for poe in self.poes]
+        return curves, averages, maps
+
+    def get_stats(self):
+        """
+        :returns:
+            a tuple (mean_curves, mean_average_losses, mean_maps,
+            quantile_curves, quantile_average_losses, quantile_maps)
+        """
+        ref, normalized = self._normalized_buffer()
+        weights = ([w for w, _ls, _ps in self.buffer]
+                   if self.weighted else None)
+        if self.sum_poes is None:
+            mean_poes = mean_curves(normalized, weights)
+        else:
+            mean_poes = self.sum_poes / self.sum_weights
+            if weights is not None:  # the sampled weights are normalized
+                weights = numpy.array(weights) / numpy.sum(weights)
+        means, mean_averages, mean_maps = self._curves_maps(
+            ref, mean_poes)
+        q_curves, q_averages, q_maps = [], [], []
+        for q in self.quantiles:
+            curves, averages, maps = self._curves_maps(
+                ref, quantile_curves(normalized, q, weights))
+            q_curves.append(curves)
+            q_averages.append(averages)
+            q_maps.append(maps)
+        return (means, mean_averages, mean_maps,
+                q_curves, q_averages, q_maps)
+
+
+def get_statistical_output(assets, stats, insured_stats):
+    """
+    :param assets: the assets of the loss curves
+    :param stats: the :class:`LossStatistics` of the ground-up losses
+    :param insured_stats: the :class:`LossStatistics` of the insured losses
+    :returns: a :class:`StatisticalOutput` instance
+    """
+    (mean_curves_, mean_averages, mean_maps,
+     q_curves, q_averages, q_maps) = stats.get_stats()
+    if insured_stats.num_rlzs:
+        (mean_insured, mean_insured_averages, _maps,
+         q_insured, q_insured_averages, _qmaps) = insured_stats.get_stats()
+    else:
+        mean_insured = mean_insured_averages = None
+        q_insured = q_insured_averages = None
+    return StatisticalOutput(
+        assets, mean_curves_, mean_averages, mean_maps,
+        q_curves, q_averages, q_maps, mean_insured, mean_insured_averages,
+        q_insured, q_insured_averages)
@@ -90,6 +90,7 @@ class ScenarioDamageRiskCalculator(base.RiskCalculator):
     # FIXME. scenario damage calculator does not use output builders
     output_builders = []
     getter_class = hazard_getters.GroundMotionGetter
+    epsilon_params = None  # the damage does not depend on the epsilons
 
     def __init__(self, job):
         super(ScenarioDamageRiskCalculator, self).__init__(job)
@@ -15,12 +15,78 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
-"""DB writing functionality for Risk calculators."""
+"""
+DB writing functionality for Risk calculators. The outputs per asset
+are not saved one by one: they are added to a :class:`CacheInserter`
+per table, shared by all the writers of a task, and saved with a COPY
+FROM when the cache is full or when :func:`flush` is called at the end
+of the task. If the task fails the cached outputs are thrown away by
+:func:`discard`, so that they are never saved by the next task running
+in the same process, which may belong to another job.
+"""
 
 import collections
 import itertools
+import numpy
 from openquake.risklib import scientific
 from openquake.engine.db import models
+from openquake.engine.writer import CacheInserter
+
+# max number of rows in the cache of each table
+CACHE_SIZE = 10000
+
+# Django model -> CacheInserter, shared by the writers of a task
+_inserters = {}
+
+
+def save(objects):
+    """
+    Add the given Django objects to the cache of their table; they are
+    saved on the database when the cache is full or when :func:`flush`
+    is called.
+
+    :param objects: a list of Django objects
+    """
+    for obj in objects:
+        model = obj.__class__
+        try:
+            inserter = _inserters[model]
+        except KeyError:
+            inserter = _inserters[model] = CacheInserter(model, CACHE_SIZE)
+        inserter.add(obj)
+
+
+def flush():
+    """
+    Save on the database all the outputs added to the caches.
+    """
+    for inserter in _inserters.itervalues():
+        inserter.flush()
+
+
+def discard():
+    """
+    Throw away the outputs added to the caches and not saved yet,
+    and remove the caches.
+    """
+    for inserter in _inserters.itervalues():
+        inserter.discard()
+    _inserters.clear()
+
+
+def asset_values(assets, loss_type):
+    """
+    :param assets: a list of N ExposureData instances
+    :param str loss_type: a loss type
+    :returns: an array of N asset values; missing values are zero
+    """
+    return numpy.array([asset.value(loss_type) or 0 for asset in assets],
+                       float)
+
+
+def _take(values, n):
+    # the first n values of a sequence or iterator, as a float array
+    return numpy.array(list(itertools.islice(values, n)), float)
 
 
 def loss_map(
@@ -39,26 +105,22 @@ def loss_map(
     :param absolute:
         False if the provided losses are loss ratios
     """
+    losses = _take(losses, len(assets))
+    if std_devs is not None:
+        std_devs = _take(std_devs, len(assets))
 
-    for i, asset in enumerate(assets):
-        loss = losses[i]
+    if not absolute:
+        values = asset_values(assets, loss_type)
+        losses *= values
         if std_devs is not None:
-            std_dev = std_devs[i]
-        else:
-            std_dev = None
-
-        if not absolute:
-            value = asset.value(loss_type) or 0
-            loss *= value
-            if std_devs is not None:
-                std_dev *= value
+            std_devs *= values
 
-        models.LossMapData.objects.create(
-            loss_map_id=loss_map_id,
-            asset_ref=asset.asset_ref,
-            value=loss,
-            std_dev=std_dev,
-            location=asset.site)
+    save([models.LossMapData(
+        loss_map_id=loss_map_id,
+        asset_ref=asset.asset_ref,
+        value=losses[i],
+        std_dev=None if std_devs is None else std_devs[i],
+        location=asset.site) for i, asset in enumerate(assets)])
 
 
 def bcr_distribution(loss_type, bcr_distribution_id, assets, bcr_data):
@@ -79,15 +141,17 @@ def bcr_distribution(loss_type, bcr_distribution_id, assets, bcr_data):
       2) eal_retrofitted: expected annual loss in the retrofitted model
       3) bcr: Benefit Cost Ratio parameter.
     """
-    for asset, (eal_original, eal_retrofitted, bcr) in zip(assets, bcr_data):
-        models.BCRDistributionData.objects.create(
-            bcr_distribution_id=bcr_distribution_id,
-            asset_ref=asset.asset_ref,
-            average_annual_loss_original=eal_original * asset.value(loss_type),
-            average_annual_loss_retrofitted=(eal_retrofitted *
-                                             asset.value(loss_type)),
-            bcr=bcr,
-            location=asset.site)
+    bcr_data = _take(bcr_data, len(assets)).reshape(-1, 3)
+    values = asset_values(assets, loss_type)
+    eal_original = bcr_data[:, 0] * values
+    eal_retrofitted = bcr_data[:, 1] * values
+    save([models.BCRDistributionData(
+        bcr_distribution_id=bcr_distribution_id,
+        asset_ref=asset.asset_ref,
+        average_annual_loss_original=eal_original[i],
+        average_annual_loss_retrofitted=eal_retrofitted[i],
+        bcr=bcr_data[i, 2],
+        location=asset.site) for i, asset in enumerate(assets)])
 
 
 def loss_curve(loss_type, loss_curve_id, assets, curve_data):
@@ -108,19 +172,9 @@ def loss_curve(loss_type, loss_curve_id, assets, curve_data):
         A tuple of the form (curves, averages) holding a numpy array with N
         loss curve data and N average loss value associated with the curve
     """
-
     curves, averages = curve_data
-    for asset, (losses, poes), average in itertools.izip(
-            assets, curves, averages):
-        models.LossCurveData.objects.create(
-            loss_curve_id=loss_curve_id,
-            asset_ref=asset.asset_ref,
-            location=asset.site,
-            poes=poes,
-            loss_ratios=losses,
-            asset_value=asset.value(loss_type),
-            average_loss_ratio=average,
-            stddev_loss_ratio=None)
+    _loss_curve_data(loss_type, loss_curve_id, assets, curves, averages,
+                     itertools.repeat(None))
 
 
 def event_loss_curve(loss_type, loss_curve_id, assets, curve_data):
@@ -141,19 +195,26 @@ def event_loss_curve(loss_type, loss_curve_id, assets, curve_data):
         A tuple of the form (curves, averages, stddevs) holding a numpy array
         loss curve data and N average loss value associated with the curve
     """
-
     curves, averages, stddevs = curve_data
-    for asset, (losses, poes), average, stddev in itertools.izip(
-            assets, curves, averages, stddevs):
-        models.LossCurveData.objects.create(
-            loss_curve_id=loss_curve_id,
-            asset_ref=asset.asset_ref,
-            location=asset.site,
-            poes=poes,
-            loss_ratios=losses,
-            asset_value=asset.value(loss_type),
-            average_loss_ratio=average,
-            stddev_loss_ratio=stddev)
+    _loss_curve_data(loss_type, loss_curve_id, assets, curves, averages,
+                     stddevs)
+
+
+def _loss_curve_data(loss_type, loss_curve_id, assets, curves, averages,
+                     stddevs):
+    # save the loss curves of the given assets
+    values = asset_values(assets, loss_type)
+    save([models.LossCurveData(
+        loss_curve_id=loss_curve_id,
+        asset_ref=asset.asset_ref,
+        location=asset.site,
+        poes=list(poes),
+        loss_ratios=list(losses),
+        asset_value=value,
+        average_loss_ratio=average,
+        stddev_loss_ratio=stddev)
+        for asset, value, (losses, poes), average, stddev in itertools.izip(
+            assets, values, curves, averages, stddevs)])
 
 
 def loss_fraction(loss_type, loss_fraction_id, assets, values, fractions):
@@ -171,12 +232,15 @@ def loss_fraction(loss_type, loss_fraction_id, assets, values, fractions):
     :param absolute_losses:
        the absolute loss contributions of `values` in `assets`
     """
-    for asset, value, fraction in itertools.izip(assets, values, fractions):
-        models.LossFractionData.objects.create(
-            loss_fraction_id=loss_fraction_id,
-            value=value,
-            location=asset.site,
-            absolute_loss=fraction * asset.value(loss_type))
+    absolute_losses = _take(fractions, len(assets)) * asset_values(
+        assets, loss_type)
+    save([models.LossFractionData(
+        loss_fraction_id=loss_fraction_id,
+        value=value,
+        location=asset.site,
+        absolute_loss=absolute_loss)
+        for asset, value, absolute_loss in itertools.izip(
+            assets, values, absolute_losses)])
 
 
 ###
@@ -194,14 +258,17 @@ def damage_distribution(assets, fraction_matrix, dmg_state_ids):
        a list of  IDs of instances of
        :class:`openquake.engine.db.models.DmgState` ordered by `lsi`
     """
+    units = numpy.array([asset.number_of_units for asset in assets], float)
+    fraction_matrix = _take(fraction_matrix, len(assets))
+    # multiply the fractions of each asset by its number of units
+    fraction_matrix *= units.reshape(
+        (-1,) + (1,) * (fraction_matrix.ndim - 1))
     for fractions, asset in zip(fraction_matrix, assets):
-        fractions *= asset.number_of_units
         means, stds = scientific.mean_std(fractions)
-
-        for mean, std, dmg_state_id in zip(means, stds, dmg_state_ids):
-            models.DmgDistPerAsset.objects.create(
-                dmg_state_id=dmg_state_id,
-                mean=mean, stddev=std, exposure_data=asset)
+        save([models.DmgDistPerAsset(
+            dmg_state_id=dmg_state_id,
+            mean=mean, stddev=std, exposure_data_id=asset.id)
+            for mean, std, dmg_state_id in zip(means, stds, dmg_state_ids)])
 
 
 def damage_distribution_per_taxonomy(fractions, dmg_state_ids, taxonomy):
@@ -251,13 +318,13 @@ def classical_damage(assets, fraction_matrix, dmg_state_ids, damage_id):
     :param damage_id:
        ID of a :class:`openquake.engine.db.models.Damage` instance
     """
-    for fractions, asset in zip(fraction_matrix, assets):
-        for fraction, dmg_state_id in zip(fractions, dmg_state_ids):
-            models.DamageData.objects.create(
-                damage_id=damage_id,
-                dmg_state_id=dmg_state_id,
-                exposure_data=asset,
-                fraction=fraction)
+    save([models.DamageData(
+        damage_id=damage_id,
+        dmg_state_id=dmg_state_id,
+        exposure_data_id=asset.id,
+        fraction=fraction)
+        for fractions, asset in zip(fraction_matrix, assets)
+        for fraction, dmg_state_id in zip(fractions, dmg_state_ids)])
 
 
 # A namedtuple that identifies an Output object in a risk calculation
@@ -0,0 +1,241 @@
+# Copyright (c) 2010-2014, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A per-job store of numpy arrays, used as an alternative to the database
+for the bulk numeric outputs of a calculation. The database keeps only
+the metadata (i.e. the Output and HazardCurve records) while the arrays
+are saved in binary format, so that there is no conversion of the floats
+into strings and back. The backend is set with the parameter `backend`
+in the section [datastore] of openquake.cfg; the possible values are
+
+- `db` (the default): do not use the datastore
+- `npy`: save each array in a .npy file, which is read with memory mapping
+- `hdf5`: save each array in a chunked, compressed HDF5 dataset
+  (requires h5py)
+"""
+import os
+import shutil
+
+import numpy
+
+from openquake.engine.utils import config
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+DEFAULT_DATADIR = '~/oqdata'
+
+
+class DataStore(object):
+    """
+    Abstract base class for the datastores. The keys are strings like
+    `'hcurves/42/poes'` and the values are numpy arrays. The subclasses
+    must implement `__getitem__`, `__setitem__`, `__delitem__` and
+    `keys`.
+
+    :param calc_id: the ID of the calculation owning the datastore
+    :param datadir: the directory containing the datastores of all the
+                    calculations (by default `datadir` in openquake.cfg)
+    """
+    backend = None
+
+    def __init__(self, calc_id, datadir=None):
+        self.calc_id = calc_id
+        self.datadir = os.path.expanduser(datadir or config.get(
+            'datastore', 'datadir') or DEFAULT_DATADIR)
+        self.calc_dir = os.path.join(self.datadir, 'calc_%d' % calc_id)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def clear(self):
+        """Remove all the data of the calculation"""
+        if os.path.exists(self.calc_dir):
+            shutil.rmtree(self.calc_dir)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.calc_dir)
+
+
+class NpyDataStore(DataStore):
+    """
+    A datastore saving each array in a .npy file inside the directory
+    `<datadir>/calc_<calc_id>`; the slashes in the keys are mapped into
+    subdirectories. The arrays are returned as read-only memory maps, so
+    that reading a few rows of a large array is cheap.
+    """
+    backend = 'npy'
+
+    def _path(self, key):
+        return os.path.join(self.calc_dir, *key.split('/')) + '.npy'
+
+    def __getitem__(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            raise KeyError(key)
+        return numpy.load(path, mmap_mode='r')
+
+    def __setitem__(self, key, array):
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        numpy.save(path, numpy.asarray(array))
+
+    def __delitem__(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            raise KeyError(key)
+        os.remove(path)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def keys(self):
+        """The keys of the stored arrays, in sorted order"""
+        keys = []
+        for dirpath, _dirnames, fnames in os.walk(self.calc_dir):
+            relpath = os.path.relpath(dirpath, self.calc_dir)
+            for fname in fnames:
+                if fname.endswith('.npy'):
+                    parts = [] if relpath == '.' else relpath.split(os.sep)
+                    keys.append('/'.join(parts + [fname[:-4]]))
+        return sorted(keys)
+
+
+class Hdf5DataStore(DataStore):
+    """
+    A datastore saving each array in a chunked, gzip-compressed dataset
+    of the HDF5 file `<datadir>/calc_<calc_id>/output.hdf5`. The arrays
+    are returned as h5py datasets, which can be sliced without reading
+    the full array.
+    """
+    backend = 'hdf5'
+
+    def __init__(self, calc_id, datadir=None):
+        if h5py is None:
+            raise ImportError('The hdf5 datastore requires h5py')
+        super(Hdf5DataStore, self).__init__(calc_id, datadir)
+        self.path = os.path.join(self.calc_dir, 'output.hdf5')
+        self._file = None
+
+    def _open(self, mode):
+        if self._file is not None and (mode == 'r' or
+                                       self._file.mode != 'r'):
+            return self._file
+        self.close()
+        if mode != 'r' and not os.path.exists(self.calc_dir):
+            os.makedirs(self.calc_dir)
+        self._file = h5py.File(self.path, mode)
+        return self._file
+
+    def close(self):
+        """Close the underlying HDF5 file, if open"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __getitem__(self, key):
+        if not os.path.exists(self.path):
+            raise KeyError(key)
+        return self._open('r')[key]
+
+    def __setitem__(self, key, array):
+        array = numpy.asarray(array)
+        f = self._open('a')
+        if key in f:
+            del f[key]
+        if array.ndim:
+            f.create_dataset(key, data=array, chunks=True,
+                             compression='gzip', shuffle=True)
+        else:  # scalars cannot be chunked
+            f.create_dataset(key, data=array)
+
+    def __delitem__(self, key):
+        del self._open('a')[key]
+
+    def keys(self):
+        """The keys of the stored arrays, in sorted order"""
+        if not os.path.exists(self.path):
+            return []
+        keys = []
+        self._open('r').visititems(
+            lambda name, obj: keys.append(name)
+            if isinstance(obj, h5py.Dataset) else None)
+        return sorted(keys)
+
+    def clear(self):
+        self.close()
+        super(Hdf5DataStore, self).clear()
+
+
+BACKENDS = {'npy': NpyDataStore, 'hdf5': Hdf5DataStore}
+
+
+def get_backend():
+    """
+    :returns:
+        the name of the datastore backend set in openquake.cfg,
+        or None if the data are stored in the database
+    """
+    backend = config.get('datastore', 'backend') or 'db'
+    if backend == 'db':
+        return None
+    elif backend not in BACKENDS:
+        raise ValueError('Unknown datastore backend %r; it should be one '
+                         'of db, %s' % (backend, ', '.join(sorted(BACKENDS))))
+    return backend
+
+
+def read(job):
+    """
+    :param job: an :class:`openquake.engine.db.models.OqJob` instance
+    :returns:
+        the datastore of the given job, or None if the job saved
+        its outputs in the database
+    """
+    backend = job.get_param('datastore', None)
+    if backend is None:
+        return None
+    return BACKENDS[backend](job.id, job.get_param('datadir', None))
+
+
+def create(job):
+    """
+    Create the datastore of the given job, if a backend is set in
+    openquake.cfg, and record it in the job parameters, so that
+    the readers can find it even if the configuration changes.
+
+    :param job: an :class:`openquake.engine.db.models.OqJob` instance
+    :returns: a :class:`DataStore` instance or None
+    """
+    dstore = read(job)
+    if dstore is not None:  # already created
+        return dstore
+    backend = get_backend()
+    if backend is None:
+        return None
+    dstore = BACKENDS[backend](job.id)
+    job.save_params(dict(datastore=backend, datadir=dstore.datadir))
+    return dstore
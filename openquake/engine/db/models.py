@@ -49,7 +49,7 @@ from openquake.commonlib.oqvalidation import OqParam
 from openquake.commonlib import logictree, valid
 
 from openquake.engine.db import fields
-from openquake.engine import writer, logs, utils
+from openquake.engine import writer, logs, utils, datastore
 
 #: Kind of supported curve statistics
 STAT_CHOICES = (
@@ -222,6 +222,37 @@ def build_curves(rlz, curves_by_trt_model_gsim):
     return curves
 
 
+def get_indep_curves(job, imt_str, site_ids):
+    """
+    Read the independent curves stored in the table `hzrdr.indep_curve_data`
+    for the given job, IMT and sites.
+
+    :param job: an :class:`OqJob` instance
+    :param imt_str: a string specifying the IMT
+    :param site_ids: a sequence of N HazardSite IDs
+    :returns: a dictionary (trt_model_id, gsim) -> array of shape (N, L)
+    """
+    imt_type, sa_period, sa_damping = from_string(imt_str)
+    # the same site can appear more than once, i.e. when several
+    # assets are associated to it
+    uniq = sorted(set(site_ids))
+    idx = dict((site_id, i) for i, site_id in enumerate(uniq))
+    data = IndepCurveData.objects.filter(
+        trt_model__lt_model__hazard_calculation=job, imt=imt_type,
+        sa_period=sa_period, sa_damping=sa_damping, site__in=uniq
+    ).values_list('trt_model', 'gsim', 'site', 'poes')
+    acc = {}
+    for trt_model_id, gsim, site_id, poes in data.iterator():
+        try:
+            array = acc[trt_model_id, gsim]
+        except KeyError:
+            array = acc[trt_model_id, gsim] = numpy.zeros(
+                (len(uniq), len(poes)))
+        array[idx[site_id]] = poes
+    rows = [idx[site_id] for site_id in site_ids]
+    return dict((key, array[rows]) for key, array in acc.iteritems())
+
+
 # Tables in the 'hzrdi' (Hazard Input) schema.
 
 class SiteModel(djm.Model):
@@ -317,7 +348,7 @@ class OqJob(djm.Model):
             em = ExposureModel.objects.get(job=self)
         except ObjectDoesNotExist:
             # return the exposure associated to the previous hazard job
-            hc_id = self.get_param('hazard_calculation_id')
+            hc_id = self.get_param('hazard_calculation_id', None)
             em = ExposureModel.objects.get(
                 job=self.__class__.objects.get(pk=hc_id))
         return em
@@ -396,7 +427,7 @@ class OqJob(djm.Model):
         assert self.job_type == 'hazard', self.job_type
         oqparam = self.get_oqparam()
         if 'exposure' in oqparam.inputs:
-            assets = self.exposuremodel.exposuredata_set.all()
+            assets = self.exposure_model.exposuredata_set.all()
             # the coords here must be sorted; the issue is that the
             # disaggregation calculator has a for loop of kind
             # for site in sites:
@@ -836,6 +867,89 @@ class HazardCurve(djm.Model):
             else:
                 return self.imt
 
+    def _get_storage(self):
+        # returns a pair (independent, dstore); the lookup is done only
+        # once, since it reads the job parameters and the filesystem
+        try:
+            return self._storage
+        except AttributeError:
+            pass
+        independent, dstore = False, None
+        if self.lt_realization_id and self.imt:  # curves by realization
+            job = self.output.oq_job
+            independent = job.get_param('independent_curves', False)
+            if not independent:
+                dstore = datastore.read(job)
+            if dstore is not None and (
+                    'hcurves/%d/poes' % self.id not in dstore):
+                raise IOError(
+                    'The hazard curves %d of job %d were saved in %s, but '
+                    'they cannot be found there: the datadir must be on '
+                    'a storage shared with every worker' % (
+                        self.id, job.id, dstore.calc_dir))
+        self._storage = independent, dstore
+        return self._storage
+
+    @property
+    def datastore(self):
+        """
+        The datastore of the job, if the curve is stored there, else None.
+
+        :raises IOError:
+            if the job saved the curve in a datastore which is missing
+            or does not contain it
+        """
+        return self._get_storage()[1]
+
+    @property
+    def is_lazy(self):
+        """
+        True if the HazardCurveData of the curve are not stored, since
+        they are read from the datastore or they can be composed on-the-fly
+        from the independent curves (see :meth:`build_data`).
+        """
+        independent, dstore = self._get_storage()
+        return bool(independent) or dstore is not None
+
+    def build_data(self, site_ids):
+        """
+        Read the hazard curves from the datastore, if they are stored there,
+        otherwise compose the hazard curves of the underlying realization
+        and IMT from the independent curves stored in
+        `hzrdr.indep_curve_data`.
+
+        :param site_ids: a sequence of N HazardSite IDs
+        :returns: an array of shape (N, L)
+        """
+        dstore = self.datastore
+        if dstore is not None:
+            return self._read_data(dstore, site_ids)
+        imt_str = 'SA(%s)' % self.sa_period if self.imt == 'SA' else self.imt
+        acc = get_indep_curves(self.output.oq_job, imt_str, site_ids)
+        return numpy.zeros((len(site_ids), len(self.imls))) + build_curves(
+            self.lt_realization, acc)
+
+    def _read_data(self, dstore, site_ids):
+        # read from the datastore only the rows of the given sites;
+        # the sites without a stored curve get a curve of zeros
+        sids = numpy.asarray(dstore['hcurves/%d/sids' % self.id])
+        site_ids = numpy.array(site_ids, dtype=sids.dtype)
+        data = numpy.zeros((len(site_ids), len(self.imls)))
+        if not len(sids):
+            return data
+        order = numpy.argsort(sids)
+        pos = numpy.searchsorted(sids, site_ids, sorter=order)
+        pos[pos == len(sids)] = 0
+        rows = order[pos]
+        found = sids[rows] == site_ids
+        uniq, inv = numpy.unique(rows[found], return_inverse=True)
+        if len(uniq):
+            # the rows are read in increasing order, which is efficient
+            # both for memory maps and for HDF5 datasets
+            data[found] = dstore['hcurves/%d/poes' % self.id][
+                list(uniq)][inv]
+        return data
+
     def __iter__(self):
         assert self.output.output_type == 'hazard_curve_multi'
 
@@ -907,6 +1021,25 @@ class HazardCurveDataManager(djm.GeoManager):
             .values_list('x', 'y', 'poes')\
             .iterator()
 
+    def curves_for(self, hc, order_by='id'):
+        """
+        Return the (x, y, poes) triples associated to the given HazardCurve,
+        as in :meth:`all_curves_simple`. If the curve is lazy the triples
+        are composed on-the-fly and they are ordered by site ID.
+
+        :param hc: a :class:`HazardCurve` instance
+        :param str order_by: field by which to order the stored curves
+        """
+        if not hc.is_lazy:
+            return self.all_curves_simple(
+                filter_args=dict(hazard_curve=hc.id), order_by=order_by)
+        sites = HazardSite.objects.filter(
+            hazard_calculation=hc.output.oq_job).order_by('id')
+        site_ids = [site.id for site in sites]
+        curves = hc.build_data(site_ids)
+        return ((site.location.x, site.location.y, list(poes))
+                for site, poes in zip(sites, curves))
+
 
 class HazardCurveData(djm.Model):
     '''
@@ -927,6 +1060,24 @@ class HazardCurveData(djm.Model):
         db_table = 'hzrdr\".\"hazard_curve_data'
 
 
+class IndepCurveData(djm.Model):
+    """
+    Hazard curves for a given TrtModel, GSIM, IMT and site. They are
+    called independent since the curves of all the realizations can be
+    composed from them, see :func:`build_curves`.
+    """
+    trt_model = djm.ForeignKey('TrtModel')
+    gsim = djm.TextField(null=False)
+    imt = djm.TextField(choices=IMT_CHOICES)
+    sa_period = djm.FloatField(null=True)
+    sa_damping = djm.FloatField(null=True)
+    poes = fields.FloatArrayField()
+    site = djm.ForeignKey('HazardSite')
+
+    class Meta:
+        db_table = 'hzrdr\".\"indep_curve_data'
+
+
 class SESCollection(djm.Model):
     """
     Stochastic Event Set Collection: A container for 1 or more Stochastic Event
@@ -1128,12 +1279,23 @@ class ProbabilisticRupture(djm.Model):
         :param site_indices:
             an array of indices for the site_collection
         """
+        prob_rup = cls.build(rupture, ses_collection, site_indices)
+        prob_rup.save()
+        return prob_rup
+
+    @classmethod
+    def build(cls, rupture, ses_collection, site_indices=None):
+        """
+        Build a ProbabilisticRupture object without saving it, so that
+        many ruptures can be saved together with
+        :meth:`openquake.engine.writer.CacheInserter.saveall`.
+        The parameters are the same as in :meth:`create`.
+        """
         iffs = isinstance(rupture.surface,
                           (geo.ComplexFaultSurface, geo.SimpleFaultSurface))
         ims = isinstance(rupture.surface, geo.MultiSurface)
-        lons, lats, depths = get_geom(rupture.surface, iffs, ims)
         hp = rupture.hypocenter
-        return cls.objects.create(
+        return cls(
             ses_collection=ses_collection,
             magnitude=rupture.mag,
             rake=rupture.rake,
@@ -2686,14 +2848,15 @@ class AssetManager(djm.GeoManager):
            occupants value for the risk calculation given in input and the cost
            for each cost type considered in `rc`
         """
-        assocs = sorted(assocs, key=lambda assoc: assoc.asset.id)
-        asset_ids = tuple(assoc.asset.id for assoc in assocs)
+        assocs = sorted(assocs, key=lambda assoc: assoc.asset_id)
+        asset_ids = tuple(assoc.asset_id for assoc in assocs)
         query, args = self._get_asset_chunk_query_args(
             exposure_model, time_event, asset_ids)
         annotated_assets = list(self.raw(query, args))
-        # add asset_site_id attribute to each asset
+        # add asset_site_id and hazard_site_id attributes to each asset
         for ass, assoc in zip(annotated_assets, assocs):
             ass.asset_site_id = assoc.id
+            ass.hazard_site_id = assoc.site_id
         return annotated_assets
 
     def _get_asset_chunk_query_args(
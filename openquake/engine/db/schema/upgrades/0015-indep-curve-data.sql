@@ -0,0 +1,25 @@
+-- Independent hazard curves, one per TrtModel, GSIM, IMT and site
+CREATE TABLE hzrdr.indep_curve_data (
+    id SERIAL PRIMARY KEY,
+    trt_model_id INTEGER NOT NULL REFERENCES hzrdr.trt_model (id)
+                                  ON DELETE CASCADE,
+    gsim TEXT NOT NULL,
+    imt VARCHAR NOT NULL,
+    sa_period float,
+    sa_damping float,
+    poes FLOAT[] NOT NULL,
+    site_id INTEGER NOT NULL REFERENCES hzrdi.hazard_site (id)
+                             ON DELETE CASCADE
+) TABLESPACE hzrdr_ts;
+
+CREATE INDEX hzrdr_indep_curve_data_trt_model_id_idx
+ON hzrdr.indep_curve_data(trt_model_id);
+
+GRANT SELECT,INSERT ON hzrdr.indep_curve_data TO oq_job_init;
+GRANT USAGE ON hzrdr.indep_curve_data_id_seq TO oq_job_init;
+
+COMMENT ON TABLE hzrdr.indep_curve_data IS 'Hazard curves by TrtModel and GSIM, from which the curves of each realization are composed';
+COMMENT ON COLUMN hzrdr.indep_curve_data.trt_model_id IS 'trt_model (id)';
+COMMENT ON COLUMN hzrdr.indep_curve_data.gsim IS 'The name of the GSIM class';
+COMMENT ON COLUMN hzrdr.indep_curve_data.poes IS 'Probabilities of exceedence';
+COMMENT ON COLUMN hzrdr.indep_curve_data.site_id IS 'hazard_site (id)';
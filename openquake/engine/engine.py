@@ -33,9 +33,9 @@ import openquake.engine
 from django.core import exceptions
 from django import db as django_db
 
-from openquake.engine import logs
+from openquake.engine import logs, datastore
 from openquake.engine.db import models
-from openquake.engine.utils import config
+from openquake.engine.utils import config, tasks
 from openquake.engine.celery_node_monitor import CeleryNodeMonitor
 from openquake.engine.writer import CacheInserter
 from openquake.engine.settings import DATABASES
@@ -88,6 +88,7 @@ def cleanup_after_job(job, terminate):
     for tid in task_ids:
         celery.task.control.revoke(tid, terminate=terminate)
         logs.LOG.debug('Revoked task %s', tid)
+    tasks.clear_broadcast(job.id)
 
 
 @contextmanager
@@ -270,8 +271,11 @@ def del_calc(job_id):
         # directly because Django is so stupid that it reads from the database
         # all the records to delete before deleting them: thus, it runs out
         # of memory for large calculations
+        dstore = datastore.read(job)
         curs = models.getcursor('admin')
         curs.execute('DELETE FROM uiapi.oq_job WHERE id=%s', (job_id,))
+        if dstore is not None:
+            dstore.clear()
     else:
         # this doesn't belong to the current user
         raise RuntimeError(UNABLE_TO_DEL_HC_FMT % 'Access denied')
@@ -193,8 +193,7 @@ def export_hazard_curve_csv(key, output, target):
     """
     data = []
     for hc in models.HazardCurve.objects.filter(output=output.id):
-        x_y_poes = models.HazardCurveData.objects.all_curves_simple(
-            filter_args=dict(hazard_curve=hc.id))
+        x_y_poes = models.HazardCurveData.objects.curves_for(hc)
         data.extend(x_y_poes)
     haz_calc_id = output.oq_job.id
     dest = _get_result_export_dest(haz_calc_id, target, hc, file_ext='csv')
@@ -252,9 +251,7 @@ def _curve_metadata(hc, target):
 
 
 def _curve_data(hc):
-    curves = models.HazardCurveData.objects.all_curves_simple(
-        filter_args=dict(hazard_curve=hc.id)
-    )
+    curves = models.HazardCurveData.objects.curves_for(hc)
     # Simple object wrapper around the values, to match the interface of the
     # XML writer:
     Location = namedtuple('Location', 'x y')
@@ -18,13 +18,84 @@
 
 """
 Serializer and related functions to save exposure data to the database.
+The assets are saved in blocks with a COPY FROM, together with their
+costs and occupancies. An exposure file which was already imported
+(i.e. with the same SHA1 digest and the same `ignore_missing_costs`)
+is not imported again: the existing exposure model is reused.
 """
+import hashlib
+import itertools
 
+from django.contrib.gis.geos.point import Point
+
+from openquake.commonlib import risk_parsers
+
+from openquake.engine import writer
 from openquake.engine.db import models
 from openquake.engine.logs import LOG
 from django.db import router
 from django.db import transaction
 
+# number of assets parsed and saved together
+EXPOSURE_BLOCK_SIZE = 10000
+
+
+def get_exposure_sha1(fname, ignore_missing_costs=()):
+    """
+    :param fname: the path of an exposure file
+    :param ignore_missing_costs: the cost types which can be missing
+    :returns: a SHA1 hex digest of the file content and of the
+              parameters affecting the import
+    """
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            sha1.update(block)
+    sha1.update('ignore_missing_costs=%r' % sorted(ignore_missing_costs))
+    return sha1.hexdigest()
+
+
+def get_exposure_model(sha1):
+    """
+    :param sha1: the SHA1 digest of an exposure file
+    :returns: the most recent ExposureModel imported from a file with
+              the given digest, or None
+    """
+    params = models.JobParam.objects.filter(
+        name='exposure_sha1', value=sha1).order_by('-id')
+    for param in params:
+        try:
+            return models.ExposureModel.objects.get(job=param.job_id)
+        except models.ObjectDoesNotExist:
+            # the exposure of the job was reused from another job
+            continue
+
+
+def import_exposure(job, fname):
+    """
+    Import the exposure file in the database, unless an exposure with
+    the same content was already imported; in that case the existing
+    exposure model is associated to the job with the parameter
+    `preloaded_exposure_model_id`.
+
+    :param job: an :class:`openquake.engine.db.models.OqJob` instance
+    :param fname: the path of the exposure file
+    :returns: an :class:`openquake.engine.db.models.ExposureModel`
+    """
+    sha1 = get_exposure_sha1(
+        fname, job.get_param('ignore_missing_costs', []))
+    exposure_model = get_exposure_model(sha1)
+    if exposure_model is not None:
+        LOG.info('Reusing the exposure model #%d, imported from %s',
+                 exposure_model.id, fname)
+        job.save_params(dict(exposure_sha1=sha1,
+                             preloaded_exposure_model_id=exposure_model.id))
+        return exposure_model
+    exposure_model = ExposureDBWriter(job).serialize(
+        risk_parsers.ExposureModelParser(fname))
+    job.save_params(dict(exposure_sha1=sha1))
+    return exposure_model
+
 
 class ExposureDBWriter(object):
     """
@@ -46,13 +117,18 @@ class ExposureDBWriter(object):
     def serialize(self, iterator):
         """
         Serialize a list of values produced by iterating over an instance of
-        :class:`openquake.commonlib.risk_parsers.ExposureParser`
+        :class:`openquake.commonlib.risk_parsers.ExposureParser`. The
+        assets are read and saved in blocks of EXPOSURE_BLOCK_SIZE.
         """
-        for asset_data in iterator:
+        iterator = iter(iterator)
+        while True:
+            block = list(itertools.islice(iterator, EXPOSURE_BLOCK_SIZE))
+            if not block:
+                break
             if not self.model:
                 self.model, self.cost_types = (
-                    self.insert_model(asset_data.exposure_metadata))
-            self.insert_datum(asset_data)
+                    self.insert_model(block[0].exposure_metadata))
+            self.insert_data(block)
         return self.model
 
     def insert_model(self, model):
@@ -92,9 +168,33 @@ class ExposureDBWriter(object):
 
         return exposure_model, cost_types
 
-    def insert_datum(self, asset_data):
+    def insert_data(self, block):
+        """
+        Insert a block of assets with their costs and occupancies,
+        by using a COPY FROM for each table.
+
+        :param block:
+            a list of :class:`openquake.commonlib.risk_parsers.AssetData`
         """
-        Insert a single asset entry.
+        assets = map(self.build_asset, block)
+        asset_ids = writer.CacheInserter.saveall(assets)
+        costs = []
+        occupancies = []
+        for asset_id, asset_data in zip(asset_ids, block):
+            costs.extend(self.build_costs(asset_id, asset_data))
+            for odata in asset_data.occupancy:
+                occupancies.append(
+                    models.Occupancy(exposure_data_id=asset_id,
+                                     occupants=odata.occupants,
+                                     period=odata.period))
+        if costs:
+            writer.CacheInserter.saveall(costs)
+        if occupancies:
+            writer.CacheInserter.saveall(occupancies)
+
+    def build_asset(self, asset_data):
+        """
+        Build a single asset entry, without saving it.
 
         :param asset_data:
             an instance of :class:`openquake.commonlib.risk_parsers.AssetData`
@@ -110,20 +210,31 @@ class ExposureDBWriter(object):
                                      "Missing cost %s for asset %s" % (
                                          cost_type, asset_data.asset_ref))
 
-        asset = models.ExposureData.objects.create(
+        return models.ExposureData(
             exposure_model=self.model,
             asset_ref=asset_data.asset_ref,
             taxonomy=asset_data.taxonomy,
             area=asset_data.area,
             number_of_units=asset_data.number,
-            site="POINT(%s %s)" % (asset_data.site.longitude,
-                                   asset_data.site.latitude))
+            site=Point(asset_data.site.longitude, asset_data.site.latitude))
 
+    def build_costs(self, asset_id, asset_data):
+        """
+        Build the costs of a single asset, without saving them.
+
+        :param asset_id:
+            the ID of the asset in the database
+        :param asset_data:
+            an instance of :class:`openquake.commonlib.risk_parsers.AssetData`
+        :returns:
+            a list of :class:`openquake.engine.db.models.Cost` instances
+        """
         model = asset_data.exposure_metadata
         deductible_is_absolute = model.conversions.deductible_is_absolute
         insurance_limit_is_absolute = (
             model.conversions.insurance_limit_is_absolute)
 
+        costs = []
         for cost in asset_data.costs:
             cost_type = self.cost_types.get(cost.cost_type, None)
 
@@ -148,8 +259,8 @@ class ExposureDBWriter(object):
                 asset_data.number,
                 model.asset_category)
 
-            models.Cost.objects.create(
-                exposure_data=asset,
+            costs.append(models.Cost(
+                exposure_data_id=asset_id,
                 cost_type=cost_type,
                 converted_cost=converted_cost,
                 converted_retrofitted_cost=retrofitted,
@@ -160,9 +271,5 @@ class ExposureDBWriter(object):
                 insurance_limit_absolute=models.make_absolute(
                     cost.limit,
                     converted_cost,
-                    insurance_limit_is_absolute))
-
-        for odata in asset_data.occupancy:
-            models.Occupancy.objects.create(exposure_data=asset,
-                                            occupants=odata.occupants,
-                                            period=odata.period)
+                    insurance_limit_is_absolute)))
+        return costs
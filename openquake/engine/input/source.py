@@ -0,0 +1,125 @@
+# Copyright (c) 2015, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An on-disk cache of the composite source models. Parsing a large source
+model takes minutes, so the parsed model is pickled in the directory
+`source_model_cache` set in the [hazard] section of openquake.cfg, with
+a key depending on the content of the source model files, of the logic
+tree files and on the parameters used in the parsing. The cached model
+is not prefiltered, so that it can be reused by calculations with
+different sites; the prefiltering is done after reading it. If the
+parameter is not set, the cache is disabled.
+"""
+import os
+import hashlib
+import cPickle as pickle
+
+from openquake.commonlib import readinput
+
+from openquake.engine.logs import LOG
+from openquake.engine.utils import config
+
+# the input files and parameters which affect the composite source model
+SOURCE_INPUTS = ('source_model_logic_tree', 'gsim_logic_tree', 'source')
+SOURCE_PARAMS = ('investigation_time', 'rupture_mesh_spacing',
+                 'complex_fault_mesh_spacing', 'width_of_mfd_bin',
+                 'area_source_discretization', 'number_of_logic_tree_samples',
+                 'random_seed')
+
+
+def get_cache_dir():
+    """
+    :returns: the directory of the source model cache, or None if disabled
+    """
+    cache_dir = config.get('hazard', 'source_model_cache')
+    return os.path.expanduser(cache_dir) if cache_dir else None
+
+
+def get_cache_key(oqparam):
+    """
+    :param oqparam: an :class:`openquake.commonlib.oqvalidation.OqParam`
+    :returns: a SHA1 hex digest of the files and parameters which affect
+              the unfiltered composite source model
+    """
+    sha1 = hashlib.sha1()
+    base_path = getattr(oqparam, 'base_path', '')
+    for name in SOURCE_INPUTS:
+        fnames = oqparam.inputs.get(name, ())
+        if isinstance(fnames, basestring):
+            fnames = [fnames]
+        for fname in sorted(fnames):
+            sha1.update(name)
+            with open(os.path.join(base_path, fname), 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), ''):
+                    sha1.update(block)
+    for name in SOURCE_PARAMS:
+        sha1.update('%s=%r' % (name, getattr(oqparam, name, None)))
+    return sha1.hexdigest()
+
+
+def filter_sources(csm, sitecol, maximum_distance):
+    """
+    Remove from the TrtModels of a composite source model the sources
+    which are farther than `maximum_distance` from all the given sites,
+    and update the number of ruptures of the TrtModels. The composite
+    source model is modified in place.
+
+    :param csm: a :class:`openquake.commonlib.source.CompositeSourceModel`
+    :param sitecol: a :class:`openquake.hazardlib.site.SiteCollection`
+    :param maximum_distance: the integration distance in km
+    :returns: the filtered composite source model
+    """
+    for sm in csm:
+        for trt_model in sm.trt_models:
+            trt_model.sources = [
+                src for src in trt_model.sources
+                if src.filter_sites_by_distance_to_source(
+                    maximum_distance, sitecol) is not None]
+            trt_model.num_ruptures = sum(
+                getattr(src, 'num_ruptures', None) or src.count_ruptures()
+                for src in trt_model.sources)
+    return csm
+
+
+def get_composite_source_model(oqparam, sitecol, prefilter):
+    """
+    Parse the source models, or read them from the cache, if enabled,
+    and prefilter them if required. The arguments are the same as for
+    :func:`openquake.commonlib.readinput.get_composite_source_model`.
+    """
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return readinput.get_composite_source_model(
+            oqparam, sitecol, prefilter)
+    fname = os.path.join(cache_dir, 'csm-%s.pik' % get_cache_key(oqparam))
+    if os.path.exists(fname):
+        LOG.info('Reading the composite source model from %s', fname)
+        with open(fname, 'rb') as f:
+            csm = pickle.load(f)
+    else:
+        csm = readinput.get_composite_source_model(oqparam, None, False)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # write in a temporary file and then rename it, so that concurrent
+        # jobs never read a partially written file
+        tmpname = '%s.%d' % (fname, os.getpid())
+        with open(tmpname, 'wb') as f:
+            pickle.dump(csm, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, fname)
+        LOG.info('Saved the composite source model in %s', fname)
+    if prefilter and sitecol is not None:
+        csm = filter_sources(csm, sitecol, oqparam.maximum_distance)
+    return csm
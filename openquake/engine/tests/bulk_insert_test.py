@@ -17,6 +17,7 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import struct
 import unittest
 
 from openquake.engine import writer
@@ -49,17 +50,37 @@ class DummyConnection(object):
         self.columns = columns
 
 
+class DummyBinaryConnection(DummyConnection):
+    # gmf_data with the column types, as returned by psycopg2
+    @property
+    def description(self):
+        return [['id', 23], ['gmf_id', 23], ['task_no', 23], ['imt', 1043],
+                ['sa_period', 701], ['sa_damping', 701], ['gmvs', 1022],
+                ['rupture_ids', 1007], ['site_id', 23]]
+
+    def fetchall(self):
+        return [(23, 'int4'), (701, 'float8'), (1043, 'varchar'),
+                (1007, '_int4'), (1022, '_float8')]
+
+    def copy_expert(self, sql, stringio):
+        self.sql = sql
+        self.data = stringio.getvalue()
+
+
 class CacheInserterTestCase(unittest.TestCase):
     """
     Unit tests for the CacheInserter class.
     """
     def setUp(self):
         self.connections = writer.connections
+        self.encoders = CacheInserter._encoders
         writer.connections = dict(
             admin=DummyConnection(), job_init=DummyConnection())
+        CacheInserter._encoders = {}
 
     def tearDown(self):
         writer.connections = self.connections
+        CacheInserter._encoders = self.encoders
 
     # this test is probably too strict and testing implementation details
     def test_insert_gmf(self):
@@ -82,3 +103,40 @@ class CacheInserterTestCase(unittest.TestCase):
             connection.columns,
             ['gmf_id', 'task_no', 'imt', 'sa_period', 'sa_damping',
              'gmvs', 'rupture_ids', 'site_id'])
+
+    def test_insert_gmf_binary(self):
+        writer.connections['job_init'] = DummyBinaryConnection()
+        cache = CacheInserter(GmfData, 10)
+        cache.add(GmfData(gmf_id=1, imt='PGA', gmvs=[0.5], rupture_ids=[7],
+                          site_id=2))
+        cache.flush()
+        connection = writer.connections['job_init']
+        self.assertEqual(
+            connection.sql, 'COPY "hzrdr"."gmf_data" (gmf_id, task_no, imt, '
+            'sa_period, sa_damping, gmvs, rupture_ids, site_id) '
+            'FROM STDIN WITH BINARY')
+        record = ''.join([
+            struct.pack('>h', 8),
+            struct.pack('>ii', 4, 1),  # gmf_id
+            struct.pack('>i', -1),  # task_no
+            struct.pack('>i', 3) + 'PGA',  # imt
+            struct.pack('>i', -1),  # sa_period
+            struct.pack('>i', -1),  # sa_damping
+            struct.pack('>iiiiiiid', 32, 1, 0, 701, 1, 1, 8, 0.5),  # gmvs
+            struct.pack('>iiiiiiii', 28, 1, 0, 23, 1, 1, 4, 7),  # rup_ids
+            struct.pack('>ii', 4, 2),  # site_id
+        ])
+        self.assertEqual(connection.data, writer.PGCOPY_HEADER + record +
+                         writer.PGCOPY_TRAILER)
+
+    def test_encode_numeric(self):
+        # 12345.6789 is encoded as the base 10000 digits 1, 2345, 6789
+        self.assertEqual(
+            writer.encode_numeric(12345.6789),
+            struct.pack('>ihhHhHHH', 14, 3, 1, 0, 4, 1, 2345, 6789))
+        self.assertEqual(writer.encode_numeric(0),
+                         struct.pack('>ihhHh', 8, 0, 0, 0, 0))
+
+    def test_encode_bytea(self):
+        self.assertEqual(writer.encode_bytea(bytearray('\x00ab')),
+                         struct.pack('>i', 3) + '\x00ab')
@@ -0,0 +1,131 @@
+# Copyright (c) 2015, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import mock
+
+from openquake.engine.calculators.hazard.classical.core import (
+    ClassicalHazardCalculator)
+from openquake.engine.calculators.hazard.classical_tiling import core
+from openquake.engine.tests.utils import helpers
+
+
+class FakeTaskManager(object):
+    # record the reduction of the tasks of a tile
+    def __init__(self, tile_no, events):
+        self.tile_no = tile_no
+        self.events = events
+
+    def reduce(self, agg, acc):
+        self.events.append(('complete', self.tile_no))
+        return {}
+
+
+class FakeSource(object):
+    # a source affecting only the sites with the given longitude
+    def __init__(self, lon):
+        self.lon = lon
+        self.num_ruptures = 1
+
+    def filter_sites_by_distance_to_source(self, maximum_distance, sitecol):
+        if self.lon in sitecol.lons:
+            return sitecol
+
+
+class FakeTrtModel(object):
+    def __init__(self, sources):
+        self.sources = sources
+        self.num_ruptures = len(sources)
+
+
+class FakeSourceModel(object):
+    def __init__(self, trt_models):
+        self.trt_models = trt_models
+
+
+class PipelineTestCase(unittest.TestCase):
+    # the tasks are not really submitted: the events of submission and
+    # completion of the tiles are recorded by mocking submit_tasks
+    def test(self):
+        cfg = helpers.get_data_path(
+            'calculators/hazard/classical/haz_map_test_job.ini')
+        job = helpers.get_job(cfg)
+        calc = core.ClassicalTilingHazardCalculator(job)
+        calc.initialize_site_collection()
+        calc.composite_model = None
+        calc.prefilter = False
+        site = list(calc.site_collection)[0]
+        calc.tiles = [[site]] * 5
+        calc.num_tiles = 5
+        calc.tiles_in_flight = 2
+
+        events = []
+
+        def submit_tasks(classical):
+            tile_no = int(classical.tilepath[0][4:])  # tilepath is 'tileN'
+            events.append(('submit', tile_no))
+            return FakeTaskManager(tile_no, events)
+
+        with mock.patch.multiple(
+                ClassicalHazardCalculator, save_source_models=mock.DEFAULT,
+                init_zeros_ones=mock.DEFAULT, post_execute=mock.DEFAULT,
+                post_process=mock.DEFAULT), mock.patch.object(
+                ClassicalHazardCalculator, 'submit_tasks', autospec=True,
+                side_effect=submit_tasks):
+            calc.execute()
+
+        # the tiles are completed in order
+        self.assertEqual([no for ev, no in events if ev == 'complete'],
+                         [1, 2, 3, 4, 5])
+        # a tile is submitted before the previous one is completed
+        self.assertEqual(events[:4], [('submit', 1), ('submit', 2),
+                                      ('complete', 1), ('submit', 3)])
+        # there are never more than tiles_in_flight tiles in flight
+        in_flight = []
+        for ev, _no in events:
+            in_flight.append(
+                (in_flight[-1] if in_flight else 0) +
+                (1 if ev == 'submit' else -1))
+        self.assertEqual(max(in_flight), 2)
+        self.assertEqual(in_flight[-1], 0)
+
+    def test_filter_by_tile(self):
+        # each tile keeps only the sources affecting its own sites
+        cfg = helpers.get_data_path(
+            'calculators/hazard/classical/haz_map_test_job.ini')
+        job = helpers.get_job(cfg)
+        calc = core.ClassicalTilingHazardCalculator(job)
+        calc.oqparam = job.get_oqparam()
+        calc.initialize_site_collection()
+        sites = list(calc.site_collection)
+        lons = [site.location.longitude for site in sites]
+        calc.composite_model = [FakeSourceModel([FakeTrtModel(
+            [FakeSource(lons[0]), FakeSource(lons[1]),
+             FakeSource(lons[0])])])]
+        with mock.patch.multiple(
+                ClassicalHazardCalculator, save_source_models=mock.DEFAULT,
+                init_zeros_ones=mock.DEFAULT, submit_tasks=mock.DEFAULT):
+            tile1 = calc.submit_tile(1, sites[:1])
+            tile2 = calc.submit_tile(2, sites[1:])
+        [[trt_model1]] = [sm.trt_models for sm in tile1.composite_model]
+        [[trt_model2]] = [sm.trt_models for sm in tile2.composite_model]
+        self.assertEqual([src.lon for src in trt_model1.sources],
+                         [lons[0], lons[0]])
+        self.assertEqual(trt_model1.num_ruptures, 2)
+        self.assertEqual([src.lon for src in trt_model2.sources], [lons[1]])
+        self.assertEqual(trt_model2.num_ruptures, 1)
+        # the parsed composite model is not changed
+        [sm] = calc.composite_model
+        self.assertEqual(len(sm.trt_models[0].sources), 3)
@@ -18,6 +18,8 @@ import getpass
 import mock
 import unittest
 
+import numpy
+import scipy.stats
 from nose.plugins.attrib import attr
 
 from openquake.engine.calculators.hazard.disaggregation import core
@@ -58,3 +60,80 @@ class DisaggHazardCalculatorTestcase(unittest.TestCase):
                 # 2 poes * 2 imts * 2 sites = 8
                 self.calc.post_execute()
                 self.assertEqual(8, save.call_count)
+
+    @attr('slow')
+    def test_get_curves_and_split(self):
+        # the curves are read by site ID and each task receives only
+        # the curves and the bin edges of its own block of sites
+        self.calc.pre_execute()
+        with mock.patch.dict(os.environ, {'OQ_NO_DISTRIBUTE': '1'}):
+            self.calc.execute()
+            # save the hazard curves, without disaggregating
+            super(core.DisaggHazardCalculator, self.calc).post_execute()
+
+        site_ids = [site.id for site in self.calc.site_collection]
+        curves = self.calc.get_curves()
+        self.assertEqual(sorted(curves), sorted(site_ids))
+        num_curves = 0
+        for hc in models.HazardCurve.objects.filter(
+                output__oq_job=self.job, imt__isnull=False,
+                lt_realization__isnull=False):
+            imt = 'SA(%s)' % hc.sa_period if hc.imt == 'SA' else hc.imt
+            for x, y, poes in models.HazardCurveData.objects.curves_for(hc):
+                # the ID of the closest site
+                site_id = min(self.calc.site_collection, key=lambda site: (
+                    site.location.longitude - x) ** 2 + (
+                    site.location.latitude - y) ** 2).id
+                key = hc.lt_realization.id, imt
+                if any(poes):
+                    numpy.testing.assert_allclose(
+                        curves[site_id][key], poes)
+                    num_curves += 1
+                else:  # the zero curves are skipped
+                    self.assertNotIn(key, curves[site_id])
+        self.assertEqual(
+            num_curves, sum(len(curves[site_id]) for site_id in site_ids))
+
+        self.calc.concurrent_tasks = 4
+        with mock.patch.dict(os.environ, {'OQ_NO_DISTRIBUTE': '1'}), \
+                mock.patch.object(core.tasks, 'starmap') as starmap, \
+                mock.patch.object(self.calc, 'save_disagg_results'):
+            self.calc.full_disaggregation()
+        [_task, all_args, _progress] = starmap.call_args[0]
+        self.assertGreater(len(all_args), 1)
+        blocks_by_trt_model = {}
+        for (_job_id, block, _srcs, trt_model_id, _trt_num,
+             curves_dict, bin_edges) in all_args:
+            ids = set(site.id for site in block)
+            self.assertEqual(set(curves_dict), ids)
+            for site_id in ids:
+                self.assertEqual(sorted(curves_dict[site_id]),
+                                 sorted(curves[site_id]))
+            self.assertEqual(len(set(key[0] for key in bin_edges)), 1)
+            self.assertEqual(set(key[1] for key in bin_edges), ids)
+            for key, edges in bin_edges.iteritems():
+                self.assertIs(edges, self.calc.bin_edges[key])
+            blocks_by_trt_model.setdefault(trt_model_id, []).extend(ids)
+        # the blocks of a TrtModel are disjoint
+        for ids in blocks_by_trt_model.itervalues():
+            self.assertEqual(len(ids), len(set(ids)))
+
+
+class DisaggregatePoesTestCase(unittest.TestCase):
+    def test(self):
+        # a gsim with mean 0 and standard deviation 1 in log space
+        gsim = mock.Mock()
+        gsim.get_mean_and_stddevs.return_value = (
+            numpy.array([0.]), [numpy.array([1.])])
+        gsim.to_distribution_values = numpy.log
+        imls = numpy.exp([-10., 10., 0.])
+        poes = core._disaggregate_poes(
+            gsim, None, None, None, 'PGA', imls,
+            scipy.stats.truncnorm(-3, 3), numpy.linspace(-3, 3, 3))
+        self.assertEqual(gsim.get_mean_and_stddevs.call_count, 1)
+        # below the truncation all the bins contribute
+        numpy.testing.assert_allclose(poes[0], [0.5, 0.5])
+        # above the truncation no bin contributes
+        numpy.testing.assert_allclose(poes[1], [0, 0])
+        # at the median only the upper bin contributes
+        numpy.testing.assert_allclose(poes[2], [0, 0.5])
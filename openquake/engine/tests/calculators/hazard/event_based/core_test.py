@@ -24,9 +24,14 @@ from openquake.hazardlib.site import Site, SiteCollection
 from openquake.hazardlib.geo.point import Point
 from openquake.hazardlib.geo.mesh import Mesh
 from openquake.hazardlib.geo.surface.complex_fault import ComplexFaultSurface
+from openquake.hazardlib.geo.surface.planar import PlanarSurface
+from openquake.hazardlib.source.rupture import ParametricProbabilisticRupture
+from openquake.hazardlib.tom import PoissonTOM
 
 from openquake.commonlib import valid
 from openquake.engine.calculators.hazard.event_based import core
+from openquake.engine import writer
+from openquake.engine.db import models
 from openquake.engine.tests.calculators.hazard.event_based \
     import _pp_test_data as test_data
 from openquake.engine.tests.utils import helpers
@@ -81,33 +86,24 @@ class GmfCalculatorTestCase(unittest.TestCase):
         ses_coll.ordinal = 0
         ses_coll.trt_model.id = 1
         calc = core.GmfCalculator(
-            [pga], [gsim], ses_coll, truncation_level=3)
+            [pga], [gsim], ses_coll, truncation_level=3,
+            imtls=dict(PGA=[0.03, 0.04, 0.05]), sids=site_coll.sids)
         calc.calc_gmfs(site_coll, rup, [(rup.id, rup_seed)])
-        expected_rups = {
-            ('AkkarBommer2010', 'PGA', 0): [rup_id],
-            ('AkkarBommer2010', 'PGA', 1): [rup_id],
-            ('AkkarBommer2010', 'PGA', 2): [rup_id],
-            ('AkkarBommer2010', 'PGA', 3): [rup_id],
-            ('AkkarBommer2010', 'PGA', 4): [rup_id],
-        }
-        expected_gmvs = {
-            ('AkkarBommer2010', 'PGA', 0): [0.1027847118266612],
-            ('AkkarBommer2010', 'PGA', 1): [0.02726361912605336],
-            ('AkkarBommer2010', 'PGA', 2): [0.0862595971325641],
-            ('AkkarBommer2010', 'PGA', 3): [0.04727148908077005],
-            ('AkkarBommer2010', 'PGA', 4): [0.04750575818347277],
-        }
-        numpy.testing.assert_equal(calc.ruptures_per_site, expected_rups)
-        for i, gmvs in expected_gmvs.iteritems():
-            numpy.testing.assert_allclose(gmvs, expected_gmvs[i])
+        expected_gmvs = [0.1027847118266612, 0.02726361912605336,
+                         0.0862595971325641, 0.04727148908077005,
+                         0.04750575818347277]
+        data = calc.gmf_data
+        numpy.testing.assert_equal(data['sid'], range(num_sites))
+        numpy.testing.assert_equal(data['rupid'], [rup_id] * num_sites)
+        numpy.testing.assert_equal(data['gsim'], [0] * num_sites)
+        numpy.testing.assert_equal(data['imt'], [0] * num_sites)
+        numpy.testing.assert_allclose(data['gmv'], expected_gmvs)
 
         # 5 curves (one per each site) for 3 levels, 1 IMT
-        [(gname, [curves])] = calc.to_haz_curves(
-            site_coll.sids, dict(PGA=[0.03, 0.04, 0.05]),
-            invest_time=50., duration=500)
+        [(gname, pnes)] = calc.to_haz_curves(invest_time=50., duration=500)
         self.assertEqual(gname, 'AkkarBommer2010')
         numpy.testing.assert_array_almost_equal(
-            curves,
+            1. - pnes,
             [[0.09516258, 0.09516258, 0.09516258],  # curve site1
              [0.00000000, 0.00000000, 0.00000000],  # curve site2
              [0.09516258, 0.09516258, 0.09516258],  # curve site3
@@ -159,3 +155,107 @@ class UnknownGsimTestCase(unittest.TestCase):
         assert errmsg.startswith(
             "Found in 'source_model.xml' a tectonic region type "
             "'Active Shallow Crust' inconsistent with the ones"), errmsg
+
+
+class GenSesRuptureIdsTestCase(unittest.TestCase):
+    # two SES collections, each one with two ruptures and three
+    # SESRuptures per rupture, stored in interleaved order
+    def test(self):
+        cfg = helpers.get_data_path('event_based_hazard/job.ini')
+        job = helpers.get_job(cfg, username=getpass.getuser())
+        calc = core.EventBasedHazardCalculator(job)
+        coll_ids = {}  # SESRupture ID -> SESCollection ID
+        rup_ids = {}  # SESRupture ID -> ProbabilisticRupture ID
+        for ordinal in range(2):
+            ses_coll = models.SESCollection.create(
+                models.Output.objects.create_output(
+                    job, 'Test SES Collection %d' % ordinal, 'ses'))
+            ses_coll.ordinal = ordinal
+            ses_coll.save()
+            prs = [helpers.create_ses_ruptures(job, ses_coll, 1)[0].rupture
+                   for _ in range(2)]
+            for i in range(2):
+                for pr in prs:
+                    models.SESRupture.objects.create(
+                        rupture=pr, ses_id=1, seed=i,
+                        tag='col=%02d|ses=0001|src=test|rup=%d-%d' % (
+                            ordinal, pr.id, i))
+            for sr in models.SESRupture.objects.filter(
+                    rupture__ses_collection=ses_coll):
+                coll_ids[sr.id] = ses_coll.id
+                rup_ids[sr.id] = sr.rupture_id
+
+        calc.concurrent_tasks = 5  # 12 SESRuptures in blocks of 3
+        blocks = list(calc.gen_ses_rupture_ids())
+        self.assertEqual(map(len, blocks), [3, 3, 3, 3])
+        # every block belongs to a single SESCollection
+        for block in blocks:
+            self.assertEqual(len(set(coll_ids[i] for i in block)), 1)
+        # the blocks are ordered by rupture
+        all_ids = sum(blocks, [])
+        self.assertEqual(
+            all_ids, sorted(all_ids, key=lambda i: (
+                coll_ids[i], rup_ids[i], i)))
+        # all the SESRuptures are covered exactly once
+        self.assertEqual(sorted(all_ids), sorted(coll_ids))
+
+
+class SaveRupturesTestCase(unittest.TestCase):
+    # two ruptures, the first occurring twice and the second once,
+    # saved with two COPY FROM in the binary format
+    def test(self):
+        cfg = helpers.get_data_path('event_based_hazard/job.ini')
+        job = helpers.get_job(cfg, username=getpass.getuser())
+        ses_coll = models.SESCollection.create(
+            models.Output.objects.create_output(
+                job, 'Test SES Collection', 'ses'))
+        surface = PlanarSurface(
+            10, 11, 12, Point(0, 0, 1), Point(1, 0, 1),
+            Point(1, 0, 2), Point(0, 0, 2))
+        prob_rups = []
+        for mag in (5., 6.):
+            rupture = ParametricProbabilisticRupture(
+                mag=mag, rake=0, tectonic_region_type='test region type',
+                hypocenter=Point(0, 0, 1.5), surface=surface,
+                occurrence_rate=1, temporal_occurrence_model=PoissonTOM(10),
+                source_typology=object())
+            prob_rups.append(models.ProbabilisticRupture.build(
+                rupture, ses_coll, [0, 2]))
+        occurrences = [[(1, 'rup-a', 42), (2, 'rup-b', 43)],
+                       [(1, 'rup-c', 44)]]
+
+        # the ruptures are saved with the binary COPY format, including
+        # the pickled surfaces in the bytea column
+        self.assertIsNotNone(writer.CacheInserter(
+            models.ProbabilisticRupture, 1).encoders)
+        with mock.patch.object(
+                writer.CacheInserter, 'saveall',
+                side_effect=writer.CacheInserter.saveall) as saveall:
+            core.save_ruptures(prob_rups, occurrences)
+        self.assertEqual(saveall.call_count, 2)  # one per table
+
+        saved = list(models.ProbabilisticRupture.objects.filter(
+            ses_collection=ses_coll).order_by('id'))
+        self.assertEqual([pr.magnitude for pr in saved], [5., 6.])
+        # the IDs are reserved in the database sequence and they are
+        # not set on the unsaved objects
+        self.assertEqual([pr.id for pr in prob_rups], [None, None])
+        for pr in saved:
+            self.assertEqual(pr.site_indices, [0, 2])
+            self.assertEqual(pr.hypocenter, Point(0, 0, 1.5))
+            # the pickled surface survives the round trip
+            self.assertIsInstance(pr.surface, PlanarSurface)
+            numpy.testing.assert_allclose(
+                pr.surface.corner_lons, surface.corner_lons)
+            numpy.testing.assert_allclose(
+                pr.surface.corner_depths, surface.corner_depths)
+            self.assertEqual(pr.surface.strike, surface.strike)
+
+        # the SESRuptures refer to the right ProbabilisticRuptures
+        sesrups = models.SESRupture.objects.filter(
+            rupture__ses_collection=ses_coll).order_by('tag')
+        self.assertEqual(
+            [(sr.tag, sr.rupture_id, sr.ses_id, sr.seed) for sr in sesrups],
+            [('rup-a', saved[0].id, 1, 42), ('rup-b', saved[0].id, 2, 43),
+             ('rup-c', saved[1].id, 1, 44)])
+        self.assertEqual(sesrups[2].rupture.magnitude, 6.)
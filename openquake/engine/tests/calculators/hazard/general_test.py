@@ -15,15 +15,20 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import shutil
+import tempfile
 import unittest
 import mock
+import numpy
 
 from openquake.commonlib.valid import SiteParam
 
-from openquake.engine import engine
+from openquake.engine import datastore, engine
 from openquake.engine.calculators.hazard import general
 from openquake.engine.calculators import calculators
 from openquake.engine.db import models
+from openquake.engine.db.upgrade_manager import version_db
+from openquake.engine.utils import config
 
 from openquake.engine.tests.utils import helpers
 
@@ -118,6 +123,175 @@ class NonEmptyQuantileTestCase(unittest.TestCase):
             ' parameter quantile_hazard_curves should not be set')
 
 
+class ImtSlicesTestCase(unittest.TestCase):
+    imtls = {'PGA': [0.1, 0.2, 0.3], 'SA(0.1)': [0.1, 0.2], 'PGV': [1.]}
+
+    def test_get_imt_slices(self):
+        slices = general.get_imt_slices(self.imtls)
+        self.assertEqual(slices.keys(), ['PGA', 'PGV', 'SA(0.1)'])
+        self.assertEqual(slices.values(),
+                         [slice(0, 3), slice(3, 4), slice(4, 6)])
+
+    def test_split_by_imt(self):
+        slices = general.get_imt_slices(self.imtls)
+        curves = numpy.arange(12.).reshape(2, 6)
+        pga, pgv, sa = general.split_by_imt(curves, slices)
+        numpy.testing.assert_equal(pga, [[0, 1, 2], [6, 7, 8]])
+        numpy.testing.assert_equal(pgv, [[3], [9]])
+        numpy.testing.assert_equal(sa, [[4, 5], [10, 11]])
+        self.assertEqual(general.split_by_imt(0, slices), [0, 0, 0])
+
+    def test_pnes_to_poes(self):
+        pnes = numpy.array([[1., .9], [.5, 0.]])
+        acc = general.pnes_to_poes({(1, 'gsim'): pnes})
+        self.assertIs(acc[1, 'gsim'], pnes)  # converted in-place
+        numpy.testing.assert_allclose(pnes, [[0., .1], [.5, 1.]])
+
+
+class IndependentCurvesTestCase(unittest.TestCase):
+    # 3 realizations, 2 sites and 4 PGA levels; the curves by realization
+    # are not stored, they are composed from the curves by TrtModel and GSIM
+    @classmethod
+    def setUpClass(cls):
+        cfg = helpers.get_data_path(
+            'calculators/hazard/classical/haz_map_test_job.ini')
+        job = helpers.get_job(cfg)
+        models.JobStats.objects.create(oq_job=job)
+        with config.context('hazard', independent_curves='true'):
+            calc = calculators(job)
+        calc.datastore = None
+        calc.pre_execute()
+        calc.mean_hazard_curves = False
+        calc.quantile_hazard_curves = ()
+        calc.map_poes = []
+        calc.initialize_realizations()
+        rnd = numpy.random.RandomState(42)
+        cls.acc = {}
+        for art in models.AssocLtRlzTrtModel.objects.filter(
+                rlz__lt_model__hazard_calculation=job):
+            curves = rnd.uniform(size=(2, 4))
+            curves[1] = 0  # the second site has zero curves
+            cls.acc[art.trt_model_id, art.gsim] = curves
+        calc.acc = dict(cls.acc)
+        calc.save_hazard_curves()
+        cls.calc = calc
+        cls.site_ids = [site.id for site in models.HazardSite.objects.filter(
+            hazard_calculation=job).order_by('id')]
+
+    def get_curves(self):
+        return models.HazardCurve.objects.filter(
+            output__oq_job=self.calc.job, imt='PGA',
+            lt_realization__isnull=False).order_by('lt_realization')
+
+    def test_schema(self):
+        # the table hzrdr.indep_curve_data is created by the upgrade 0015
+        conn = models.getcursor('admin').connection
+        self.assertGreaterEqual(version_db(conn), '0015')
+
+    def test_build_data(self):
+        hcs = self.get_curves()
+        self.assertEqual(len(hcs), 3)
+        for hc in hcs:
+            self.assertTrue(hc.is_lazy)
+            self.assertEqual(
+                models.HazardCurveData.objects.filter(
+                    hazard_curve=hc).count(), 0)
+            expected = numpy.zeros((2, 4)) + models.build_curves(
+                hc.lt_realization, self.acc)
+            numpy.testing.assert_allclose(
+                hc.build_data(self.site_ids), expected)
+
+    def test_zero_curves(self):
+        # the zero curves are not stored, but they are rebuilt as zeros
+        self.assertEqual(models.IndepCurveData.objects.filter(
+            site=self.site_ids[1]).count(), 0)
+        acc = models.get_indep_curves(
+            self.calc.job, 'PGA', [self.site_ids[1], self.site_ids[0]])
+        self.assertEqual(sorted(acc), sorted(self.acc))
+        for key, curves in acc.iteritems():
+            numpy.testing.assert_allclose(curves[0], 0)
+            numpy.testing.assert_allclose(curves[1], self.acc[key][0])
+        for hc in self.get_curves():
+            numpy.testing.assert_allclose(
+                hc.build_data([self.site_ids[1]]), [[0, 0, 0, 0]])
+
+    def test_curves_for(self):
+        sites = models.HazardSite.objects.filter(
+            hazard_calculation=self.calc.job).order_by('id')
+        for hc in self.get_curves():
+            triples = list(models.HazardCurveData.objects.curves_for(hc))
+            self.assertEqual([(x, y) for x, y, _ in triples],
+                             [(s.location.x, s.location.y) for s in sites])
+            numpy.testing.assert_allclose(
+                [poes for _, _, poes in triples],
+                hc.build_data(self.site_ids))
+
+
+class DataStoreCurvesTestCase(unittest.TestCase):
+    # 3 realizations, 2 sites and 4 PGA levels; the curves by realization
+    # are saved in a npy datastore and not in hzrdr.hazard_curve_data
+    @classmethod
+    def setUpClass(cls):
+        cls.datadir = tempfile.mkdtemp()
+        cfg = helpers.get_data_path(
+            'calculators/hazard/classical/haz_map_test_job.ini')
+        job = helpers.get_job(cfg)
+        models.JobStats.objects.create(oq_job=job)
+        with config.context('datastore', backend='npy',
+                            datadir=cls.datadir):
+            calc = calculators(job)
+        calc.pre_execute()
+        calc.mean_hazard_curves = False
+        calc.quantile_hazard_curves = ()
+        calc.map_poes = []
+        calc.initialize_realizations()
+        rnd = numpy.random.RandomState(42)
+        calc.acc = dict(
+            ((art.trt_model_id, art.gsim), rnd.uniform(size=(2, 4)))
+            for art in models.AssocLtRlzTrtModel.objects.filter(
+                rlz__lt_model__hazard_calculation=job))
+        calc.save_hazard_curves()
+        cls.calc = calc
+        cls.site_ids = [site.id for site in models.HazardSite.objects.filter(
+            hazard_calculation=job).order_by('id')]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.datadir)
+
+    def get_curves(self):
+        return models.HazardCurve.objects.filter(
+            output__oq_job=self.calc.job, imt='PGA',
+            lt_realization__isnull=False).order_by('lt_realization')
+
+    def test_read(self):
+        hcs = self.get_curves()
+        self.assertEqual(len(hcs), 3)
+        for hc in hcs:
+            self.assertTrue(hc.is_lazy)
+            self.assertEqual(
+                models.HazardCurveData.objects.filter(
+                    hazard_curve=hc).count(), 0)
+            dstore = hc.datastore
+            numpy.testing.assert_allclose(
+                hc.build_data(self.site_ids[::-1]),
+                dstore['hcurves/%d/poes' % hc.id][::-1])
+            # the lookup is done only once
+            with mock.patch('openquake.engine.datastore.read') as read:
+                self.assertIs(hc.datastore, dstore)
+                self.assertTrue(hc.is_lazy)
+            self.assertEqual(read.call_count, 0)
+
+    def test_missing(self):
+        # if the datadir is not visible there is an error, not an
+        # empty set of curves read from the database
+        hc = self.get_curves()[0]
+        with mock.patch.object(datastore.NpyDataStore, '__contains__',
+                               lambda self, key: False):
+            with self.assertRaises(IOError):
+                hc.is_lazy
+
+
 class ClosestSiteModelTestCase(unittest.TestCase):
 
     def test_closest_site_model(self):
@@ -23,12 +23,13 @@
 Test classical calculator post processing features
 """
 
-import mock
 import numpy
 import unittest
 
 from nose.plugins.attrib import attr
 
+from openquake.commonlib.calculators import calc
+
 from openquake.engine.tests.utils import helpers
 
 from openquake.engine.db import models
@@ -39,16 +40,55 @@ from openquake.engine.calculators.hazard import (
 aaae = numpy.testing.assert_array_almost_equal
 
 
-# package prefix used for mock.patching
-MOCK_PREFIX = "openquake.commonlib.calculators.calc"
-
-
-class HazardMapTaskFuncTestCase(unittest.TestCase):
-
-    MOCK_HAZARD_MAP = numpy.array([
-        [0.0098, 0.0084],
-        [0.0091, 0.00687952],
-    ])
+class StatisticsTestCase(unittest.TestCase):
+    # 3 realizations, 2 sites, 2 levels
+    curves = numpy.array([[[0.9, 0.5], [0.3, 0.1]],
+                          [[0.8, 0.4], [0.2, 0.1]],
+                          [[0.7, 0.6], [0.4, 0.0]]])
+
+    def test_mean(self):
+        aaae(post_proc.mean_curves(self.curves),
+             [[0.8, 0.5], [0.3, 0.0666667]])
+        aaae(post_proc.mean_curves(self.curves, [0.5, 0.25, 0.25]),
+             [[0.825, 0.5], [0.3, 0.075]])
+
+    def test_quantile(self):
+        # the same numbers given by scientific.quantile_curve site by site
+        aaae(post_proc.quantile_curves(self.curves, 0.5),
+             [[0.8, 0.5], [0.3, 0.1]])
+        aaae(post_proc.quantile_curves(self.curves, 0.5, [0.5, 0.25, 0.25]),
+             [[0.8, 0.45], [0.25, 0.05]])
+
+    def test_hazard_maps(self):
+        curves = [[0.9, 0.5, 0.1], [0.0, 0.0, 0.0]]
+        hmaps = post_proc.compute_hazard_maps(
+            curves, [0.1, 0.2, 0.3], [0.95, 0.5, 0.01])
+        # poe bigger than the maximum -> 0, poe smaller than the minimum
+        # -> the maximum iml
+        aaae(hmaps, [[0., 0.], [0.2, 0.], [0.3, 0.]])
+
+    def test_hazard_maps_ties(self):
+        # the poe is equal to a repeated value of the curve: the result
+        # is the same as calc.compute_hazard_maps, i.e. numpy.interp
+        curves = [[0.6, 0.2, 0.1, 0.1]]
+        imls = [0.1, 0.2, 0.3, 0.4]
+        hmaps = post_proc.compute_hazard_maps(curves, imls, [0.1, 0.2])
+        aaae(hmaps, [[0.3], [0.2]])
+        aaae(hmaps, calc.compute_hazard_maps(curves, imls, [0.1, 0.2]))
+
+        # random curves with plateaus
+        rnd = numpy.random.RandomState(42)
+        curves = -numpy.sort(-rnd.randint(0, 10, (100, 5)) / 10., axis=1)
+        imls = [0.01, 0.05, 0.1, 0.5, 1.0]
+        poes = [0.05, 0.1, 0.3, 0.5, 0.9]
+        aaae(post_proc.compute_hazard_maps(curves, imls, poes),
+             calc.compute_hazard_maps(curves, imls, poes))
+
+
+class HazardMapsTestCase(unittest.TestCase):
+    # the hazard maps are computed from the curves in memory, in
+    # save_hazard_curves for the realizations and in compute_hazard_stats
+    # for the statistics, then they are used to build the UHS
 
     TEST_POES = [0.1, 0.02]
 
@@ -56,110 +96,76 @@ class HazardMapTaskFuncTestCase(unittest.TestCase):
     def setUpClass(cls):
         cfg = helpers.get_data_path(
             'calculators/hazard/classical/haz_map_test_job2.ini')
-        cls.job = helpers.run_job(cfg).job
-        models.JobStats.objects.create(oq_job=cls.job)
-
-    def _test_maps(self, curve, hm_0_1, hm_0_02, lt_rlz=None):
-        self.assertEqual(lt_rlz, hm_0_1.lt_realization)
-        self.assertEqual(lt_rlz, hm_0_02.lt_realization)
-
-        self.assertEqual(
-            curve.investigation_time, hm_0_1.investigation_time)
-        self.assertEqual(
-            curve.investigation_time, hm_0_02.investigation_time)
-
-        self.assertEqual(curve.imt, hm_0_1.imt)
-        self.assertEqual(curve.imt, hm_0_02.imt)
-
-        self.assertEqual(curve.statistics, hm_0_1.statistics)
-        self.assertEqual(curve.statistics, hm_0_02.statistics)
-
-        self.assertEqual(curve.quantile, hm_0_1.quantile)
-        self.assertEqual(curve.quantile, hm_0_02.quantile)
-
-        self.assertIsNone(hm_0_1.sa_period)
-        self.assertIsNone(hm_0_02.sa_period)
-
-        self.assertIsNone(hm_0_1.sa_damping)
-        self.assertIsNone(hm_0_02.sa_damping)
-
-        self.assertEqual(0.1, hm_0_1.poe)
-        self.assertEqual(0.02, hm_0_02.poe)
-
-        aaae([0.0, 0.001], hm_0_1.lons)
-        aaae([0.0, 0.001], hm_0_1.lats)
-        # our mock hazard map results:
-        aaae([0.0098, 0.0084], hm_0_1.imls)
-
-        aaae([0.0, 0.001], hm_0_02.lons)
-        aaae([0.0, 0.001], hm_0_02.lats)
-        # our mock hazard map results:
-        aaae([0.0091, 0.00687952], hm_0_02.imls)
+        cls.job = helpers.run_job(
+            cfg, poes='0.1 0.02', hazard_maps='true',
+            uniform_hazard_spectra='true').job
+
+    def _test_maps(self, curve, lt_rlz=None):
+        hm_0_1, hm_0_02 = models.HazardMap.objects.filter(
+            output__oq_job=self.job, lt_realization=lt_rlz,
+            statistics=curve.statistics,
+            quantile=curve.quantile).order_by('-poe')
+        triples = list(models.HazardCurveData.objects.curves_for(curve))
+        # the maps must be the same as the ones of the reference function
+        expected = calc.compute_hazard_maps(
+            [poes for _, _, poes in triples], curve.imls, self.TEST_POES)
+
+        for hmap, poe, imls in zip([hm_0_1, hm_0_02], self.TEST_POES,
+                                   expected):
+            self.assertEqual(lt_rlz, hmap.lt_realization)
+            self.assertEqual(
+                curve.investigation_time, hmap.investigation_time)
+            self.assertEqual(curve.imt, hmap.imt)
+            self.assertEqual(curve.statistics, hmap.statistics)
+            self.assertEqual(curve.quantile, hmap.quantile)
+            self.assertIsNone(hmap.sa_period)
+            self.assertIsNone(hmap.sa_damping)
+            self.assertEqual(poe, hmap.poe)
+            aaae([0.0, 0.001], hmap.lons)
+            aaae([0.0, 0.001], hmap.lats)
+            aaae([x for x, _, _ in triples], hmap.lons)
+            aaae(imls, hmap.imls)
+
+            # there is only the PGA, so the UHS have a single period
+            [uhs] = models.UHS.objects.filter(
+                output__oq_job=self.job, lt_realization=lt_rlz,
+                statistics=curve.statistics, quantile=curve.quantile,
+                poe=poe)
+            self.assertEqual([0.0], uhs.periods)
+            uhs_data = sorted(
+                ((d.location.x, d.location.y), d.imls) for d in uhs)
+            self.assertEqual(
+                [loc for loc, _ in uhs_data], zip(hmap.lons, hmap.lats))
+            aaae([[iml] for iml in hmap.imls],
+                 [imls_ for _, imls_ in uhs_data])
 
     @attr('slow')
-    def test_hazard_curves_to_hazard_map_logic_tree(self):
+    def test_hazard_maps_logic_tree(self):
         lt_haz_curves = models.HazardCurve.objects.filter(
             output__oq_job=self.job,
             imt__isnull=False,
             lt_realization__isnull=False)
-
-        with mock.patch('%s.compute_hazard_maps' % MOCK_PREFIX) as compute:
-            compute.return_value = self.MOCK_HAZARD_MAP
-
-            for curve in lt_haz_curves:
-                post_proc.hazard_curves_to_hazard_map.task_func(
-                    self.job.id, [curve], self.TEST_POES)
-
-                lt_rlz = curve.lt_realization
-                # There should be two maps: 1 for each PoE
-                hm_0_1, hm_0_02 = models.HazardMap.objects.filter(
-                    output__oq_job=self.job,
-                    lt_realization=lt_rlz).order_by('-poe')
-
-                self._test_maps(curve, hm_0_1, hm_0_02, lt_rlz=lt_rlz)
+        self.assertTrue(lt_haz_curves)
+        for curve in lt_haz_curves:
+            self._test_maps(curve, lt_rlz=curve.lt_realization)
 
     @attr('slow')
-    def test_hazard_curves_to_hazard_map_mean(self):
-        mean_haz_curves = models.HazardCurve.objects.filter(
+    def test_hazard_maps_mean(self):
+        [curve] = models.HazardCurve.objects.filter(
             output__oq_job=self.job,
             imt__isnull=False,
             statistics='mean')
-
-        with mock.patch('%s.compute_hazard_maps' % MOCK_PREFIX) as compute:
-            compute.return_value = self.MOCK_HAZARD_MAP
-
-            for curve in mean_haz_curves:
-                post_proc.hazard_curves_to_hazard_map.task_func(
-                    self.job.id, [curve], self.TEST_POES)
-
-                hm_0_1, hm_0_02 = models.HazardMap.objects.filter(
-                    output__oq_job=self.job,
-                    statistics='mean').order_by('-poe')
-
-                self._test_maps(curve, hm_0_1, hm_0_02)
+        self._test_maps(curve)
 
     @attr('slow')
-    def test_hazard_curves_to_hazard_map_quantile(self):
-        with mock.patch('%s.compute_hazard_maps' % MOCK_PREFIX) as compute:
-            compute.return_value = self.MOCK_HAZARD_MAP
-
-            for quantile in (0.1, 0.9):
-                quantile_haz_curves = models.HazardCurve.objects.filter(
-                    output__oq_job=self.job,
-                    imt__isnull=False,
-                    statistics='quantile',
-                    quantile=quantile)
-
-                for curve in quantile_haz_curves:
-                    post_proc.hazard_curves_to_hazard_map.task_func(
-                        self.job.id, [curve], self.TEST_POES)
-
-                    hm_0_1, hm_0_02 = models.HazardMap.objects.filter(
-                        output__oq_job=self.job,
-                        statistics='quantile',
-                        quantile=quantile).order_by('-poe')
-
-                    self._test_maps(curve, hm_0_1, hm_0_02)
+    def test_hazard_maps_quantile(self):
+        for quantile in (0.1, 0.9):
+            [curve] = models.HazardCurve.objects.filter(
+                output__oq_job=self.job,
+                imt__isnull=False,
+                statistics='quantile',
+                quantile=quantile)
+            self._test_maps(curve)
 
 
 class Bug1086719TestCase(unittest.TestCase):
@@ -0,0 +1,93 @@
+# Copyright (c) 2015, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+from openquake.engine.calculators.risk import hazard_getters
+from openquake.engine.calculators.risk.event_based_risk import core
+from openquake.engine.db import models
+
+from openquake.engine.tests.utils import helpers
+
+
+class EltToArrayTestCase(unittest.TestCase):
+    rupture_ids = numpy.array([10, 20, 30])
+
+    def test_dict(self):
+        # the ruptures 5 and 99 are not in the hazard output
+        elt = {30: 2., 10: 1., 99: 5., 5: 7.}
+        assert_allclose(core.elt_to_array(elt, self.rupture_ids), [1, 0, 2])
+
+    def test_repeated(self):
+        # the losses of the same rupture are summed
+        elt = [(20, 1.), (20, 2.5), (30, 1.), (25, 4.)]
+        assert_allclose(core.elt_to_array(elt, self.rupture_ids),
+                        [0, 3.5, 1])
+
+    def test_empty(self):
+        assert_allclose(core.elt_to_array({}, self.rupture_ids), [0, 0, 0])
+        assert_allclose(core.elt_to_array([], self.rupture_ids), [0, 0, 0])
+        self.assertEqual(
+            len(core.elt_to_array({10: 1.}, numpy.array([], int))), 0)
+
+
+class PostProcessTestCase(unittest.TestCase):
+    # a fake event based hazard with three ruptures
+    def test(self):
+        job, _ = helpers.get_fake_risk_job(
+            helpers.get_data_path('event_based_risk/job.ini'),
+            helpers.get_data_path('event_based_hazard/job.ini'), 'gmf')
+        job.is_running = True
+        job.save()
+        calc = core.EventBasedRiskCalculator(job)
+        calc.pre_execute()
+        [ho] = calc.get_hazard_outputs()
+        rupture_ids = hazard_getters.get_rupture_ids(ho)
+        self.assertEqual(len(rupture_ids), 3)
+
+        # the second rupture has no losses
+        calc.acc = {('structural', ho.id): numpy.array([3., 0., 5.])}
+        calc.post_process()
+
+        event_loss = models.EventLoss.objects.get(
+            output__oq_job=job, output__output_type='event_loss',
+            loss_type='structural', hazard_output=ho)
+        data = sorted((d.rupture_id, d.aggregate_loss)
+                      for d in event_loss.eventlossdata_set.all())
+        self.assertEqual(data, [(rupture_ids[0], 3.), (rupture_ids[2], 5.)])
+        [curve] = models.AggregateLossCurveData.objects.filter(
+            loss_curve__output__oq_job=job)
+        self.assertEqual(curve.loss_curve.hazard_output, ho)
+
+
+class AggResultTestCase(unittest.TestCase):
+    def test_in_place(self):
+        job, _ = helpers.get_fake_risk_job(
+            helpers.get_data_path('event_based_risk/job.ini'),
+            helpers.get_data_path('event_based_hazard/job.ini'), 'gmf')
+        calc = core.EventBasedRiskCalculator(job)
+        acc = {}
+        elt1 = {('structural', 1): numpy.array([1., 0., 2.])}
+        elt2 = {('structural', 1): numpy.array([0., 3., 1.]),
+                ('nonstructural', 1): numpy.array([1., 1., 1.])}
+        self.assertIs(calc.agg_result(acc, elt1), acc)
+        self.assertIs(calc.agg_result(acc, elt2), acc)
+        assert_allclose(acc['structural', 1], [1, 3, 3])
+        assert_allclose(acc['nonstructural', 1], [1, 1, 1])
+        # the event loss tables of the tasks are not modified
+        assert_allclose(elt1['structural', 1], [1, 0, 2])
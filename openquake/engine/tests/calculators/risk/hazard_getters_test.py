@@ -18,14 +18,64 @@ import numpy
 from openquake.engine.tests.utils import helpers
 import unittest
 import cPickle as pickle
+import mock
 
 from openquake.engine.db import models
 from openquake.engine.calculators.risk import hazard_getters
 from openquake.engine.calculators.risk.base import RiskCalculator
+from openquake.engine.calculators.risk.scenario_damage.core import (
+    ScenarioDamageRiskCalculator)
 
 from openquake.engine.tests.utils.helpers import get_data_path
 
 
+class MakeEpsilonsTestCase(unittest.TestCase):
+    def test_independent_from_chunks(self):
+        eps = hazard_getters.make_epsilons(['a1', 'a2', 'a3'], 5, 42, 0)
+        eps1 = hazard_getters.make_epsilons(['a1'], 5, 42, 0)
+        eps23 = hazard_getters.make_epsilons(['a2', 'a3'], 5, 42, 0)
+        numpy.testing.assert_equal(eps, numpy.vstack([eps1, eps23]))
+        # another SES collection has different epsilons
+        self.assertFalse(numpy.allclose(
+            eps1, hazard_getters.make_epsilons(['a1'], 5, 42, 0, 1)))
+
+    def test_correlation(self):
+        refs = ['a%d' % i for i in range(100)]
+        eps = hazard_getters.make_epsilons(refs, 10000, 42, .5, 0, 'RM')
+        corr = numpy.corrcoef(eps)
+        self.assertAlmostEqual(corr[0, 1], .5, delta=.05)
+        self.assertAlmostEqual(corr[50, 99], .5, delta=.05)
+        numpy.testing.assert_allclose(eps.std(axis=1), 1, atol=.05)
+        # perfect correlation
+        eps = hazard_getters.make_epsilons(refs[:2], 10, 42, 1, 0, 'RM')
+        numpy.testing.assert_allclose(eps[0], eps[1])
+
+    def test_unicode(self):
+        # non-ASCII references are hashed in UTF-8, so the same reference
+        # as a unicode or as a byte string has the same epsilons
+        ref = u'edif\xedcio-\u0394'
+        eps = hazard_getters.make_epsilons([ref], 5, 42, 0)
+        numpy.testing.assert_equal(
+            eps, hazard_getters.make_epsilons([ref.encode('utf-8')], 5, 42, 0))
+        self.assertFalse(numpy.allclose(
+            eps, hazard_getters.make_epsilons([u'edificio-D'], 5, 42, 0)))
+
+
+class ClosestSitesTestCase(unittest.TestCase):
+    def test(self):
+        site_lons = numpy.array([0., 1., 2.])
+        site_lats = numpy.array([0., 0., 0.])
+        # 0.1 degrees are about 11 km
+        lons = numpy.array([0.9, 2.1, 5., 0.])
+        lats = numpy.array([0., 0., 0., 0.1])
+        idx = hazard_getters.closest_sites(
+            site_lons, site_lats, lons, lats, 15)
+        numpy.testing.assert_equal(idx, [1, 2, -1, 0])
+        idx = hazard_getters.closest_sites(
+            site_lons, site_lats, lons, lats, 10)
+        numpy.testing.assert_equal(idx, [-1, -1, -1, -1])
+
+
 class HazardCurveGetterTestCase(unittest.TestCase):
 
     hazard_demo = get_data_path('simple_fault_demo_hazard/job.ini')
@@ -48,6 +98,7 @@ class HazardCurveGetterTestCase(unittest.TestCase):
         self.job.save()
         calc.pre_execute()
 
+        hazard_getters.associate_assets(calc, [self.taxonomy])
         self.builder = hazard_getters.RiskInitializer(
             self.taxonomy, calc)
         self.builder.init_assocs()
@@ -56,9 +107,9 @@ class HazardCurveGetterTestCase(unittest.TestCase):
         self.assets = models.ExposureData.objects.get_asset_chunk(
             calc.exposure_model, calc.time_event, assocs)
         self.nbytes = self.builder.calc_nbytes()
-        self.builder.init_epsilons()
         self.getter = self.getter_class(
-            self.imt, self.taxonomy, calc.get_hazard_outputs(), self.assets)
+            self.imt, self.taxonomy, calc.get_hazard_outputs(), self.assets,
+            epsilon_params=(42, 0, 0))
 
     def test_nbytes(self):
         self.assertEqual(self.nbytes, 0)
@@ -66,6 +117,13 @@ class HazardCurveGetterTestCase(unittest.TestCase):
     def test_is_pickleable(self):
         pickle.dumps(self.getter)  # raises an error if not
 
+    def test_get_subset(self):
+        subgetter = self.getter.get_subset(self.taxonomy, [0])
+        self.assertEqual(subgetter.assets, self.assets[:1])
+        self.assertEqual(subgetter.site_ids, self.getter.site_ids[:1])
+        self.assertIs(subgetter.cache, self.getter.cache)
+        self.assertEqual(len(self.getter.assets), len(self.assets))
+
     def test_call(self):
         # the exposure model in this example has three assets of taxonomy VF
         # called a1, a2 and a3; only a2 and a3 are within the maximum distance
@@ -75,6 +133,74 @@ class HazardCurveGetterTestCase(unittest.TestCase):
         numpy.testing.assert_allclose([[0.1, 0.2, 0.3], [0.1, 0.2, 0.3]], data)
 
 
+class HazardCurveCacheTestCase(HazardCurveGetterTestCase):
+    # the curves of the sites of a chunk of assets are read with a single
+    # query, and cached by hazard output and IMT for the next chunks
+
+    def setUp(self):
+        super(HazardCurveCacheTestCase, self).setUp()
+        # a different curve for each hazard site
+        [ho] = self.getter.hazard_outputs
+        self.poes = {}  # site ID -> poes
+        hcd = models.HazardCurveData.objects.filter(
+            hazard_curve__output__oq_job=ho.oq_job).order_by('id')
+        for i, data in enumerate(hcd, 1):
+            data.poes = [i / 10., i / 20., i / 40.]
+            data.save()
+            for site in models.HazardSite.objects.filter(
+                    hazard_calculation=ho.oq_job, location=data.location):
+                self.poes[site.id] = data.poes
+        # a2 and a3 have the same location: associate a3 to another site
+        a2, a3 = self.assets
+        a3.hazard_site_id = [site_id for site_id in sorted(self.poes)
+                             if site_id != a2.hazard_site_id][0]
+        self.getter = self.getter_class(
+            self.imt, self.taxonomy, self.getter.hazard_outputs, self.assets)
+
+    def read_data(self, getter):
+        # returns the hazard data and the sites read by the single query
+        read_curves = hazard_getters.HazardCurveGetter._read_curves
+        with mock.patch.object(
+                hazard_getters.HazardCurveGetter, '_read_curves',
+                autospec=True, side_effect=read_curves) as read:
+            data = getter.get_data()
+        return data, [call[0][2] for call in read.call_args_list]
+
+    def test_call(self):
+        data, reads = self.read_data(self.getter)
+        site_ids = self.getter.site_ids
+        self.assertEqual(len(set(site_ids)), 2)
+        self.assertEqual(reads, [sorted(site_ids)])
+        numpy.testing.assert_allclose(
+            data, [self.poes[site_id] for site_id in site_ids])
+
+    def test_cache_across_chunks(self):
+        cache = {}
+        a2, a3 = self.assets
+        chunk1 = self.getter_class(
+            self.imt, self.taxonomy, self.getter.hazard_outputs, [a2], cache)
+        chunk2 = self.getter_class(
+            self.imt, self.taxonomy, self.getter.hazard_outputs, [a2, a3],
+            cache)
+        data1, reads1 = self.read_data(chunk1)
+        self.assertEqual(reads1, [chunk1.site_ids])
+        # the second chunk reads only the site which is not in the cache
+        data2, reads2 = self.read_data(chunk2)
+        self.assertEqual(reads2, [chunk2.site_ids[1:]])
+        numpy.testing.assert_allclose(data2[:1], data1)
+        numpy.testing.assert_allclose(
+            data2, [self.poes[site_id] for site_id in chunk2.site_ids])
+        [ho] = self.getter.hazard_outputs
+        self.assertEqual(list(cache), [(ho.id, self.imt)])
+        # a third chunk with the same sites does not query again
+        chunk3 = self.getter_class(
+            self.imt, self.taxonomy, self.getter.hazard_outputs, [a3, a2],
+            cache)
+        data3, reads3 = self.read_data(chunk3)
+        self.assertEqual(reads3, [])
+        numpy.testing.assert_allclose(data3, data2[::-1])
+
+
 class GroundMotionGetterTestCase(HazardCurveGetterTestCase):
 
     hazard_demo = get_data_path('event_based_hazard/job.ini')
@@ -100,8 +226,11 @@ class GroundMotionGetterTestCase(HazardCurveGetterTestCase):
 
         data = self.getter.get_data()
         numpy.testing.assert_allclose([[0.1, 0.2, 0.3]], data)
+        # the epsilons are regenerated from the seed and the asset_ref
+        [ho] = self.getter.hazard_outputs
+        [ses_coll] = hazard_getters.haz_out_to_ses_coll(ho)
         numpy.testing.assert_allclose(
-            numpy.array([[0.49671415, -0.1382643, 0.64768854]]),
+            hazard_getters.make_epsilons(['a1'], 3, 42, 0, ses_coll.ordinal),
             self.getter.epsilons)  # shape (1, 3)
 
 
@@ -113,18 +242,28 @@ class ScenarioTestCase(GroundMotionGetterTestCase):
     taxonomy = 'RM'
 
     def test_nbytes(self):
-        # I am not populating the table ses_rupture
-        self.assertEqual(len(self.getter.rupture_ids), 0)
+        # the epsilons depend on number_of_ground_motion_fields
+        self.assertEqual(len(self.getter.rupture_ids), 3)
         self.assertEqual(self.nbytes, 80)
 
     def test_call(self):
         # the exposure model in this example has two assets of taxonomy RM
         # (a1 and a3) but the asset a3 has no hazard data within the
-        # maximum distance; there are 10 realizations
+        # maximum distance; there are three ruptures
         a1, = self.assets
         self.assertEqual(self.getter.assets, [a1])
         [hazard] = self.getter.hazards.values()
-        self.assertEqual(hazard.values()[0], {0: 0.1, 1: 0.2, 2: 0.3})
+        # the GMV matrix has a row for the site of a1 and a column
+        # for each rupture
+        numpy.testing.assert_allclose(hazard, [[0.1, 0.2, 0.3]])
+        numpy.testing.assert_allclose(
+            self.getter.get_data(), [[0.1, 0.2, 0.3]])
 
-        # NB: since I am not populating the table ses_rupture,
-        # self.getter.get_data() is empty
+    def test_no_epsilons(self):
+        # the scenario damage calculator does not regenerate the epsilons
+        self.assertIsNone(ScenarioDamageRiskCalculator.epsilon_params)
+        getter = self.getter_class(
+            self.imt, self.taxonomy, self.getter.hazard_outputs, self.assets,
+            epsilon_params=ScenarioDamageRiskCalculator.epsilon_params)
+        self.assertFalse(hasattr(getter, 'epsilons'))
+        numpy.testing.assert_allclose(getter.get_data(), [[0.1, 0.2, 0.3]])
@@ -0,0 +1,62 @@
+# Copyright (c) 2015, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+from openquake.engine.calculators.risk import loss_statistics
+
+
+class NormalizeTestCase(unittest.TestCase):
+    def test(self):
+        losses = numpy.array([[0, 1, 2], [0, 0, 0]], float)
+        poes = numpy.array([[1, .5, .2], [1, .8, .6]])
+        ref = numpy.array([[0, 2, 4], [0, 0, 0]], float)
+        # the second asset has zero reference losses and is not changed
+        assert_allclose(loss_statistics.normalize(losses, poes, ref),
+                        [[1, .2, 0], [1, .8, .6]])
+
+
+class LossStatisticsTestCase(unittest.TestCase):
+    losses = [[0., .5, 1.]]  # one asset, three loss ratios
+    poes = [[1, .5, .1], [1, .4, .2], [1, .9, .3], [1, .6, .4]]
+
+    def get_stats(self, buffer_size):
+        stats = loss_statistics.LossStatistics(
+            [.5], [.5], buffer_size=buffer_size)
+        for poes in self.poes:
+            stats.add([(self.losses[0], poes)])
+        return stats
+
+    def test_buffer(self):
+        stats = self.get_stats(buffer_size=10)
+        self.assertEqual(stats.num_rlzs, 4)
+        self.assertEqual(len(stats.buffer), 4)
+        [[(losses, mean)], _avgs, _maps, [[(_, median)]], _, _] = (
+            stats.get_stats())
+        assert_allclose(losses, self.losses[0])
+        assert_allclose(mean, [1, .6, .25])
+        assert_allclose(median, [1, .55, .25])
+
+    def test_running_mean(self):
+        # only two realizations are kept in memory, but the mean is the
+        # same since the curves have the same loss ratios
+        stats = self.get_stats(buffer_size=2)
+        self.assertEqual(stats.num_rlzs, 4)
+        self.assertEqual(len(stats.buffer), 2)
+        [(_losses, mean)] = stats.get_stats()[0]
+        assert_allclose(mean, [1, .6, .25])
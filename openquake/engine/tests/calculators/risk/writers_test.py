@@ -0,0 +1,107 @@
+# Copyright (c) 2015, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import mock
+from numpy.testing import assert_allclose
+
+from openquake.engine.calculators.risk import base, writers
+
+
+class FakeAsset(object):
+    def __init__(self, asset_ref, structural, number_of_units=1, id=None):
+        self.asset_ref = asset_ref
+        self.structural = structural
+        self.number_of_units = number_of_units
+        self.id = id
+        self.site = None
+
+    def value(self, loss_type):
+        return getattr(self, loss_type)
+
+
+class LossMapWriterTestCase(unittest.TestCase):
+    def test_loss_ratios(self):
+        assets = [FakeAsset('a1', 10.), FakeAsset('a2', None)]
+        with mock.patch.object(writers, 'save') as save:
+            writers.loss_map('structural', 42, assets, [.1, .2], [.01, .02])
+        [data] = save.call_args[0]
+        self.assertEqual([d.asset_ref for d in data], ['a1', 'a2'])
+        self.assertEqual([d.loss_map_id for d in data], [42, 42])
+        # the losses are multiplied by the asset values, zero if missing
+        self.assertEqual([d.value for d in data], [1., 0.])
+        self.assertEqual([d.std_dev for d in data], [.1, 0.])
+
+
+class BCRDistributionWriterTestCase(unittest.TestCase):
+    def test_eal(self):
+        assets = [FakeAsset('a1', 10.), FakeAsset('a2', 100.)]
+        bcr_data = [(.1, .05, 2.), (.2, .1, .5)]
+        with mock.patch.object(writers, 'save') as save:
+            writers.bcr_distribution('structural', 42, assets, bcr_data)
+        [data] = save.call_args[0]
+        self.assertEqual([d.bcr_distribution_id for d in data], [42, 42])
+        # the expected annual losses are multiplied by the asset values,
+        # the benefit cost ratios are not
+        assert_allclose([d.average_annual_loss_original for d in data],
+                        [1., 20.])
+        assert_allclose([d.average_annual_loss_retrofitted for d in data],
+                        [.5, 10.])
+        assert_allclose([d.bcr for d in data], [2., .5])
+
+
+class DamageDistributionWriterTestCase(unittest.TestCase):
+    def test_units(self):
+        assets = [FakeAsset('a1', 10., number_of_units=2, id=1),
+                  FakeAsset('a2', 10., number_of_units=1, id=2)]
+        # two events and two damage states for each asset
+        fractions = [[[.2, .8], [.4, .6]], [[1., 0.], [1., 0.]]]
+        with mock.patch.object(writers, 'save') as save:
+            writers.damage_distribution(assets, fractions, [11, 12])
+        data1, data2 = [args[0] for args, _ in save.call_args_list]
+        self.assertEqual([(d.exposure_data_id, d.dmg_state_id)
+                          for d in data1 + data2],
+                         [(1, 11), (1, 12), (2, 11), (2, 12)])
+        # the mean fractions are multiplied by the number of units
+        assert_allclose([d.mean for d in data1], [.6, 1.4])
+        assert_allclose([d.mean for d in data2], [1., 0.])
+
+
+class DiscardTestCase(unittest.TestCase):
+    def tearDown(self):
+        writers._inserters.clear()
+
+    def test_discard(self):
+        with mock.patch.object(writers, 'CacheInserter') as inserter_class:
+            writers.save([FakeAsset('a1', 10.)])
+            inserter = inserter_class.return_value
+            self.assertEqual(inserter.add.call_count, 1)
+            writers.discard()
+        self.assertEqual(inserter.discard.call_count, 1)
+        self.assertEqual(inserter.flush.call_count, 0)
+        self.assertEqual(writers._inserters, {})
+
+    def test_failing_task(self):
+        # the outputs cached by a failing task are discarded, so that
+        # they cannot be saved by the next task in the same process
+        calc = mock.Mock()
+        calc.get_hazard_outputs.side_effect = ValueError('boom')
+        with mock.patch.object(writers, 'discard') as discard, \
+                mock.patch.object(writers, 'flush') as flush:
+            with self.assertRaises(ValueError):
+                base.run_risk.task_func(1, [], calc)
+        self.assertEqual(discard.call_count, 1)
+        self.assertEqual(flush.call_count, 0)
@@ -0,0 +1,68 @@
+# Copyright (c) 2010-2014, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from openquake.engine import datastore
+from openquake.engine.utils import config
+
+
+class NpyDataStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.dstore = datastore.NpyDataStore(42, self.datadir)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_set_get(self):
+        poes = numpy.array([[.1, .2, .3], [.4, .5, .6]])
+        self.dstore['hcurves/1/poes'] = poes
+        self.dstore['hcurves/1/sids'] = [10, 11]
+        self.assertEqual(self.dstore.keys(),
+                         ['hcurves/1/poes', 'hcurves/1/sids'])
+        self.assertIn('hcurves/1/poes', self.dstore)
+        self.assertNotIn('hcurves/2/poes', self.dstore)
+        numpy.testing.assert_equal(self.dstore['hcurves/1/poes'][[1]],
+                                   [[.4, .5, .6]])
+        numpy.testing.assert_equal(self.dstore['hcurves/1/sids'], [10, 11])
+        with self.assertRaises(KeyError):
+            self.dstore['hcurves/2/poes']
+
+    def test_del_clear(self):
+        self.dstore['a'] = numpy.zeros(3)
+        self.dstore['b/c'] = numpy.ones(3)
+        del self.dstore['a']
+        self.assertEqual(self.dstore.keys(), ['b/c'])
+        self.dstore.clear()
+        self.assertEqual(self.dstore.keys(), [])
+
+
+class GetBackendTestCase(unittest.TestCase):
+    def test_default(self):
+        with config.context('datastore', backend='db'):
+            self.assertIsNone(datastore.get_backend())
+
+    def test_npy(self):
+        with config.context('datastore', backend='npy'):
+            self.assertEqual(datastore.get_backend(), 'npy')
+
+    def test_unknown(self):
+        with config.context('datastore', backend='xxx'):
+            self.assertRaises(ValueError, datastore.get_backend)
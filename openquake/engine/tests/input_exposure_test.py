@@ -0,0 +1,119 @@
+# Copyright (c) 2015, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+import mock
+
+from openquake.engine.db import models
+from openquake.engine.input import exposure
+
+# the description is unique, so that the exposure is really imported
+EXPOSURE = '''<?xml version='1.0' encoding='UTF-8'?>
+<nrml xmlns="http://openquake.org/xmlns/nrml/0.4">
+  <exposureModel id="ep" category="single_asset">
+    <description>%s</description>
+    <conversions>
+      <costTypes>
+        <costType name="structural" unit="USD" type="aggregated"/>
+      </costTypes>
+    </conversions>
+    <assets>
+%s
+    </assets>
+  </exposureModel>
+</nrml>'''
+
+ASSET = '''      <asset id="a%d" taxonomy="VF">
+        <location lon="%d.0" lat="0.0"/>
+        <costs>
+          <cost type="structural" value="%d"/>
+        </costs>
+        <occupancies>
+          <occupancy occupants="%d" period="day"/>
+        </occupancies>
+      </asset>'''
+
+
+class ExposureSha1TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'exposure.xml')
+        with open(self.fname, 'w') as f:
+            f.write('<nrml/>')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sha1(self):
+        sha1 = exposure.get_exposure_sha1(self.fname)
+        self.assertEqual(sha1, exposure.get_exposure_sha1(self.fname))
+        # the cost types which can be missing change the imported data
+        self.assertNotEqual(
+            sha1, exposure.get_exposure_sha1(self.fname, ['contents']))
+        with open(self.fname, 'w') as f:
+            f.write('<nrml></nrml>')
+        self.assertNotEqual(sha1, exposure.get_exposure_sha1(self.fname))
+
+
+class ImportExposureTestCase(unittest.TestCase):
+    # an exposure with 3 assets; the asset aN has a structural cost of
+    # 10 * N and N occupants
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'exposure.xml')
+        assets = '\n'.join(ASSET % (i, i, 10 * i, i) for i in (1, 2, 3))
+        with open(self.fname, 'w') as f:
+            f.write(EXPOSURE % (uuid.uuid4(), assets))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reuse(self):
+        job1 = models.OqJob.objects.create(user_name='openquake')
+        model1 = exposure.import_exposure(job1, self.fname)
+        self.assertEqual(model1.job, job1)
+        self.assertIsNone(job1.get_param('preloaded_exposure_model_id', None))
+        self.assertEqual(model1.exposuredata_set.count(), 3)
+
+        # the second import reuses the exposure model of the first job
+        job2 = models.OqJob.objects.create(user_name='openquake')
+        model2 = exposure.import_exposure(job2, self.fname)
+        self.assertEqual(model2.id, model1.id)
+        self.assertEqual(
+            job2.get_param('preloaded_exposure_model_id'), model1.id)
+        self.assertFalse(
+            models.ExposureModel.objects.filter(job=job2).exists())
+        self.assertEqual(model1.exposuredata_set.count(), 3)
+
+    def test_blocks(self):
+        # with blocks of 2 assets the third asset is in a second block
+        job = models.OqJob.objects.create(user_name='openquake')
+        with mock.patch.object(exposure, 'EXPOSURE_BLOCK_SIZE', 2):
+            model = exposure.import_exposure(job, self.fname)
+        assets = model.exposuredata_set.order_by('id')
+        self.assertEqual([a.asset_ref for a in assets], ['a1', 'a2', 'a3'])
+        for i, asset in enumerate(assets, 1):
+            [cost] = models.Cost.objects.filter(exposure_data=asset)
+            self.assertEqual(cost.cost_type.name, 'structural')
+            self.assertEqual(cost.converted_cost, 10 * i)
+            [occupancy] = models.Occupancy.objects.filter(
+                exposure_data=asset)
+            self.assertEqual(occupancy.occupants, i)
+            self.assertEqual(occupancy.period, 'day')
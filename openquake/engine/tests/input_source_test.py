@@ -0,0 +1,90 @@
+# Copyright (c) 2015, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from openquake.engine.input import source
+from openquake.engine.utils import config
+
+
+class FakeOqParam(object):
+    inputs = {'source_model_logic_tree': 'smlt.xml'}
+    investigation_time = 50.
+    rupture_mesh_spacing = 5.
+
+
+class SourceModelCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.smlt = os.path.join(self.tmpdir, 'smlt.xml')
+        with open(self.smlt, 'w') as f:
+            f.write('<logicTree/>')
+        self.oqparam = FakeOqParam()
+        self.oqparam.base_path = self.tmpdir
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache_key(self):
+        key = source.get_cache_key(self.oqparam)
+        self.assertEqual(key, source.get_cache_key(self.oqparam))
+        self.oqparam.investigation_time = 1.
+        key2 = source.get_cache_key(self.oqparam)
+        self.assertNotEqual(key, key2)
+        with open(self.smlt, 'w') as f:
+            f.write('<logicTree></logicTree>')
+        self.assertNotEqual(
+            key2, source.get_cache_key(self.oqparam))
+
+    def test_warm_start(self):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        with config.context('hazard', source_model_cache=cache_dir), \
+                mock.patch('openquake.commonlib.readinput.'
+                           'get_composite_source_model',
+                           return_value=['csm']) as parse:
+            csm1 = source.get_composite_source_model(
+                self.oqparam, None, False)
+            csm2 = source.get_composite_source_model(
+                self.oqparam, None, False)
+        self.assertEqual(csm1, ['csm'])
+        self.assertEqual(csm2, ['csm'])
+        self.assertEqual(parse.call_count, 1)  # parsed only the first time
+
+    def test_prefilter(self):
+        # the cached model is not prefiltered, so that it is reused when
+        # only the sites change; the prefiltering is done after reading it
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.oqparam.maximum_distance = 200
+        with config.context('hazard', source_model_cache=cache_dir), \
+                mock.patch('openquake.commonlib.readinput.'
+                           'get_composite_source_model',
+                           return_value=['csm']) as parse, \
+                mock.patch.object(source, 'filter_sources',
+                                  side_effect=lambda csm, sitecol, dist:
+                                  csm + [sitecol]) as filter_:
+            csm1 = source.get_composite_source_model(
+                self.oqparam, 'sites1', True)
+            csm2 = source.get_composite_source_model(
+                self.oqparam, 'sites2', True)
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(parse.call_args[0][1:], (None, False))
+        self.assertEqual(csm1, ['csm', 'sites1'])
+        self.assertEqual(csm2, ['csm', 'sites2'])
+        self.assertEqual(filter_.call_args[0][2], 200)
@@ -459,9 +459,10 @@ def get_fake_risk_job(risk_cfg, hazard_cfg, output_type="curve",
             output=models.Output.objects.create_output(
                 hazard_job, "Test gmf scenario output", "gmf_scenario"))
 
-        models.SESCollection.create(
+        ses_coll = models.SESCollection.create(
             output=models.Output.objects.create_output(
                 hazard_job, "Test SES Collection", "ses"))
+        ruptures = create_ses_ruptures(hazard_job, ses_coll, 3)
         site_ids = models.save_sites(
             hazard_job,
             [(15.48, 38.0900001), (15.565, 38.17), (15.481, 38.25)])
@@ -472,7 +473,7 @@ def get_fake_risk_job(risk_cfg, hazard_cfg, output_type="curve",
                 imt="PGA",
                 site_id=site_id,
                 gmvs=[0.1, 0.2, 0.3],
-                rupture_ids=[0, 1, 2])
+                rupture_ids=[r.id for r in ruptures])
 
     elif output_type in ("ses", "gmf"):
         hazard_output = create_gmf_data_records(hazard_job)[0].gmf
@@ -21,9 +21,14 @@
 Unit tests for the utils.tasks module.
 """
 
+import os
+import shutil
+import tempfile
 import unittest
 
-from openquake.engine.utils import tasks
+import mock
+
+from openquake.engine.utils import tasks, config
 
 from openquake.engine.tests.utils.tasks import \
     failing_task, just_say_hello, get_even
@@ -41,6 +46,17 @@ class TaskManagerTestCase(unittest.TestCase):
         result = tm.reduce(lambda lst, val: lst + [val], [])
         self.assertEqual(expected, result)
 
+    def test_sliding_window(self):
+        with mock.patch.object(tasks.OqTaskManager, 'max_in_flight', 2):
+            tm = tasks.OqTaskManager.starmap(
+                just_say_hello, [(i, ) for i in range(5)])
+            if not tasks.no_distribute():
+                self.assertEqual(len(tm.results), 2)
+                self.assertEqual(len(tm.queued), 3)
+            result = tm.reduce(lambda lst, val: lst + [val], [])
+        self.assertEqual(["hello"] * 5, result)
+        self.assertEqual(len(tm.queued), 0)
+
     def test_type_error(self):
         try:
             tasks.OqTaskManager.starmap(just_say_hello, range(5))
@@ -64,3 +80,29 @@ class TaskManagerTestCase(unittest.TestCase):
         got = tasks.apply_reduce(
             get_even, (1, [1, 2, 3, 4, 5]), list.__add__, [], 2)
         self.assertEqual(sorted(got), [2, 4])
+
+
+class BroadcastTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_broadcast(self):
+        big = range(100000)
+        with config.context('celery', broadcast_dir=self.tmpdir), \
+                mock.patch.object(tasks, 'no_distribute', lambda: False):
+            self.assertEqual(tasks.broadcast(1, 'small'), 'small')
+            ref = tasks.broadcast(1, big)
+            self.assertIsInstance(ref, tasks.Broadcast)
+            self.assertEqual(ref.path, tasks.broadcast(1, big).path)
+            self.assertEqual(ref.get(), big)
+            self.assertIs(ref.get(), ref.get())  # cached
+            tasks.clear_broadcast(1)
+        self.assertFalse(os.path.exists(os.path.dirname(ref.path)))
+
+    def test_disabled(self):
+        big = range(100000)
+        with config.context('celery', broadcast_dir=''):
+            self.assertIs(tasks.broadcast(1, big), big)
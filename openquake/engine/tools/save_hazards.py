@@ -40,6 +40,7 @@ with all of its outputs, then remove it by using ``bin/openquake
 sufficient permissions). Then run again ``restore_hazards.py``.
 """
 
+import csv
 import gzip
 import itertools
 import os
@@ -91,6 +92,21 @@ class Copier(object):
             if fname not in self.filenames:
                 self.filenames.append(fname)
 
+    def write_rows(self, rows, dest, name):
+        """
+        Append the given rows to a csv file, in the same format of COPY TO.
+
+        :param rows: an iterable over sequences of strings
+        :param str dest: the destination directory
+        :param str name: the destination file name
+        """
+        fname = os.path.join(dest, name + ".gz")
+        log.info('(-> %s)', fname)
+        with gzip.GzipFile(fname, 'a') as fileobj:
+            csv.writer(fileobj, lineterminator='\n').writerows(rows)
+            if fname not in self.filenames:
+                self.filenames.append(fname)
+
 
 class HazardDumper(object):
     """
@@ -165,6 +181,28 @@ class HazardDumper(object):
                where hazard_curve_id in {}""".format(ids),
             'hzrdr.hazard_curve_data.csv', mode='a')
 
+        # the lazy curves are not stored in hzrdr.hazard_curve_data,
+        # so their rows are built from the datastore or the indep curves
+        hc_ids = [row[0] for row in self.curs.fetchall(
+            'select id from hzrdr.hazard_curve where output_id in %s '
+            'and imt is not null' % output)]
+        for hc in models.HazardCurve.objects.filter(pk__in=hc_ids):
+            if hc.is_lazy:
+                self.lazy_hazard_curve_data(hc)
+
+    def lazy_hazard_curve_data(self, hc):
+        """Dump the hazard_curve_data of a lazy hazard_curve"""
+        triples = list(models.HazardCurveData.objects.curves_for(hc))
+        ids = self.curs.fetchall(
+            "select nextval('hzrdr.hazard_curve_data_id_seq') "
+            "from generate_series(1, %s)", len(triples))
+        weight = hc.lt_realization.weight if hc.lt_realization else None
+        rows = [(id_, hc.id, '{%s}' % ','.join(map(repr, poes)),
+                 '' if weight is None else weight,
+                 'SRID=4326;POINT(%r %r)' % (x, y))
+                for [id_], (x, y, poes) in zip(ids, triples)]
+        self.curs.write_rows(rows, self.outdir, 'hzrdr.hazard_curve_data.csv')
+
     def gmf(self, output):
         """Dump gmf, gmf_data"""
         self._copy(
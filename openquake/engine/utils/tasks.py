@@ -18,7 +18,12 @@
 
 """Utility functions related to splitting work into tasks."""
 
+import os
+import shutil
+import hashlib
 import operator
+import collections
+import cPickle as pickle
 
 from celery.result import ResultSet
 from celery.app import current_app
@@ -36,6 +41,12 @@ from openquake.engine.performance import EnginePerformanceMonitor
 CONCURRENT_TASKS = int(config.get('celery', 'concurrent_tasks'))
 SOFT_MEM_LIMIT = int(config.get('memory', 'soft_mem_limit'))
 HARD_MEM_LIMIT = int(config.get('memory', 'hard_mem_limit'))
+MAX_TASKS_IN_FLIGHT = int(config.get('celery', 'max_tasks_in_flight') or 0)
+
+# arguments smaller than this (in bytes, once pickled) are not broadcasted
+BROADCAST_MIN_SIZE = 1 << 16
+# maximum number of broadcasted objects kept in memory by a worker process
+BROADCAST_CACHE_SIZE = 8
 
 
 class JobNotRunning(Exception):
@@ -52,13 +63,36 @@ class OqTaskManager(TaskManager):
       print oqm.aggregate_results(agg, acc)
 
     Progress report is built-in.
+
+    If the parameter `max_tasks_in_flight` in openquake.cfg is positive,
+    at most that number of tasks are sent to celery at the same time:
+    the arguments of the other tasks are kept in the controller and
+    a new task is sent every time a result is received (sliding window).
+    In this way the memory occupation of the broker and of the result
+    backend does not depend on the total number of tasks.
     """
+    #: maximum number of tasks sent and not completed; 0 means no limit
+    max_in_flight = MAX_TASKS_IN_FLIGHT
+
+    def __init__(self, *args, **kw):
+        super(OqTaskManager, self).__init__(*args, **kw)
+        self.queued = collections.deque()  # arguments of unsent tasks
+
     def submit(self, *args):
         """
         Submit an oqtask with the given arguments to celery and return
         an AsyncResult. If the variable OQ_NO_DISTRIBUTE is set, the
         task function is run in process and the result is returned.
+        If there are already `max_in_flight` tasks in flight the
+        arguments are queued and the task is sent later.
         """
+        if (self.max_in_flight and not no_distribute() and
+                len(self.results) >= self.max_in_flight):
+            self.queued.append(args)
+            return
+        self._submit(args)
+
+    def _submit(self, args):
         # log a warning if too much memory is used
         check_mem_usage(SOFT_MEM_LIMIT, HARD_MEM_LIMIT)
         if no_distribute():
@@ -68,11 +102,45 @@ class OqTaskManager(TaskManager):
             self.sent += sum(len(p) for p in piks)
             res = self.oqtask.delay(*piks)
         self.results.append(res)
+        return res
+
+    def reduce(self, agg=operator.add, acc=None):
+        """
+        Aggregate the results of the tasks. If some task was queued,
+        the tasks are sent with a sliding window while the results
+        are received.
+
+        :param agg: the aggregation function, (acc, val) -> new acc
+        :param acc: the initial value of the accumulator
+        :returns: the final value of the accumulator
+        """
+        if not self.queued:  # all the tasks were sent
+            return super(OqTaskManager, self).reduce(agg, acc)
+        if acc is None:
+            acc = AccumDict()
+        num_tasks = len(self.results) + len(self.queued)
+        logs.LOG.progress('Sending %d "%s" tasks, at most %d at the time',
+                          num_tasks, self.name, self.max_in_flight)
+        done = [0, 0]  # number of tasks completed, last percent logged
+
+        def agg_and_percent(acc, val):
+            res = agg(acc, val)
+            done[0] += 1
+            percent = done[0] * 100 // num_tasks
+            if percent >= done[1] + 10 or done[0] == num_tasks:
+                done[1] = percent
+                logs.LOG.progress('%s %3d%%', self.name, percent)
+            return res
+        acc = self.aggregate_result_set(agg_and_percent, acc)
+        self.results = []
+        return acc
 
     def aggregate_result_set(self, agg, acc):
         """
         Loop on a set of celery AsyncResults and update the accumulator
-        by using the aggregation function.
+        by using the aggregation function. The results are consumed in
+        completion order; every time a result is received a queued task
+        (if any) is sent.
 
         :param agg: the aggregation function, (acc, val) -> new acc
         :param acc: the initial value of the accumulator
@@ -81,22 +149,121 @@ class OqTaskManager(TaskManager):
         if not self.results:
             return acc
         backend = current_app().backend
-        rset = ResultSet(self.results)
-        for task_id, result_dict in rset.iter_native():
-            # log a warning if too much memory is used
-            check_mem_usage(SOFT_MEM_LIMIT, HARD_MEM_LIMIT)
-            result = result_dict['result']
-            if isinstance(result, BaseException):
-                raise result
-            self.received += len(result)
-            acc = agg(acc, result.unpickle())
-            del backend._cache[task_id]  # work around a celery bug
+        pending = collections.OrderedDict(
+            (res.task_id, res) for res in self.results)
+        while pending:
+            rset = ResultSet(pending.values())
+            for task_id, result_dict in rset.iter_native():
+                # log a warning if too much memory is used
+                check_mem_usage(SOFT_MEM_LIMIT, HARD_MEM_LIMIT)
+                del pending[task_id]
+                result = result_dict['result']
+                if isinstance(result, BaseException):
+                    raise result
+                self.received += len(result)
+                acc = agg(acc, result.unpickle())
+                del backend._cache[task_id]  # work around a celery bug
+                if self.queued:
+                    # fill the free slot and wait again on the new set;
+                    # the results already received are cached
+                    res = self._submit(self.queued.popleft())
+                    pending[res.task_id] = res
+                    break
         return acc
 
 # a convenient alias
 starmap = OqTaskManager.starmap
 
 
+class Broadcast(object):
+    """
+    A reference to an object published with :func:`broadcast`. It is
+    cheap to pickle; the object is read by the workers with the method
+    `.get()` and kept in memory, so that the tasks of the same job
+    running in the same process unpickle it only once.
+
+    :param path: the path of the file containing the pickled object
+    """
+    _cache = collections.OrderedDict()  # path -> object, per process
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        """
+        :returns: the broadcasted object
+        """
+        try:
+            obj = self._cache.pop(self.path)
+        except KeyError:
+            with open(self.path, 'rb') as f:
+                obj = pickle.load(f)
+            if len(self._cache) >= BROADCAST_CACHE_SIZE:
+                self._cache.popitem(last=False)  # discard the oldest
+        self._cache[self.path] = obj  # the most recent is the last one
+        return obj
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.path)
+
+
+def get_broadcast_dir(job_id):
+    """
+    :param job_id: the ID of the current job
+    :returns:
+        the directory where the broadcasted objects of the job are
+        saved, or None if the broadcast is disabled
+    """
+    broadcast_dir = config.get('celery', 'broadcast_dir')
+    if not broadcast_dir:
+        return None
+    return os.path.join(os.path.expanduser(broadcast_dir),
+                        'calc_%d' % job_id)
+
+
+def broadcast(job_id, obj):
+    """
+    Publish an object which is the same for all the tasks of a job,
+    by saving it in the directory `broadcast_dir` set in openquake.cfg,
+    which must be visible to all the workers. The file name is the SHA1
+    of the pickled object, so an object is saved only once.
+
+    :param job_id: the ID of the current job
+    :param obj: a pickleable object
+    :returns:
+        a :class:`Broadcast` instance, or the object itself if the
+        broadcast is disabled or the object is small
+    """
+    broadcast_dir = get_broadcast_dir(job_id)
+    if broadcast_dir is None or no_distribute():
+        return obj
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    if len(data) < BROADCAST_MIN_SIZE:
+        return obj
+    path = os.path.join(broadcast_dir, hashlib.sha1(data).hexdigest())
+    if not os.path.exists(path):
+        if not os.path.exists(broadcast_dir):
+            os.makedirs(broadcast_dir)
+        # write in a temporary file and then rename it, so that
+        # the workers never read a partially written file
+        tmpname = '%s.%d' % (path, os.getpid())
+        with open(tmpname, 'wb') as f:
+            f.write(data)
+        os.rename(tmpname, path)
+    return Broadcast(path)
+
+
+def clear_broadcast(job_id):
+    """
+    Remove the objects broadcasted by the given job, if any.
+
+    :param job_id: the ID of the job
+    """
+    broadcast_dir = get_broadcast_dir(job_id)
+    if broadcast_dir and os.path.exists(broadcast_dir):
+        shutil.rmtree(broadcast_dir)
+
+
 def apply_reduce(task, task_args,
                  agg=operator.add,
                  acc=None,
@@ -126,9 +293,36 @@ def apply_reduce(task, task_args,
         return acc
     elif len(data) == 1 or not concurrent_tasks:
         return agg(acc, task.task_func(job_id, data, *args))
-    blocks = split_in_blocks(data, concurrent_tasks, weight, key)
+    return submit_blocks(task, task_args, concurrent_tasks,
+                         weight, key, name).reduce(agg, acc)
+
+
+def submit_blocks(task, task_args,
+                  concurrent_tasks=CONCURRENT_TASKS,
+                  weight=lambda item: 1,
+                  key=lambda item: 'Unspecified',
+                  name=None):
+    """
+    Split the data in a tuple of the form (job_id, data, *args) in chunks
+    and submit a task for each chunk, without waiting for the results.
+    This is useful to send more work to the workers while the controller
+    is still reducing previous results. The large arguments in `*args`,
+    which are the same for all the tasks, are broadcasted (see
+    :func:`broadcast`) and not sent to each task.
+
+    :param task: an oqtask
+    :param task_args: the arguments to be passed to the task function
+    :param concurrent_tasks: hint about how many tasks to generate
+    :param weight: function to extract the weight of an item in data
+    :param key: function to extract the kind of an item in data
+    :returns: an :class:`OqTaskManager`; call .reduce(agg, acc) on it
+    """
+    job_id = task_args[0]
+    data = task_args[1]
+    args = tuple(broadcast(job_id, arg) for arg in task_args[2:])
+    blocks = split_in_blocks(data, concurrent_tasks or 1, weight, key)
     task_args = [(job_id, block) + args for block in blocks]
-    return starmap(task, task_args, logs.LOG.progress, name).reduce(agg, acc)
+    return starmap(task, task_args, logs.LOG.progress, name)
 
 
 def oqtask(task_func):
@@ -163,8 +357,9 @@ def oqtask(task_func):
             try:
                 # log a warning if too much memory is used
                 check_mem_usage(SOFT_MEM_LIMIT, HARD_MEM_LIMIT)
-                # run the task
-                return task_func(*args)
+                # read the broadcasted arguments and run the task
+                return task_func(*[arg.get() if isinstance(arg, Broadcast)
+                                   else arg for arg in args])
             finally:
                 # save on the db
                 CacheInserter.flushall()
@@ -22,22 +22,164 @@ Base classes for the output methods of the various codecs.
 import logging
 import weakref
 import atexit
+import struct
+from decimal import Decimal
 from cStringIO import StringIO
 
+import numpy
+
 from django.db import connections
 from django.db import router, transaction
 from django.contrib.gis.db.models.fields import GeometryField
 from django.contrib.gis.geos.point import Point
 
+from openquake.engine.db.fields import PickleField, GzippedField
+
 LOGGER = logging.getLogger('serializer')
 
+# see http://www.postgresql.org/docs/9.1/static/sql-copy.html
+PGCOPY_HEADER = 'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+PGCOPY_NULL = struct.pack('>i', -1)
+DEFAULT_SRID = 4326
+# EWKB of a 2D point with SRID, little endian
+EWKB_POINT = struct.Struct('<BIIdd')
+EWKB_POINT_TYPE = 0x20000001
+
+
+def _scalar_encoder(fmt):
+    # build an encoder for a fixed-size scalar type
+    st = struct.Struct('>i' + fmt)
+    size = st.size - 4
+    return lambda value: st.pack(size, value)
+
+
+def encode_text(value):
+    """
+    :returns: the binary COPY representation of a text field
+    """
+    data = unicode(value).encode('utf8')
+    return struct.pack('>i', len(data)) + data
+
+
+def encode_bytea(value):
+    """
+    :returns: the binary COPY representation of a bytea field
+    """
+    data = str(value)
+    return struct.pack('>i', len(data)) + data
+
+
+def encode_numeric(value):
+    """
+    :returns: the binary COPY representation of a numeric field, i.e.
+              a sequence of base 10000 digits
+    """
+    if not isinstance(value, Decimal):
+        value = Decimal(repr(value) if isinstance(value, float)
+                        else str(value))
+    if value.is_nan():
+        data = struct.pack('>hhHh', 0, 0, 0xC000, 0)
+        return struct.pack('>i', len(data)) + data
+    sign, digits, exp = value.as_tuple()
+    digits = ''.join(map(str, digits))
+    if exp >= 0:
+        intpart, fracpart = digits + '0' * exp, ''
+    else:
+        digits = digits.zfill(-exp)
+        intpart, fracpart = digits[:len(digits) + exp], digits[exp:]
+    dscale = max(0, -exp)
+    intpart = intpart.zfill((len(intpart) + 3) // 4 * 4)
+    fracpart = fracpart.ljust((len(fracpart) + 3) // 4 * 4, '0')
+    groups = [int(intpart[i:i + 4]) for i in range(0, len(intpart), 4)]
+    weight = len(groups) - 1
+    groups.extend(int(fracpart[i:i + 4])
+                  for i in range(0, len(fracpart), 4))
+    while groups and groups[0] == 0:  # strip the leading zeros
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:  # strip the trailing zeros
+        groups.pop()
+    if not groups:
+        weight = 0
+    data = struct.pack('>hhHh%dH' % len(groups), len(groups), weight,
+                       0x4000 if sign else 0, dscale, *groups)
+    return struct.pack('>i', len(data)) + data
+
+
+def encode_geometry(value):
+    """
+    :returns: the binary COPY representation of a PostGIS geometry, i.e.
+              its EWKB; the SRID is 4326 unless specified otherwise
+    """
+    if isinstance(value, Point):
+        data = EWKB_POINT.pack(1, EWKB_POINT_TYPE, value.srid or DEFAULT_SRID,
+                               value.x, value.y)
+    else:
+        if value.srid is None:
+            value = value.clone()
+            value.srid = DEFAULT_SRID
+        data = str(value.ewkb)
+    return struct.pack('>i', len(data)) + data
+
+
+def _array_encoder(elem_oid, dtype):
+    # build an encoder for an one-dimensional array of fixed-size
+    # elements; the elements are converted all together by numpy
+    size = numpy.dtype(dtype).itemsize
+    item = numpy.dtype([('size', '>i4'), ('value', dtype)])
+
+    def encode(value):
+        array = numpy.asarray(value, dtype)
+        if array.ndim != 1:
+            raise ValueError('Expected an one-dimensional array, got shape %s'
+                             % str(array.shape))
+        n = len(array)
+        if n:
+            items = numpy.empty(n, item)
+            items['size'] = size
+            items['value'] = array
+            data = struct.pack('>iiiii', 1, 0, elem_oid, n, 1) + \
+                items.tostring()
+        else:
+            data = struct.pack('>iii', 0, 0, elem_oid)
+        return struct.pack('>i', len(data)) + data
+    return encode
+
+
+#: binary encoders by PostgreSQL type name
+ENCODER = {
+    'bool': _scalar_encoder('?'),
+    'int2': _scalar_encoder('h'),
+    'int4': _scalar_encoder('i'),
+    'int8': _scalar_encoder('q'),
+    'float4': _scalar_encoder('f'),
+    'float8': _scalar_encoder('d'),
+    'text': encode_text,
+    'bytea': encode_bytea,
+    'varchar': encode_text,
+    'numeric': encode_numeric,
+    'geometry': encode_geometry,
+    'geography': encode_geometry,
+    '_int2': _array_encoder(21, '>i2'),
+    '_int4': _array_encoder(23, '>i4'),
+    '_int8': _array_encoder(20, '>i8'),
+    '_float4': _array_encoder(700, '>f4'),
+    '_float8': _array_encoder(701, '>f8'),
+}
+
 
 class CacheInserter(object):
     """
-    Bulk insert bunches of Django objects by converting them in strings
-    and by using COPY FROM.
+    Bulk insert bunches of Django objects by using COPY FROM. If all the
+    columns of the table have a binary encoder the objects are converted
+    in the binary COPY format, otherwise they are converted in strings.
     """
     instances = weakref.WeakSet()
+    # (alias, table name) -> list of (column name, encoder) or None
+    _encoders = {}
+    # model -> {column name: field} for the fields stored as bytea
+    _binary_fields = {}
 
     @classmethod
     def flushall(cls):
@@ -57,16 +199,27 @@ class CacheInserter(object):
         self = cls(objects[0].__class__, block_size)
         curs = connections[self.alias].cursor()
         seq = self.tname.replace('"', '') + '_id_seq'
+        encoders = self.encoders
         with transaction.atomic(using=self.alias):
             reserve_ids = "select nextval('%s') "\
                 "from generate_series(1, %d)" % (seq, len(objects))
             curs.execute(reserve_ids)
             ids = [i for (i,) in curs.fetchall()]
             stringio = StringIO()
-            for i, obj in zip(ids, objects):
-                stringio.write('%d\t%s\n' % (i, self.to_line(obj)))
-            stringio.reset()
-            curs.copy_from(stringio, self.tname)
+            if encoders is None:
+                for i, obj in zip(ids, objects):
+                    stringio.write('%d\t%s\n' % (i, self.to_line(obj)))
+                stringio.reset()
+                curs.copy_from(stringio, self.tname)
+            else:
+                [(_id, encode_id)] = encoders[:1]
+                stringio.write(PGCOPY_HEADER)
+                for i, obj in zip(ids, objects):
+                    stringio.write(self.to_record(obj, (i, encode_id)))
+                stringio.write(PGCOPY_TRAILER)
+                stringio.reset()
+                curs.copy_expert(
+                    'COPY %s FROM STDIN WITH BINARY' % self.tname, stringio)
             stringio.close()
         return ids
 
@@ -90,14 +243,47 @@ class CacheInserter(object):
         try:
             return self._fields[self.tname]
         except KeyError:
-            # introspect the field names from the database
-            # by relying on the DB API 2.0
-            # NB: we cannot trust the ordering in the Django model
-            curs = connections[self.alias].cursor()
-            curs.execute('select * from %s where 1=0' % self.tname)
-            names = self._fields[self.tname] = [
-                r[0] for r in curs.description if r[0] != 'id']
-            return names
+            self._introspect()
+            return self._fields[self.tname]
+
+    @property
+    def encoders(self):
+        """
+        Returns a list of pairs (field name, binary encoder) for all the
+        fields, including the id field, or None if some field has a type
+        which cannot be encoded and the text format must be used. The
+        introspection is done only once per table.
+        """
+        try:
+            return self._encoders[self.alias, self.tname]
+        except KeyError:
+            self._introspect()
+            return self._encoders[self.alias, self.tname]
+
+    def _introspect(self):
+        # introspect the field names and types from the database
+        # by relying on the DB API 2.0
+        # NB: we cannot trust the ordering in the Django model
+        curs = connections[self.alias].cursor()
+        curs.execute('select * from %s where 1=0' % self.tname)
+        descr = curs.description
+        self._fields[self.tname] = [r[0] for r in descr if r[0] != 'id']
+        type_codes = [r[1] if len(r) > 1 else None for r in descr]
+        encoders = None
+        if None not in type_codes:
+            curs.execute('select oid, typname from pg_type where oid in %s',
+                         (tuple(set(type_codes)),))
+            typname = dict(curs.fetchall())
+            try:
+                encoders = [(r[0], ENCODER[typname[code]])
+                            for r, code in zip(descr, type_codes)]
+            except KeyError:  # unknown type, use the text format
+                pass
+        if encoders is None or encoders[0][0] != 'id':
+            # saveall requires the id to be the first field
+            self._encoders[self.alias, self.tname] = None
+        else:
+            self._encoders[self.alias, self.tname] = encoders
 
     def add(self, obj):
         """
@@ -108,8 +294,10 @@ class CacheInserter(object):
         """
         assert isinstance(obj, self.table), 'Expected instance of %s, got %r' \
             % (self.table.__name__, obj)
-        line = self.to_line(obj)
-        self.stringio.write(line + '\n')
+        if self.encoders is None:
+            self.stringio.write(self.to_line(obj) + '\n')
+        else:
+            self.stringio.write(self.to_record(obj))
         self.nlines += 1
         if self.nlines >= self.max_cache_size:
             self.flush()
@@ -123,8 +311,18 @@ class CacheInserter(object):
 
         # save the StringIO object with a COPY FROM
         curs = connections[self.alias].cursor()
-        self.stringio.reset()
-        curs.copy_from(self.stringio, self.tname, columns=self.fields)
+        if self.encoders is None:
+            self.stringio.reset()
+            curs.copy_from(self.stringio, self.tname, columns=self.fields)
+        else:
+            data = StringIO()
+            data.write(PGCOPY_HEADER)
+            data.write(self.stringio.getvalue())
+            data.write(PGCOPY_TRAILER)
+            data.reset()
+            curs.copy_expert('COPY %s (%s) FROM STDIN WITH BINARY' % (
+                self.tname, ', '.join(self.fields)), data)
+            data.close()
         self.stringio.close()
         self.stringio = StringIO()
 
@@ -135,6 +333,14 @@ class CacheInserter(object):
         LOGGER.debug('saved %d rows in %s', self.nlines, self.tname)
         self.nlines = 0
 
+    def discard(self):
+        """
+        Discard the pending objects without saving them.
+        """
+        self.stringio.close()
+        self.stringio = StringIO()
+        self.nlines = 0
+
     def to_line(self, obj):
         """
         Convert the fields of a Django object into a line string suitable
@@ -159,6 +365,43 @@ class CacheInserter(object):
             cols.append(col)
         return '\t'.join(cols)
 
+    def to_record(self, obj, id_pair=None):
+        """
+        Convert the fields of a Django object into a tuple in the binary
+        COPY format. If `id_pair` is given, it must be a pair
+        (id, id_encoder) and the id field is included in the tuple.
+        """
+        encoders = self.encoders[1:]
+        n = len(encoders)
+        rec = []
+        if id_pair is not None:
+            i, encode_id = id_pair
+            rec.append(encode_id(i))
+            n += 1
+        binary_fields = self.binary_fields
+        for f, encode in encoders:
+            col = getattr(obj, f)
+            if col is not None and f in binary_fields:
+                # i.e. a PickleField, the value must be serialized
+                col = binary_fields[f].get_prep_value(col)
+            rec.append(PGCOPY_NULL if col is None else encode(col))
+        return struct.pack('>h', n) + ''.join(rec)
+
+    @property
+    def binary_fields(self):
+        """
+        Returns a dictionary column name -> Django field for the fields
+        of the model stored in bytea columns, which values are converted
+        with the method .get_prep_value of the field.
+        """
+        try:
+            return self._binary_fields[self.table]
+        except KeyError:
+            fields = self._binary_fields[self.table] = dict(
+                (f.column, f) for f in self.table._meta.fields
+                if isinstance(f, (PickleField, GzippedField)))
+            return fields
+
     @staticmethod
     def array_to_pgstring(a):
         """
@@ -17,6 +17,7 @@
 # License along with this program. If not, see
 # <https://www.gnu.org/licenses/agpl.html>.
 
+import csv
 import sys
 import logging
 import traceback
@@ -297,6 +298,28 @@ DBINTERFACE = {
 }
 
 
+def _arraystr(values):
+    # a list of floats in the syntax of a postgres array
+    return '{%s}' % ','.join(map(repr, map(float, values)))
+
+
+def export_lazy_curves(hc, fileobj):
+    """
+    Write on `fileobj` the curves of the given HazardCurve in the same
+    csv format of the export query of hazard curves. This is needed
+    when the curves are not stored in `hzrdr.hazard_curve_data`, but
+    they are read from the datastore or composed on-the-fly.
+
+    :param hc: a lazy :class:`openquake.engine.db.models.HazardCurve`
+    :param fileobj: a file-like object open for writing
+    """
+    writer = csv.writer(fileobj, delimiter='|', lineterminator='\n')
+    writer.writerow(['location', 'imls', 'poes'])
+    imls = _arraystr(hc.imls)
+    for x, y, poes in oqe_models.HazardCurveData.objects.curves_for(hc):
+        writer.writerow(['POINT(%r %r)' % (x, y), imls, _arraystr(poes)])
+
+
 def copy_output(platform_connection, output, foreign_calculation_id):
     """
     Copy `output` data from the engine database to the platform one.
@@ -334,14 +357,18 @@ def copy_output(platform_connection, output, foreign_calculation_id):
                 return
 
             logger.info("Copying to temporary stream")
-            engine_cursor.copy_expert(
-                """COPY (%s) TO STDOUT
-                   WITH (FORMAT 'csv', HEADER true,
-                         ENCODING 'utf8', DELIMITER '|')""" % (
-                iface.export_query % {
-                    'output_id': output.id,
-                    'calculation_id': output.oq_job.id}),
-                temporary_file)
+            if (output.output_type == 'hazard_curve' and
+                    output.hazard_curve.is_lazy):
+                export_lazy_curves(output.hazard_curve, temporary_file)
+            else:
+                engine_cursor.copy_expert(
+                    """COPY (%s) TO STDOUT
+                       WITH (FORMAT 'csv', HEADER true,
+                             ENCODING 'utf8', DELIMITER '|')""" % (
+                        iface.export_query % {
+                            'output_id': output.id,
+                            'calculation_id': output.oq_job.id}),
+                    temporary_file)
 
             temporary_file.seek(0)
 